@@ -0,0 +1,468 @@
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+import history_utils
+import json_utils
+import render_utils
+import trace_utils
+from chatbot_utils import CalendarChatGPT, _unavailable_note
+
+
+class ChatSession:
+  """State of one conversation: its own bounded history and a turn lock.
+  """
+  def __init__(self, session_id, history=None):
+    self.session_id = session_id
+    self.history = history if history is not None else history_utils.HistoryManager()
+    self.lock = asyncio.Lock()
+    self.last_active = time.time()
+
+  @property
+  def messages(self):
+    return self.history.turns
+
+
+class ServerBusy(Exception):
+  """Raised by SessionManager when too many turns are already waiting.
+  """
+
+
+class AsyncCalendarChatGPT(CalendarChatGPT):
+  """asyncio version of CalendarChatGPT.
+
+  LLM calls go through AsyncOpenAI; blocking Google Calendar calls run on a
+  bounded thread pool. Every stage takes a ChatSession so that many
+  conversations can share one instance.
+  """
+  def __init__(self, *args, max_calendar_workers=8, async_client=None, **kwargs):
+    if kwargs.get("client") is None:
+      # the synchronous client is never used; don't build one
+      kwargs["client"] = async_client
+    super().__init__(*args, **kwargs)
+    self.client = async_client
+    self.executor = ThreadPoolExecutor(max_workers=max_calendar_workers)
+    self.default_session = ChatSession("default")
+
+  def _make_client(self):
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=self.openai_api_key, max_retries=0)
+
+  async def _run_blocking(self, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # keep the current span as the parent of spans opened by fn
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(self.executor, functools.partial(context.run, fn, *args, **kwargs))
+
+  async def call(self, messages, stage=None, json_mode=False, max_tokens=None, cache=True):
+    with self.tracer.span("llm", stage=stage, request_chars=trace_utils.payload_chars(messages)) as span:
+      started = time.perf_counter()
+      key, response = self._cached_response(messages, stage, json_mode, max_tokens)
+      span.set(cache_hit=response is not None)
+      if response is not None:
+        self._record_timing(stage, started)
+        return response
+
+      if self.json_output or json_mode:
+        response = await self.governor.acall(
+          self._governor_key(), self.client.chat.completions.create, idempotent=False,
+          model=self.model,
+          response_format={ "type": "json_object" },
+          messages=messages,
+          max_tokens=max_tokens or self.max_tokens
+        )
+      else:
+        response = await self.governor.acall(
+          self._governor_key(), self.client.chat.completions.create, idempotent=False,
+          model=self.model,
+          messages=messages,
+          max_tokens=max_tokens or self.max_tokens
+        )
+      if key is not None and cache:
+        self.response_cache.put(stage, key, response)
+      self._record_tokens(stage, messages, getattr(response, "usage", None),
+                          response.choices[0].message.content, span)
+      self._record_timing(stage, started)
+      return response
+
+  async def stream(self, messages, stage=None):
+    """Async generator version of CalendarChatGPT.stream.
+    """
+    span = self.tracer.start_span("llm", stage=stage, stream=True,
+                                  request_chars=trace_utils.payload_chars(messages))
+    error = None
+    try:
+      started = time.perf_counter()
+      key, response = self._cached_response(messages, stage)
+      span.set(cache_hit=response is not None)
+      if response is not None:
+        self._record_timing(stage, started)
+        yield response.choices[0].message.content
+        return
+
+      chunks = await self.governor.acall(
+        self._governor_key(), self.client.chat.completions.create, idempotent=False,
+        model=self.model,
+        messages=messages,
+        max_tokens=self.max_tokens,
+        **self._stream_kwargs()
+      )
+      parts = []
+      usage = None
+      async for chunk in chunks:
+        if getattr(chunk, "usage", None) is not None:
+          usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+          if not parts:
+            span.set(first_token_ms=round((time.perf_counter() - started) * 1000, 3))
+          parts.append(chunk.choices[0].delta.content)
+          yield chunk.choices[0].delta.content
+      self._record_tokens(stage, messages, usage, "".join(parts), span)
+      self._record_timing(stage, started)
+    except BaseException as e:
+      error = type(e).__name__
+      raise
+    finally:
+      self.tracer.end_span(span, error)
+
+  async def _ask(self, session, content, stage, prompt=None):
+    """Sends the stage prompt after the history relevant to the stage and
+    returns the reply text.
+    """
+    self.tracer.debug("prompt", stage=stage, session=session.session_id, text=content)
+    messages = self._stage_messages(stage, content, session.history, prompt)
+    response = await self.call(messages, stage=stage)
+    return response.choices[0].message.content
+
+  async def _ask_json(self, session, content, stage, parse):
+    """Like _ask, but returns parse(reply) and asks for a corrected reply
+    while parse raises json_utils.JSONParseError, up to json_repairs times.
+    """
+    self.tracer.debug("prompt", stage=stage, session=session.session_id, text=content)
+    messages = self._stage_messages(stage, content, session.history)
+    response = await self.call(messages, stage=stage, cache=False)
+    message = response.choices[0].message.content
+    for repair in range(self.json_repairs + 1):
+      try:
+        result = parse(message)
+      except json_utils.JSONParseError as e:
+        if repair == self.json_repairs:
+          raise
+        self.parse_stats.record(stage, repairs=1)
+        messages = self._repair_messages(messages, message, e)
+        message = (await self.call(messages, stage=stage + "_repair")).choices[0].message.content
+        continue
+      if repair:
+        self.parse_stats.record(stage, repaired=1)
+      else:
+        self._cache_response(messages, stage, response)
+      return result
+
+  async def _ask_batch(self, stage, texts):
+    with self.tracer.span("llm_batch", stage=stage, items=len(texts)):
+      messages = self._batch_messages(stage, texts)
+      # one reply answers every item, so it gets the room of all of them
+      message = (await self.call(messages, stage=stage + "_batch", json_mode=True,
+                                 max_tokens=self.max_tokens * len(texts))).choices[0].message.content
+      return self._batch_answers(stage, message, len(texts))
+
+  async def _batched(self, stage, text, session):
+    if self.micro_batcher is None or session.history.context(stage):
+      return None
+    return await self.micro_batcher.asubmit(self._batch_key(stage), text,
+                                            lambda texts: self._ask_batch(stage, texts))
+
+  async def _prompt_intent(self, text, session):
+    with self.tracer.span("stage.intent") as span:
+      intent = await self._batched("intent", text, session)
+      span.set(batched=intent is not None)
+      if intent is not None:
+        return intent
+      return await self._ask(session, self._intent_prompt(text), "intent")
+
+  async def _prompt_add_calendar(self, text, session):
+    with self.tracer.span("stage.add_calendar") as span:
+      try:
+        message_json = await self._ask_json(session, self._add_calendar_prompt(text), "add_calendar",
+                                            self._parse_add_calendar)
+        event = await self._run_blocking(self._insert_event, message_json)
+        return 'Event created: %s' % (event.get('htmlLink'))
+      except Exception as e:
+        span.set(failure=f"{type(e).__name__}: {e}")
+        return None
+
+  async def _prompt_detect_date(self, text, session):
+    with self.tracer.span("stage.detect_date") as span:
+      resolved = self._local_date(text)
+      span.set(local=resolved is not None)
+      if resolved is not None:
+        return resolved
+      return await self._llm_date(text, session)
+
+  async def _llm_date(self, text, session):
+    resolved = await self._batched("detect_date", text, session)
+    if resolved is not None:
+      return resolved
+    return await self._ask_json(session, self._detect_date_prompt(text), "detect_date", self._parse_detect_date)
+
+  async def _prompt_summarize_calendar(self, text, session):
+    with self.tracer.span("stage.summarize", mode=self.summary_mode):
+      date_expression, date_min, date_max = await self._prompt_detect_date(text, session)
+      date_min, date_max = self._summary_time_range(date_min, date_max)
+      event_list, unavailable = await self._run_blocking(self._fetch_events, date_min, date_max)
+      return await self._summarize_events(text, date_expression, date_min, event_list, session, unavailable)
+
+  async def _summarize_events(self, text, date_expression, date_min, event_list, session, unavailable=()):
+    if self.summary_mode == "llm":
+      summary = await self._ask_json(session, self._summarize_prompt(text, event_list, date_min), "summarize",
+                                     lambda message: self._render_summary(message, date_expression, date_min))
+      return summary + _unavailable_note(unavailable)
+
+    agenda = render_utils.render_agenda(event_list, date_expression, date_min, timezone=self.timezone)
+    if self.summary_mode != "polish":
+      return agenda + _unavailable_note(unavailable)
+    polished = await self._ask(session, self._polish_prompt(text, agenda), "summarize", prompt="polish")
+    return polished + _unavailable_note(unavailable)
+
+  async def analysis_dialogue_gpt_call(self, user_text, session):
+    with self.tracer.span("stage.analysis"):
+      return await self._ask_json(session, self._analysis_prompt(user_text), "analysis", self._parse_analysis)
+
+  async def create_schedule_dialogue_gpt_call(self, formatted_string, session):
+    with self.tracer.span("stage.schedule"):
+      return await self._ask_json(session, self._schedule_prompt(formatted_string), "schedule",
+                                  self._parse_schedule)
+
+  async def create_subtasks_gpt_call(self, formatted_string, session):
+    with self.tracer.span("stage.subtasks"):
+      return await self._ask_json(session, self._subtasks_prompt(formatted_string), "subtasks",
+                                  self._parse_subtasks)
+
+  async def _prompt_plan_and_add_calendar(self, text, session):
+    with self.tracer.span("stage.plan", local_scheduler=self.local_scheduler) as span:
+      formatted_string = await self.analysis_dialogue_gpt_call(text, session)
+      unscheduled = []
+      unavailable = []
+      if self.local_scheduler:
+        subtasks = await self.create_subtasks_gpt_call(formatted_string, session)
+        start, deadline = self._plan_window(formatted_string)
+        event_list, busy, unavailable = await self._run_blocking(self._fetch_busy, start, deadline)
+        message_json, unscheduled = self._schedule_locally(subtasks, start, deadline, event_list, busy)
+      else:
+        message_json = await self.create_schedule_dialogue_gpt_call(formatted_string, session)
+        message_json = message_json["Tasks"]
+      bodies, task_indices, failed = self._plan_bodies(message_json)
+      results = await self._run_blocking(self._insert_events, bodies)
+      message_json += unscheduled
+      failed += [task['Task'] for task in unscheduled]
+      span.set(tasks=len(message_json), failed=len(failed))
+      return self._plan_output(message_json, task_indices, results, failed) + _unavailable_note(unavailable)
+
+  async def _speculate_summary_inputs(self, text, session):
+    started = time.perf_counter()
+    llm_calls = 0
+    resolved = self._local_date(text)
+    if resolved is None:
+      resolved = await self._llm_date(text, session)
+      llm_calls = 1
+    date_min, date_max = self._summary_time_range(resolved[1], resolved[2])
+    event_list, unavailable = await self._run_blocking(self._fetch_events, date_min, date_max)
+    return dict(date_expression=resolved[0], date_min=date_min, event_list=event_list, unavailable=unavailable,
+                llm_calls=llm_calls, seconds=time.perf_counter() - started)
+
+  async def _prompt_speculative(self, text, session):
+    summary_task = asyncio.create_task(self._speculate_summary_inputs(text, session))
+    self.speculation_stats["runs"] += 1
+    try:
+      message_content = await self._prompt_intent(text, session)
+    except BaseException:
+      summary_task.cancel()
+      raise
+
+    if '1' in message_content:
+      self.speculation_stats["kept"] += 1
+      inputs = await summary_task
+      return await self._summarize_events(text, inputs["date_expression"], inputs["date_min"],
+                                           inputs["event_list"], session, inputs["unavailable"])
+
+    if summary_task.done():
+      if summary_task.exception() is None:
+        result = summary_task.result()
+        self.speculation_stats["wasted"] += 1
+        self.speculation_stats["wasted_llm_calls"] += result["llm_calls"]
+        self.speculation_stats["wasted_event_fetches"] += 1
+        self.speculation_stats["wasted_seconds"] += result["seconds"]
+    else:
+      summary_task.cancel()
+      self.speculation_stats["cancelled"] += 1
+    return await self._dispatch(message_content, text, session)
+
+  async def prompt(self, text, session=None) -> str:
+    if session is None:
+      session = self.default_session
+    with self.tracer.span("turn", session=session.session_id, request_chars=len(text)) as span:
+      reply = await self._respond(text, session)
+      session.history.add_turn(text, reply)
+      span.set(response_chars=len(reply or ""))
+      return reply
+
+  async def prompt_stream(self, text, session=None):
+    """Async generator version of CalendarChatGPT.prompt_stream.
+    """
+    if session is None:
+      session = self.default_session
+    span = self.tracer.start_span("turn", session=session.session_id, stream=True, request_chars=len(text))
+    parts = []
+    error = None
+    responses = self._respond_stream(text, session)
+    try:
+      while True:
+        # the turn is the parent of the spans opened while making the reply
+        with self.tracer.activate(span):
+          try:
+            part = await responses.__anext__()
+          except StopAsyncIteration:
+            break
+        parts.append(part)
+        yield part
+    except BaseException as e:
+      error = type(e).__name__
+      raise
+    finally:
+      with self.tracer.activate(span):
+        await responses.aclose()
+      span.set(response_chars=sum(len(part) for part in parts))
+      self.tracer.end_span(span, error)
+    session.history.add_turn(text, "".join(parts))
+
+  async def _respond_stream(self, text, session):
+    message_content = self._local_intent(text)
+    if message_content is None:
+      message_content = await self._prompt_intent(text, session)
+
+    if '3' in message_content and not self.local_scheduler:
+      async for part in self._stream_plan_and_add_calendar(text, session):
+        yield part
+    elif any(intent in message_content for intent in '123'):
+      yield await self._dispatch(message_content, text, session)
+    else:
+      messages = self._stage_messages("chat", text, session.history)
+      async for part in self.stream(messages, stage="chat"):
+        yield part
+
+  async def _stream_plan_and_add_calendar(self, text, session):
+    formatted_string = await self.analysis_dialogue_gpt_call(text, session)
+    input_text = self._schedule_prompt(formatted_string)
+    self.tracer.debug("prompt", stage="schedule", session=session.session_id, text=input_text)
+    messages = self._stage_messages("schedule", input_text, session.history)
+
+    parser = json_utils.IncrementalArrayParser()
+    inserts = []
+    shown = 0
+    failed = []
+    async for delta in self.stream(messages, stage="schedule"):
+      for item in parser.feed(delta):
+        inserts.append(asyncio.ensure_future(self._run_blocking(self._insert_plan_item, len(inserts), item)))
+      while shown < len(inserts) and inserts[shown].done():
+        yield self._plan_item_line(shown, inserts[shown].result(), failed)
+        shown += 1
+    for insert in inserts[shown:]:
+      yield self._plan_item_line(shown, await insert, failed)
+      shown += 1
+
+    if not inserts:
+      # no task could be found in the stream; ask for the whole plan, with the repair retries
+      try:
+        tasks = (await self.create_schedule_dialogue_gpt_call(formatted_string, session))["Tasks"]
+      except json_utils.JSONParseError as error:
+        self.tracer.debug("plan_failed", session=session.session_id, errors=error.errors)
+        tasks = []
+      if not tasks:
+        yield "I could not make a plan for this request. Could you rephrase it?"
+        return
+      for i, task in enumerate(tasks):
+        yield self._plan_item_line(i, (task,) + await self._run_blocking(self._insert_plan_task, task), failed)
+    if failed:
+      yield "\nThe following tasks could not be added: " + ", ".join(failed)
+
+  async def _respond(self, text, session):
+    message_content = self._local_intent(text)
+    if message_content is None:
+      if self.speculative:
+        return await self._prompt_speculative(text, session)
+      message_content = await self._prompt_intent(text, session)
+
+    return await self._dispatch(message_content, text, session)
+
+  async def _dispatch(self, message_content, text, session):
+    if '1' in message_content:
+      return await self._prompt_summarize_calendar(text, session)
+    elif '2' in message_content:
+      return await self._prompt_add_calendar(text, session)
+    elif '3' in message_content:
+      return await self._prompt_plan_and_add_calendar(text, session)
+    else:
+      return await self._ask(session, text, "chat")
+
+  def close(self):
+    self.executor.shutdown(wait=False)
+
+
+class SessionManager:
+  """Serves many conversations concurrently on one AsyncCalendarChatGPT.
+
+  Turns of the same session run one at a time, at most `max_concurrency`
+  turns run at once, and `handle` raises ServerBusy once `max_pending` turns
+  are in flight or waiting, so callers can shed load instead of queueing
+  without bound.
+  """
+  def __init__(self, chatbot, max_concurrency=100, max_pending=1000, idle_timeout=None,
+               history_factory=history_utils.HistoryManager):
+    self.chatbot = chatbot
+    self.history_factory = history_factory
+    self.max_pending = max_pending
+    self.idle_timeout = idle_timeout
+    self.sessions = {}
+    self.pending = 0
+    self._semaphore = asyncio.Semaphore(max_concurrency)
+
+  def get_session(self, session_id):
+    if session_id not in self.sessions:
+      self.sessions[session_id] = ChatSession(session_id, history=self.history_factory())
+    return self.sessions[session_id]
+
+  def close_session(self, session_id):
+    self.sessions.pop(session_id, None)
+
+  def evict_idle(self):
+    """Drops sessions idle for longer than idle_timeout seconds.
+    """
+    if self.idle_timeout is None:
+      return
+    now = time.time()
+    for session_id, session in list(self.sessions.items()):
+      if now - session.last_active > self.idle_timeout and not session.lock.locked():
+        del self.sessions[session_id]
+
+  async def handle(self, session_id, text):
+    if self.pending >= self.max_pending:
+      raise ServerBusy(f"{self.pending} turns pending")
+    self.pending += 1
+    try:
+      session = self.get_session(session_id)
+      async with session.lock:
+        async with self._semaphore:
+          response = await self.chatbot.prompt(text, session)
+      session.last_active = time.time()
+      return response
+    finally:
+      self.pending -= 1
+
+  async def handle_many(self, turns):
+    """Runs (session_id, text) turns concurrently; returns responses or exceptions in order.
+    """
+    return await asyncio.gather(*(self.handle(session_id, text) for session_id, text in turns),
+                                return_exceptions=True)
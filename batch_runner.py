@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from dotenv import load_dotenv
+
+from chatbot_utils import CalendarChatGPT, collect_timings
+from micro_batcher import MicroBatcher
+
+TEXT_KEYS = ("text", "utterance", "body")
+ID_KEYS = ("request_id", "id")
+
+
+class RateLimiter:
+  """Spaces calls so that at most `rate` start per second across threads.
+  """
+  def __init__(self, rate=None):
+    self.interval = 1.0 / rate if rate else 0.0
+    self._next = 0.0
+    self._lock = threading.Lock()
+
+  def wait(self):
+    if not self.interval:
+      return
+    with self._lock:
+      now = time.monotonic()
+      start = max(now, self._next)
+      self._next = start + self.interval
+    if start > now:
+      time.sleep(start - now)
+
+
+def read_requests(input_path):
+  """Yields (request_id, text) for each line of a JSONL file.
+
+  The text is taken from the first of TEXT_KEYS present, the id from the first
+  of ID_KEYS, else the line number. Blank and malformed lines are skipped.
+  """
+  with open(input_path, encoding="utf-8") as f:
+    for line_no, line in enumerate(f, start=1):
+      line = line.strip()
+      if not line:
+        continue
+      try:
+        record = json.loads(line)
+      except json.JSONDecodeError:
+        print(f"Skipping malformed line {line_no}")
+        continue
+      text = next((record[k] for k in TEXT_KEYS if record.get(k)), None)
+      if text is None:
+        print(f"Skipping line {line_no} without text")
+        continue
+      request_id = next((record[k] for k in ID_KEYS if record.get(k) is not None), f"line-{line_no}")
+      yield str(request_id), text
+
+
+def finished_ids(output_path, retry_errors=False):
+  """Ids already written to output_path; failed ones only unless retry_errors.
+  """
+  done = set()
+  if not os.path.exists(output_path):
+    return done
+  with open(output_path, encoding="utf-8") as f:
+    for line in f:
+      try:
+        record = json.loads(line)
+      except json.JSONDecodeError:
+        # partial line left by a crash
+        continue
+      if retry_errors and record.get("status") != "ok":
+        continue
+      done.add(record["request_id"])
+  return done
+
+
+def _ends_with_newline(path):
+  with open(path, "rb") as f:
+    f.seek(-1, os.SEEK_END)
+    return f.read(1) == b"\n"
+
+
+def stage_timings(timings):
+  """Sums (stage, seconds) pairs per stage.
+  """
+  totals = defaultdict(float)
+  for stage, seconds in timings:
+    totals[stage or "chat"] += seconds
+  return {stage: round(seconds, 4) for stage, seconds in totals.items()}
+
+
+def process_request(chatbot, request_id, text):
+  # every line is an independent conversation
+  chatbot.history.clear()
+  started = time.perf_counter()
+  record = {"request_id": request_id, "text": text}
+  with collect_timings() as timings:
+    try:
+      record["response"] = chatbot.prompt(text)
+      record["status"] = "ok"
+    except Exception as e:
+      record["response"] = None
+      record["status"] = "error"
+      record["error"] = f"{type(e).__name__}: {e}"
+  record["seconds"] = round(time.perf_counter() - started, 4)
+  record["timings"] = stage_timings(timings)
+  return record
+
+
+def run_batch(input_path, output_path, make_chatbot, concurrency=4, rate=None, retry_errors=False):
+  """Streams the requests of input_path through CalendarChatGPT.prompt.
+
+  Each worker thread builds its own chatbot with make_chatbot(). Results are
+  appended to output_path as they finish and flushed line by line, so a rerun
+  after a crash skips the requests already written. At most `rate` requests
+  start per second. Returns counts of ok, error and skipped requests.
+  """
+  done = finished_ids(output_path, retry_errors)
+  limiter = RateLimiter(rate)
+  local = threading.local()
+  counts = {"ok": 0, "error": 0, "skipped": 0}
+
+  def work(request_id, text):
+    if not hasattr(local, "chatbot"):
+      local.chatbot = make_chatbot()
+    limiter.wait()
+    return process_request(local.chatbot, request_id, text)
+
+  def collect(futures):
+    for future in futures:
+      record = future.result()
+      out.write(json.dumps(record, ensure_ascii=False) + "\n")
+      out.flush()
+      counts[record["status"]] += 1
+      print(">>============ {0} {1} ({2}s)".format(record["request_id"], record["status"], record["seconds"]))
+
+  with open(output_path, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=concurrency) as executor:
+    if out.tell() and not _ends_with_newline(output_path):
+      # terminate the partial line left by a crash
+      out.write("\n")
+    pending = set()
+    for request_id, text in read_requests(input_path):
+      if request_id in done:
+        counts["skipped"] += 1
+        continue
+      done.add(request_id)
+      # keep the input streaming instead of queueing the whole file
+      if len(pending) >= concurrency * 2:
+        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+        collect(finished)
+      pending.add(executor.submit(work, request_id, text))
+    collect(wait(pending)[0])
+  return counts
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(description="Replay a JSONL file of utterances through CalendarChatGPT.")
+  arg_parser.add_argument("input", help="JSONL file with one utterance per line")
+  arg_parser.add_argument("output", help="JSONL file the results are appended to")
+  arg_parser.add_argument("--concurrency", type=int, default=4)
+  arg_parser.add_argument("--rate", type=float, default=None, help="max requests started per second")
+  arg_parser.add_argument("--retry-errors", action="store_true", help="rerun requests that failed before")
+  arg_parser.add_argument("--model", default="gpt-4-1106-preview")
+  arg_parser.add_argument("--timezone", default="Korean Standard Time")
+  arg_parser.add_argument("--max-tokens", type=int, default=1000,
+                          help="reply limit of each LLM call; plans and summaries need more than a chat turn")
+  arg_parser.add_argument("--batch-size", type=int, default=1,
+                          help="send the intent and date prompts of up to this many requests in one call")
+  arg_parser.add_argument("--batch-wait", type=float, default=0.02,
+                          help="seconds a prompt waits for others to share its call")
+  args = arg_parser.parse_args()
+
+  load_dotenv()
+  # one batcher for all the workers' chatbots
+  batcher = MicroBatcher(args.batch_size, args.batch_wait) if args.batch_size > 1 else None
+  make_chatbot = lambda: CalendarChatGPT(os.environ.get("OPENAI_API_KEY"),
+                                         model=args.model,
+                                         timezone=args.timezone,
+                                         max_tokens=args.max_tokens,
+                                         micro_batcher=batcher)
+  counts = run_batch(args.input, args.output, make_chatbot,
+                     concurrency=args.concurrency, rate=args.rate, retry_errors=args.retry_errors)
+  print("Done: {ok} ok, {error} failed, {skipped} skipped".format(**counts))
+
+
+if __name__ == "__main__":
+  main()
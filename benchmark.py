@@ -0,0 +1,289 @@
+"""Benchmarks the summarize, add and plan flows of CalendarChatGPT offline,
+against the stand-ins of fake_backends.
+
+    python benchmark.py --iterations 100 --concurrency 4 --events 2000 --llm-latency 0.3
+    python benchmark.py --startup 10
+    python benchmark.py --event-formats --events 5000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+import date_utils
+import event_record
+import fake_backends
+import history_utils
+from chatbot_utils import CalendarChatGPT, collect_timings
+from micro_batcher import MicroBatcher
+
+FLOWS = {
+  "summarize": "What's my schedule for today?",
+  "add": "Add a meeting with Ryan Gosling tomorrow at 2PM in Room 308.",
+  "plan": "I have a conference talk next Friday. Can you plan what I should do to prepare for it?",
+}
+
+
+def percentile(values, q):
+  if not values:
+    return 0.0
+  values = sorted(values)
+  return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+
+def _summary(values):
+  return {"n": len(values),
+          "mean": round(sum(values) / len(values), 6) if values else 0.0,
+          "p50": round(percentile(values, 50), 6),
+          "p95": round(percentile(values, 95), 6)}
+
+
+def make_chatbot_factory(events, llm_latency=0.0, calendar_latency=0.0, prompt_cache_min_tokens=1024, **kwargs):
+  """Returns a function building a CalendarChatGPT on fresh fake backends.
+  """
+  def make_chatbot():
+    client = fake_backends.ScriptedChatClient(latency=llm_latency, prompt_cache_min_tokens=prompt_cache_min_tokens)
+    return CalendarChatGPT(None,
+                           client=client,
+                           service=fake_backends.FakeCalendarService(events, latency=calendar_latency),
+                           **kwargs)
+  return make_chatbot
+
+
+def run_flow(make_chatbot, text, iterations, concurrency=1):
+  """Runs `iterations` turns of text on `concurrency` threads, one chatbot each.
+
+  Returns end-to-end latency, per-stage latency of each LLM/Calendar call,
+  per-stage prompt and cached prompt tokens and throughput in turns per second.
+  """
+  turns = []
+  stages = defaultdict(list)
+  tokens = defaultdict(lambda: {"prompt_tokens": 0, "cached_prompt_tokens": 0})
+  errors = []
+  lock = threading.Lock()
+  counter = iter(range(iterations))
+
+  def worker():
+    chatbot = make_chatbot()
+    while True:
+      with lock:
+        if next(counter, None) is None:
+          for stage, stats in chatbot.token_counter.stats.items():
+            tokens[stage or "chat"]["prompt_tokens"] += stats["prompt_tokens"]
+            tokens[stage or "chat"]["cached_prompt_tokens"] += stats["cached_prompt_tokens"]
+          return
+      chatbot.history.clear()
+      started = time.perf_counter()
+      try:
+        with collect_timings() as timings:
+          chatbot.prompt(text)
+      except Exception as e:
+        with lock:
+          errors.append(f"{type(e).__name__}: {e}")
+        continue
+      seconds = time.perf_counter() - started
+      with lock:
+        turns.append(seconds)
+        for stage, stage_seconds in timings:
+          stages[stage or "chat"].append(stage_seconds)
+
+  threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+  started = time.perf_counter()
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  wall = time.perf_counter() - started
+
+  return {"turns": _summary(turns),
+          "stages": {stage: _summary(values) for stage, values in stages.items()},
+          "prompt_tokens": dict(tokens),
+          "throughput": round(len(turns) / wall, 2) if wall else 0.0,
+          "errors": len(errors)}
+
+
+def peak_memory(make_chatbot, text, iterations=10):
+  """Peak traced memory in bytes of building a chatbot and running a few turns.
+  """
+  tracemalloc.start()
+  try:
+    chatbot = make_chatbot()
+    for _ in range(iterations):
+      chatbot.prompt(text)
+    return tracemalloc.get_traced_memory()[1]
+  finally:
+    tracemalloc.stop()
+
+
+def _retained(build):
+  """build() and the traced memory it leaves allocated, in bytes.
+  """
+  tracemalloc.start()
+  try:
+    value = build()
+    return value, tracemalloc.get_traced_memory()[0]
+  finally:
+    tracemalloc.stop()
+
+
+# the keys the summarize prompt used to send of each event, as a dict repr
+DICT_PROMPT_KEYS = ['summary', 'start', 'organizer', 'end', 'location', 'attendees']
+
+
+def measure_event_formats(events=1000, timezone="Asia/Seoul"):
+  """Memory kept by the events of a listing and the prompt tokens of sending
+  them, as the API's dicts and as event_record.EventRecords.
+  """
+  tzinfo = date_utils.get_tzinfo(timezone)
+  payload = json.dumps(fake_backends.generate_events(events, timezone=timezone))
+  dicts, dict_bytes = _retained(lambda: json.loads(payload))
+  # the records are built from a response of their own, which is then dropped
+  records, record_bytes = _retained(lambda: event_record.from_events(json.loads(payload), tzinfo))
+  dict_text = str([{k: event.get(k, '') for k in DICT_PROMPT_KEYS} for event in dicts])
+  record_text = event_record.serialize(records, tzinfo)
+  return {"events": len(records),
+          "dicts": {"bytes": dict_bytes, "prompt_tokens": history_utils.estimate_tokens(dict_text)},
+          "records": {"bytes": record_bytes, "prompt_tokens": history_utils.estimate_tokens(record_text)}}
+
+
+def print_event_formats(result):
+  print(">>===========================================")
+  print("[event formats] {0} events".format(result["events"]))
+  for name in ("dicts", "records"):
+    print("  {0:<16} {1:10.1f} KiB  {2:>8} prompt tokens".format(
+      name, result[name]["bytes"] / 1024, result[name]["prompt_tokens"]))
+
+
+# Run in a fresh interpreter per sample, so that nothing is imported yet
+STARTUP_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import chatbot_utils
+imported = time.perf_counter()
+heavy = [m for m in ("openai", "googleapiclient", "google_auth_oauthlib") if m in sys.modules]
+import fake_backends
+events = fake_backends.generate_events({events})
+ready = time.perf_counter()
+chatbot = chatbot_utils.CalendarChatGPT(None, client=fake_backends.ScriptedChatClient(),
+                                        service=fake_backends.FakeCalendarService(events))
+constructed = time.perf_counter()
+chatbot.prompt({text!r})
+answered = time.perf_counter()
+print(json.dumps({{"import": imported - started, "construct": constructed - ready,
+                  "first_response": answered - constructed, "heavy_modules": heavy}}))
+"""
+
+
+def measure_startup(runs=5, events=100, text=FLOWS["summarize"]):
+  """Import time of chatbot_utils, construction time and time to the first
+  reply, each measured in `runs` fresh interpreters.
+
+  The first reply includes loading whatever the chatbot defers to first use;
+  the fakes stand in for OpenAI and Calendar, so no network time is counted.
+  """
+  script = STARTUP_SCRIPT.format(events=events, text=text)
+  samples = defaultdict(list)
+  heavy = set()
+  env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+  for _ in range(runs):
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)), env=env).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    heavy.update(result.pop("heavy_modules"))
+    for name, seconds in result.items():
+      samples[name].append(seconds)
+  return {"phases": {name: _summary(values) for name, values in samples.items()},
+          "heavy_modules_on_import": sorted(heavy)}
+
+
+def print_startup(result):
+  print(">>===========================================")
+  print("[startup] heavy modules loaded by the import: {0}".format(", ".join(result["heavy_modules_on_import"]) or "none"))
+  for name, stats in result["phases"].items():
+    print("  {0:<16} {1:>5} runs   p50 {2:8.2f} ms  p95 {3:8.2f} ms".format(
+      name, stats["n"], stats["p50"] * 1000, stats["p95"] * 1000))
+
+
+def run_benchmark(flows=tuple(FLOWS), iterations=50, concurrency=1, events=1000,
+                  llm_latency=0.0, calendar_latency=0.0, recurring=0, **kwargs):
+  event_list = fake_backends.generate_events(events, recurring=recurring)
+  make_chatbot = make_chatbot_factory(event_list, llm_latency, calendar_latency, **kwargs)
+  results = {}
+  for flow in flows:
+    results[flow] = run_flow(make_chatbot, FLOWS[flow], iterations, concurrency)
+    results[flow]["peak_memory_bytes"] = peak_memory(make_chatbot, FLOWS[flow], min(iterations, 10))
+  return results
+
+
+def print_results(results):
+  for flow, result in results.items():
+    turns = result["turns"]
+    print(">>===========================================")
+    print("[{0}] {1} turns, {2} turns/s, p50 {3:.2f} ms, p95 {4:.2f} ms, peak memory {5:.1f} KiB, {6} errors".format(
+      flow, turns["n"], result["throughput"], turns["p50"] * 1000, turns["p95"] * 1000,
+      result["peak_memory_bytes"] / 1024, result["errors"]))
+    for stage, stats in result["stages"].items():
+      print("  {0:<16} {1:>5} calls  p50 {2:8.2f} ms  p95 {3:8.2f} ms".format(
+        stage, stats["n"], stats["p50"] * 1000, stats["p95"] * 1000))
+    for stage, stats in result["prompt_tokens"].items():
+      print("  {0:<16} {1:>8} prompt tokens, {2} cached".format(
+        stage, stats["prompt_tokens"], stats["cached_prompt_tokens"]))
+
+
+def main():
+  arg_parser = argparse.ArgumentParser(description="Benchmark CalendarChatGPT flows without network access.")
+  arg_parser.add_argument("--flows", nargs="+", choices=list(FLOWS), default=list(FLOWS))
+  arg_parser.add_argument("--iterations", type=int, default=50)
+  arg_parser.add_argument("--concurrency", type=int, default=1)
+  arg_parser.add_argument("--events", type=int, default=1000, help="events in the fake calendar")
+  arg_parser.add_argument("--recurring", type=int, default=0, help="recurring series in the fake calendar")
+  arg_parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds per fake LLM call")
+  arg_parser.add_argument("--calendar-latency", type=float, default=0.0, help="seconds per fake Calendar call")
+  arg_parser.add_argument("--summary-mode", default="local", choices=["local", "polish", "llm"])
+  arg_parser.add_argument("--batch-size", type=int, default=1,
+                          help="micro-batch the intent and date prompts of up to this many concurrent turns")
+  arg_parser.add_argument("--batch-wait", type=float, default=0.02,
+                          help="seconds a prompt waits for others to share its call")
+  arg_parser.add_argument("--prompt-cache-min-tokens", type=int, default=1024,
+                          help="shortest prompt prefix the fake OpenAI client reports as cached")
+  arg_parser.add_argument("--startup", type=int, metavar="RUNS",
+                          help="measure import time and time to first response in RUNS fresh interpreters instead")
+  arg_parser.add_argument("--event-formats", action="store_true",
+                          help="compare the memory and prompt tokens of --events events as dicts and as records instead")
+  arg_parser.add_argument("--output", help="also write the results to this JSON file")
+  args = arg_parser.parse_args()
+
+  if args.event_formats:
+    results = {"event_formats": measure_event_formats(args.events)}
+    print_event_formats(results["event_formats"])
+    if args.output:
+      with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    return
+
+  if args.startup:
+    results = {"startup": measure_startup(args.startup)}
+    print_startup(results["startup"])
+    if args.output:
+      with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    return
+
+  batcher = MicroBatcher(args.batch_size, args.batch_wait) if args.batch_size > 1 else None
+  results = run_benchmark(args.flows, args.iterations, args.concurrency, args.events,
+                          args.llm_latency, args.calendar_latency, recurring=args.recurring,
+                          summary_mode=args.summary_mode, prompt_cache_min_tokens=args.prompt_cache_min_tokens,
+                          micro_batcher=batcher)
+  print_results(results)
+  if args.output:
+    with open(args.output, "w", encoding="utf-8") as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+  main()
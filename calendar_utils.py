@@ -1,84 +1,481 @@
 #https://developers.google.com/calendar/api/quickstart/python
 
 import datetime
+import heapq
+import json
 import os.path
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+# The Google client libraries are imported where they are first needed: they
+# take a large share of the start-up time and the fakes don't need them.
+
+import date_utils
+import event_record
+import governor
 
 # If modifying these scopes, delete the file token.json.
 # SCOPES = ["https://www.googleapis.com/auth/calendar.readonly"]
 SCOPES = ['https://www.googleapis.com/auth/calendar']
 
 
-def get_calendar_service():
-  """Gets google calendar api service instance.
+def load_credentials(token_path="token.json", credentials_path="credentials.json"):
+  """Loads the user's credentials, refreshing them or running the login flow if needed.
   """
+  from google.auth.transport.requests import Request
+  from google.oauth2.credentials import Credentials
+  from google_auth_oauthlib.flow import InstalledAppFlow
+
   creds = None
   # The file token.json stores the user's access and refresh tokens, and is
   # created automatically when the authorization flow completes for the first
   # time.
-  if os.path.exists("token.json"):
-    creds = Credentials.from_authorized_user_file("token.json", SCOPES)
+  if os.path.exists(token_path):
+    creds = Credentials.from_authorized_user_file(token_path, SCOPES)
   # If there are no (valid) credentials available, let the user log in.
   if not creds or not creds.valid:
     if creds and creds.expired and creds.refresh_token:
       creds.refresh(Request())
     else:
       flow = InstalledAppFlow.from_client_secrets_file(
-          "credentials.json", SCOPES
+          credentials_path, SCOPES
       )
       creds = flow.run_local_server(port=0)
     # Save the credentials for the next run
-    with open("token.json", "w") as token:
+    with open(token_path, "w") as token:
       token.write(creds.to_json())
+  return creds
+
+
+def token_path(user=None):
+  """token.json for the default user, token_<user>.json for the others.
+  """
+  return "token.json" if user is None else f"token_{user}.json"
+
+
+class ServicePool:
+  """Process-wide Calendar services, one per user and thread.
+
+  Credentials are loaded once per user and refreshed by a background thread
+  `refresh_margin` seconds before they expire. Loading (which may run the
+  interactive login) and refreshing hold a lock of that user only, so one
+  user's login does not hold up the others. The discovery document is the
+  static one bundled with googleapiclient, parsed once; each thread gets its
+  own service on its own httplib2 transport, since httplib2 is not
+  thread-safe.
+  """
+  def __init__(self, token_path_for=token_path, credentials_path="credentials.json",
+               refresh_margin=300, check_interval=60):
+    self.token_path_for = token_path_for
+    self.credentials_path = credentials_path
+    self.refresh_margin = refresh_margin
+    self.check_interval = check_interval
+    self._creds = {}
+    self._lock = threading.Lock()
+    self._user_locks = {}  # user -> lock around loading, refreshing and saving their token
+    self._local = threading.local()
+    self._document = None
+    self._stop = threading.Event()
+    self._refresher = None
+
+  def _user_lock(self, user):
+    with self._lock:
+      return self._user_locks.setdefault(user, threading.Lock())
+
+  def credentials(self, user=None):
+    with self._lock:
+      creds = self._creds.get(user)
+    if creds is not None:
+      return creds
+    with self._user_lock(user):
+      # another thread may have loaded them while this one waited
+      with self._lock:
+        if user in self._creds:
+          return self._creds[user]
+      creds = load_credentials(self.token_path_for(user), self.credentials_path)
+      with self._lock:
+        self._creds[user] = creds
+        self._start_refresher()
+      return creds
+
+  def _discovery_document(self):
+    if self._document is None:
+      from googleapiclient import discovery_cache
+      self._document = json.loads(discovery_cache.get_static_doc("calendar", "v3"))
+    return self._document
+
+  def get(self, user=None):
+    """The calling thread's service for user.
+    """
+    services = getattr(self._local, "services", None)
+    if services is None:
+      services = self._local.services = {}
+    if user not in services:
+      import google_auth_httplib2
+      import httplib2
+      from googleapiclient.discovery import build_from_document
+      http = google_auth_httplib2.AuthorizedHttp(self.credentials(user), http=httplib2.Http())
+      services[user] = build_from_document(self._discovery_document(), http=http)
+    return services[user]
+
+  def warm_up(self, user=None):
+    """Loads the credentials of user, parses the discovery document and
+    builds the calling thread's service, ahead of the first call.
+    """
+    self.credentials(user)
+    self.get(user)
+
+  def service(self, user=None):
+    """A service object usable from any thread, see ThreadLocalService.
+    """
+    self.credentials(user)
+    return ThreadLocalService(self, user)
+
+  def _start_refresher(self):
+    if self._refresher is None:
+      self._refresher = threading.Thread(target=self._refresh_loop, name="calendar-token-refresh", daemon=True)
+      self._refresher.start()
+
+  def refresh_expiring(self):
+    """Refreshes the credentials that expire within refresh_margin seconds.
+    """
+    # credential expiries are naive UTC
+    soon = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) + datetime.timedelta(seconds=self.refresh_margin)
+    with self._lock:
+      users = list(self._creds.items())
+    from google.auth.transport.requests import Request
+    for user, creds in users:
+      if not (creds.refresh_token and (creds.expiry is None or creds.expiry <= soon)):
+        continue
+      with self._user_lock(user):
+        try:
+          creds.refresh(Request())
+        except Exception as error:
+          print(f"An error occurred refreshing the token of {user or 'the default user'}: {error}")
+          continue
+        with open(self.token_path_for(user), "w") as token:
+          token.write(creds.to_json())
+
+  def _refresh_loop(self):
+    while not self._stop.wait(self.check_interval):
+      self.refresh_expiring()
+
+  def close(self):
+    self._stop.set()
+
+
+class ThreadLocalService:
+  """Stands in for a Calendar service and forwards each call to the calling
+  thread's own service from the pool.
+  """
+  def __init__(self, pool, user=None):
+    self.pool = pool
+    self.user = user
+
+  def __getattr__(self, name):
+    return getattr(self.pool.get(self.user), name)
+
 
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+
+def get_service_pool():
+  global _default_pool
+  with _default_pool_lock:
+    if _default_pool is None:
+      _default_pool = ServicePool()
+    return _default_pool
+
+
+def get_calendar_service(user=None):
+  """Gets google calendar api service instance.
+
+  The service comes from the process-wide ServicePool, so the credentials and
+  the discovery document are loaded once however many chatbots are built.
+  """
+  from googleapiclient.errors import HttpError
   try:
-    service = build("calendar", "v3", credentials=creds)
-    return service
+    return get_service_pool().service(user)
   
   except HttpError as error:
     print(f"An error occurred: {error}")
     return None
 
-def get_event_list_recent(service, **kwargs):
+# Event keys used when summarizing the calendar and planning around it;
+# iCalUID identifies an event shared by several calendars
+SUMMARY_EVENT_KEYS = ['summary', 'start', 'end', 'organizer', 'location', 'attendees', 'iCalUID', 'transparency']
+
+
+def _fields_param(fields):
+  """Builds a partial-response `fields` value that keeps the paging keys.
+  `fields` is either a list of event keys or a raw fields string.
+  """
+  if fields is None:
+    return None
+  if not isinstance(fields, str):
+    fields = f"items({','.join(fields)})"
+  for key in ("nextPageToken", "nextSyncToken"):
+    if key not in fields:
+      fields = f"{key},{fields}"
+  return fields
+
+
+def execute(request, calendarId="primary", idempotent=True):
+  """Executes a Calendar API request through the process-wide governor:
+  rate limited per calendar, with retries of rate limits and server errors.
+  Requests that are not idempotent, like inserts, are retried on rate limits only.
+  """
+  return governor.get_governor().call(f"calendar:{calendarId}", request.execute, idempotent=idempotent)
+
+
+def _service_identity(service):
+  # every ThreadLocalService of a pool and user stands for the same account
+  if isinstance(service, ThreadLocalService):
+    return id(service.pool), service.user
+  return id(service)
+
+
+def iter_event_pages(service, calendarId="primary", fields=None, **kwargs):
+  """Yields `events().list` result pages, following nextPageToken.
+  """
+  fields = _fields_param(fields)
+  page_token = None
+  while True:
+    page = execute(
+        service.events()
+        .list(
+            calendarId=calendarId,
+            pageToken=page_token,
+            fields=fields,
+            **kwargs
+        ),
+        calendarId
+    )
+    yield page
+    page_token = page.get("nextPageToken")
+    if not page_token:
+      return
+
+
+def iter_events(service, calendarId="primary", fields=None, **kwargs):
+  """Yields events one by one as each `events().list` page arrives.
   
+  fields: optional list of event keys (e.g. SUMMARY_EVENT_KEYS) or a raw
+  partial-response string, so that only those keys are downloaded.
+  """
+  for page in iter_event_pages(service, calendarId=calendarId, fields=fields, **kwargs):
+    yield from page.get("items", [])
+
+
+def get_event_list_recent(service, **kwargs):
+  """Lists the events of a calendar; HttpErrors are raised.
+  """
   # service = get_calendar_service()
   
   if service:
+    # Call the Calendar API
+    # kwargs e.g. timeMin, timeMax, maxResults, singleEvents, orderBy, fields
+    # identical queries already in flight (e.g. from other sessions) are shared
+    calendarId = kwargs.get("calendarId", "primary")
+    query = (_service_identity(service), repr(sorted(kwargs.items())))
+    events = governor.get_governor().single_flight(
+        f"calendar:{calendarId}", query, lambda: list(iter_events(service, **kwargs)))
+
+    if not events:
+      print("No upcoming events found.")
+      return
+
+    return events
+
+
+def map_calendars(fn, calendarIds, max_workers=8, errors=None):
+  """fn(calendarId) for several calendars in parallel, one result per calendar.
+
+  An HttpError is raised, unless an errors dict is given: then the calendar
+  gets None and its error is recorded in errors under its id.
+  """
+  from googleapiclient.errors import HttpError
+
+  def call(calendarId):
     try:
-      # Call the Calendar API
-      now = datetime.datetime.now(datetime.UTC).isoformat().split('+')[0] + "Z"  # 'Z' indicates UTC time
-      # print(f"Getting the upcoming {n} events")
-      events_result = (
-          service.events()
-          .list(
-              calendarId="primary",
-              # timeMin=now,
-              # maxResults=n,
-              # singleEvents=True,
-              # orderBy="startTime",
-              **kwargs
-          )
-          .execute()
-      )
-      events = events_result.get("items", [])
+      return fn(calendarId)
+    except HttpError as error:
+      if errors is None:
+        raise
+      errors[calendarId] = error
+
+  if len(calendarIds) == 1:
+    return [call(calendarIds[0])]
+  with ThreadPoolExecutor(max_workers=min(max_workers, len(calendarIds))) as executor:
+    return list(executor.map(call, calendarIds))
+
+
+def get_event_lists(service, calendarIds, max_workers=8, errors=None, **kwargs):
+  """Lists the events of several calendars in parallel, one list per calendar.
+
+  errors: see map_calendars; a calendar that could not be listed gets [].
+  """
+  def list_calendar(calendarId):
+    return get_event_list_recent(service, calendarId=calendarId, **kwargs) or []
+
+  return [events or [] for events in map_calendars(list_calendar, calendarIds, max_workers, errors)]
+
+
+def merge_event_records(event_lists, tzinfo=None):
+  """Merges per-calendar event lists into one list of event_record.EventRecords
+  in start time order; each event is parsed once, for both the merge and the
+  flows that use it.
+
+  A k-way merge of the lists sorted by start; an event that appears on
+  several calendars (same iCalUID and start) is kept once.
+  """
+  record_lists = []
+  for event_list in event_lists:
+    records = event_record.from_events(event_list, tzinfo)
+    records.sort(key=lambda record: record.start)
+    record_lists.append(records)
+
+  merged = []
+  seen = set()
+  for record in heapq.merge(*record_lists, key=lambda record: record.start):
+    identity = (record.ical_uid or record.id, record.start)
+    if identity[0] is not None and identity in seen:
+      continue
+    seen.add(identity)
+    merged.append(record)
+  return merged
+
+
+# freebusy queries accept at most 50 calendars each
+MAX_FREEBUSY_CALENDARS = 50
+
+
+class FreeBusyError(Exception):
+  """freebusy could not read a calendar; errors are those the API gave for it.
+  """
+  def __init__(self, calendarId, errors):
+    super().__init__(f"{calendarId}: {errors}")
+    self.calendarId = calendarId
+    self.errors = errors
 
-      if not events:
-        print("No upcoming events found.")
-        return
 
-      # # Prints the start and name of the next 10 events
-      # for event in events:
-      #   start = event["start"].get("dateTime", event["start"].get("date"))
-      #   print(start, event["summary"])
-      return events
+def get_busy_intervals(service, calendarIds, timeMin, timeMax, errors=None):
+  """(start, end) timestamps of the busy time of the calendars, from freebusy.
 
+  Much smaller responses than listing the events when only the busy time
+  matters, as when planning. timeMin/timeMax are RFC3339 strings.
+
+  A calendar that could not be read raises an HttpError or FreeBusyError,
+  unless an errors dict is given: then the error is recorded in it under
+  the calendar's id and the other calendars are still read.
+  """
+  from googleapiclient.errors import HttpError
+  intervals = []
+  for offset in range(0, len(calendarIds), MAX_FREEBUSY_CALENDARS):
+    chunk = calendarIds[offset:offset + MAX_FREEBUSY_CALENDARS]
+    body = {"timeMin": timeMin, "timeMax": timeMax,
+            "items": [{"id": calendarId} for calendarId in chunk]}
+    try:
+      response = execute(service.freebusy().query(body=body), "freebusy")
     except HttpError as error:
-      print(f"An error occurred: {error}")
+      if errors is None:
+        raise
+      errors.update(dict.fromkeys(chunk, error))
+      continue
+    for calendarId, calendar in response.get("calendars", {}).items():
+      if calendar.get("errors"):
+        error = FreeBusyError(calendarId, calendar["errors"])
+        if errors is None:
+          raise error
+        errors[calendarId] = error
+      for busy in calendar.get("busy", []):
+        intervals.append((date_utils.event_time({'dateTime': busy['start']}, None).timestamp(),
+                          date_utils.event_time({'dateTime': busy['end']}, None).timestamp()))
+  return intervals
+
+
+# Google batch requests accept at most 50 calls each
+MAX_BATCH_SIZE = 50
+
+
+def with_event_id(body):
+  """body with a client-generated id, if it has none. An insert of it can
+  be retried safely: once the event exists, inserting it again fails with 409.
+  """
+  if body.get('id'):
+    return body
+  # ids are base32hex (0-9, a-v), 5 to 1024 characters
+  return dict(body, id=uuid.uuid4().hex)
+
+
+def _is_conflict(error):
+  resp = getattr(error, "resp", None)
+  return resp is not None and int(resp.status) == 409
+
+
+def insert_event(service, body, calendarId="primary"):
+  """Inserts one event, retried like a read. An attempt that timed out after
+  the server stored the event makes the retry fail with 409; the stored
+  event is returned then.
+  """
+  from googleapiclient.errors import HttpError
+  body = with_event_id(body)
+  try:
+    return execute(service.events().insert(calendarId=calendarId, body=body), calendarId)
+  except HttpError as error:
+    if not _is_conflict(error):
+      raise
+    return execute(service.events().get(calendarId=calendarId, eventId=body['id']), calendarId)
+
+
+def insert_events(service, bodies, calendarId="primary", max_workers=5):
+  """Inserts several events with as few round trips as possible.
+  
+  Uses the client's batch HTTP request when available, concurrent workers
+  otherwise. Returns a list of (event, error) pairs in the order of bodies;
+  exactly one of the two is None for each item, so a failing item does not
+  affect the others. Each body gets its id before the first attempt, so no
+  retry can add an event twice.
+  """
+  from googleapiclient.errors import HttpError
+  bodies = [with_event_id(body) for body in bodies]
+  results = [(None, None)] * len(bodies)
+  
+  def insert(body):
+    try:
+      return insert_event(service, body, calendarId), None
+    except Exception as error:
+      return None, error
+  
+  if hasattr(service, "new_batch_http_request"):
+    item_failures = set()
+    
+    def callback(request_id, response, exception):
+      results[int(request_id)] = (None, exception) if exception is not None else (response, None)
+      if exception is not None:
+        item_failures.add(int(request_id))
+    
+    for offset in range(0, len(bodies), MAX_BATCH_SIZE):
+      batch = service.new_batch_http_request(callback=callback)
+      for i in range(offset, min(offset + MAX_BATCH_SIZE, len(bodies))):
+        batch.add(service.events().insert(calendarId=calendarId, body=bodies[i]), request_id=str(i))
+      try:
+        execute(batch, calendarId)
+      except HttpError as error:
+        for i in range(offset, min(offset + MAX_BATCH_SIZE, len(bodies))):
+          if results[i] == (None, None):
+            results[i] = (None, error)
+    # items of a batch fail on their own, e.g. when rate limited; retry those one by one.
+    # A 409 is an item stored by an earlier attempt of the batch: fetch it.
+    for i in sorted(item_failures):
+      if _is_conflict(results[i][1]) or governor.is_retryable(results[i][1]):
+        results[i] = insert(bodies[i])
+    return results
+  
+  with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    return list(executor.map(insert, bodies))
 
 
 if __name__ == "__main__":
@@ -1,14 +1,59 @@
 import calendar_utils
+import date_utils
+import event_record
+import governor
+import history_utils
+import json_utils
+import llm_cache
+import prompt_utils
+import render_utils
+import scheduler_utils
+import trace_utils
 import json
 import os
 import ast
+import contextlib
+import contextvars
 import re
 import datetime
-import openai
-from openai import OpenAI
+import threading
+import time
 import dateutil.parser as parser
 
-from ast import literal_eval
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# how many recent (stage, seconds) timings a chatbot keeps in `timings`
+TIMINGS_KEPT = 1000
+
+# list of the (stage, seconds) of the turn being collected, see collect_timings
+_turn_timings = contextvars.ContextVar("turn_timings", default=None)
+
+
+@contextlib.contextmanager
+def collect_timings():
+  """Collects the (stage, seconds) of the LLM and Calendar calls made in the
+  block, including those of the threads and tasks it starts, into the list
+  it yields. Concurrent turns each collect their own.
+  """
+  timings = []
+  token = _turn_timings.set(timings)
+  try:
+    yield timings
+  finally:
+    _turn_timings.reset(token)
+
+
+def _unavailable_note(unavailable):
+  """The line added to a reply made without the events of some calendars.
+  """
+  if not unavailable:
+    return ""
+  return "\n\nThe following calendars could not be read and were left out: " + ", ".join(unavailable)
+
+
+def _lowercase_keys(value):
+  return {key.lower(): item for key, item in value.items()} if isinstance(value, dict) else value
 
 
 class CalendarChatGPT:
@@ -18,328 +63,933 @@ class CalendarChatGPT:
                json_output=False, 
                max_tokens=100,
                calendarId="primary",
-               timezone="Korean Standard Time"):
+               timezone="Korean Standard Time",
+               intent_classifier=None,
+               resolve_dates_locally=True,
+               event_store=None,
+               speculative=False,
+               response_cache=None,
+               history=None,
+               summary_mode="local",
+               local_scheduler=True,
+               client=None,
+               service=None,
+               tracer=None,
+               user=None,
+               calendarIds=None,
+               freebusy_planning=False,
+               json_repairs=1,
+               call_governor=None,
+               prompts=None,
+               micro_batcher=None,
+               warm_up=False):
     
-    openai.api_key = openai_api_key
+    self.openai_api_key = openai_api_key
     self.max_tokens = max_tokens
-    self.messages = []
+    # "local": render the agenda from the fetched events, "polish": also have
+    # the LLM rephrase it, "llm": have the LLM build it from the raw events
+    self.summary_mode = summary_mode
+    # ask the LLM only for subtask names and durations and place them in the
+    # free time of the calendar with scheduler_utils
+    self.local_scheduler = local_scheduler
+    # bounded conversation history; stage prompts are never kept in it
+    self.history = history if history is not None else history_utils.HistoryManager()
+    self.token_counter = history_utils.TokenCounter()
+    # (stage, seconds) of the latest LLM and Calendar calls of all turns;
+    # collect_timings gets those of one turn
+    self.timings = deque(maxlen=TIMINGS_KEPT)
+    # spans of each turn, stage and external call; prompts are debug events
+    self.tracer = tracer if tracer is not None else trace_utils.Tracer()
     self.calendarId = calendarId
+    # calendars read when summarizing and planning; events are added to calendarId
+    self.calendarIds = list(calendarIds) if calendarIds else [calendarId]
+    # plan against freebusy busy times instead of the full event lists
+    self.freebusy_planning = freebusy_planning
     self.timezone = timezone
     
     self.json_output = json_output
+    # JSON replies are validated against json_utils.STAGE_SCHEMAS; an invalid
+    # one is sent back with its errors up to json_repairs times
+    self.json_repairs = json_repairs
+    self.parse_stats = json_utils.ParseStats()
+    # versioned stage prompts: a fixed system message per stage, then the
+    # history, then the user message with the fields of the call
+    self.prompts = prompts if prompts is not None else prompt_utils.PROMPTS
+    # optional local classifier tried before the LLM intent prompt
+    self.intent_classifier = intent_classifier
+    # resolve date phrases with date_utils, asking the LLM only if it cannot
+    self.resolve_dates_locally = resolve_dates_locally
     
-    self.client = OpenAI()
+    # rate limits, retries and the concurrency cap of OpenAI calls; Calendar
+    # calls go through the process-wide governor.get_governor()
+    self.governor = call_governor if call_governor is not None else governor.get_governor()
+    # client/service can be injected, e.g. the stand-ins of fake_backends;
+    # otherwise they are built on first use (or by warm_up), so that neither
+    # importing nor constructing the chatbot loads openai or googleapiclient
+    self._client = client
     self.model = model
-    self.service = calendar_utils.get_calendar_service()
+    # services come from the shared calendar_utils.ServicePool; user picks token_<user>.json
+    self.user = user
+    self._service = service
+    self._lazy_lock = threading.Lock()
+    # optional event_store.EventStore serving summarize queries locally, or a
+    # list of them, one per calendar of calendarIds
+    stores = event_store if isinstance(event_store, (list, tuple)) else [event_store] if event_store else []
+    self.event_stores = {store.calendarId: store for store in stores}
+    missing = [c for c in self.calendarIds if c not in self.event_stores]
+    if self.event_stores and missing:
+      raise ValueError(f"no event store for calendars {missing}; give one per calendar of calendarIds")
+    # the store that events added to calendarId are recorded in
+    self.event_store = self.event_stores.get(calendarId)
+    
+    # optional micro_batcher.MicroBatcher, shared between chatbots, sending
+    # the intent and date prompts of concurrent turns as one call
+    self.micro_batcher = micro_batcher
+    
+    # run intent classification, date detection and the event prefetch at once
+    self.speculative = speculative
+    self._speculation_executor = None
+    self._speculation_lock = threading.Lock()
+    # optional llm_cache.ResponseCache consulted by call() for opted-in stages
+    self.response_cache = response_cache
+    self.speculation_stats = {
+      "runs": 0,
+      "kept": 0,
+      "cancelled": 0,
+      "wasted": 0,
+      "wasted_llm_calls": 0,
+      "wasted_event_fetches": 0,
+      "wasted_seconds": 0.0,
+    }
+    if warm_up:
+      self.warm_up(background=True)
+
+  def _make_client(self):
+    from openai import OpenAI
+    # the governor retries, so the client does not
+    return OpenAI(api_key=self.openai_api_key, max_retries=0)
+
+  @property
+  def client(self):
+    if self._client is None:
+      with self._lazy_lock:
+        if self._client is None:
+          self._client = self._make_client()
+    return self._client
+
+  @client.setter
+  def client(self, client):
+    self._client = client
+
+  @property
+  def service(self):
+    if self._service is None:
+      with self._lazy_lock:
+        if self._service is None:
+          self._service = calendar_utils.get_calendar_service(self.user)
+    return self._service
+
+  @service.setter
+  def service(self, service):
+    self._service = service
+
+  def warm_up(self, background=False):
+    """Builds the OpenAI client and the Calendar service (credentials and
+    discovery document) now rather than on the first message. With
+    background=True this runs on a daemon thread, which is returned; a
+    failure there is left for the first message to report.
+    """
+    if not background:
+      self._warm_up()
+      return None
+    thread = threading.Thread(target=self._warm_up, kwargs={"quiet": True}, name="chatbot-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+  def _warm_up(self, quiet=False):
+    try:
+      with self.tracer.span("warm_up"):
+        self.client
+        service = self.service
+        if isinstance(service, calendar_utils.ThreadLocalService):
+          service.pool.warm_up(service.user)
+    except Exception:
+      if not quiet:
+        raise
+
+  @property
+  def messages(self):
+    return self.history.turns
+
+  def _stage_messages(self, stage, content, history=None, prompt=None):
+    """System message of the stage prompt (of prompt, if it differs from
+    stage), the history relevant to the stage, then the user message.
 
-  def call(self):
+    The system message comes first and does not change between calls, so
+    the provider can serve the start of the request from its prompt cache.
+    """
+    history = history if history is not None else self.history
+    template = self.prompts.get(prompt or stage)
+    system = [template.system_message] if template is not None else []
+    return system + history.context(stage) + [{"role": "user", "content": content}]
+
+  def _record_timing(self, stage, started):
+    timing = (stage, time.perf_counter() - started)
+    self.timings.append(timing)
+    turn_timings = _turn_timings.get()
+    if turn_timings is not None:
+      turn_timings.append(timing)
+
+  def _record_tokens(self, stage, messages, usage, content, span):
+    tokens = self.token_counter.record(stage, messages, usage)
+    template = self.prompts.template_of(messages)
+    if template is not None:
+      span.set(prompt=template.label, static_prompt_tokens=template.static_tokens)
+    span.set(estimated_prompt_tokens=tokens,
+             prompt_tokens=getattr(usage, "prompt_tokens", None),
+             cached_tokens=history_utils.cached_tokens(usage),
+             completion_tokens=getattr(usage, "completion_tokens", None),
+             response_chars=len(content or ""))
+
+  def _cache_key(self, messages, stage, json_mode=False, max_tokens=None):
+    """The response cache key of messages, or None if stage is not cached.
+    """
+    if self.response_cache is None or not self.response_cache.enabled_for(stage):
+      return None
+    response_format = { "type": "json_object" } if self.json_output or json_mode else None
+    return llm_cache.cache_key(self.model, response_format, max_tokens or self.max_tokens, messages)
+
+  def _cached_response(self, messages, stage, json_mode=False, max_tokens=None):
+    """Returns (cache key, cached response); the key is None if stage is not cached.
+    """
+    key = self._cache_key(messages, stage, json_mode, max_tokens)
+    if key is None:
+      return None, None
+    return key, self.response_cache.get(stage, key)
+
+  def _cache_response(self, messages, stage, response):
+    key = self._cache_key(messages, stage)
+    if key is not None:
+      self.response_cache.put(stage, key, response)
+
+  def _load_json(self, stage, message, transform=None):
+    """Extracts the JSON reply of a stage and validates it against its schema.
+    Raises json_utils.JSONParseError.
+    """
+    try:
+      value = json_utils.extract_json(message)
+      if transform is not None:
+        value = transform(value)
+      errors = json_utils.validate(value, json_utils.STAGE_SCHEMAS.get(stage))
+      if errors:
+        raise json_utils.JSONParseError(errors)
+    except json_utils.JSONParseError as e:
+      self.parse_stats.record(stage, attempts=1, failures=1)
+      self.tracer.debug("parse_failure", stage=stage, errors=e.errors)
+      raise
+    self.parse_stats.record(stage, attempts=1)
+    return value
+
+  def _repair_messages(self, messages, message, error):
+    return messages + [
+      {"role": "assistant", "content": message or ""},
+      {"role": "user", "content": "Your reply could not be used: " + "; ".join(error.errors) +
+                                  ". Reply with only the corrected JSON."},
+    ]
+
+  def _ask_json(self, stage, content, parse):
+    """Sends the stage prompt and returns parse(reply). If parse raises
+    JSONParseError, asks for a corrected reply naming the errors, up to
+    json_repairs times.
+    """
+    messages = self._stage_messages(stage, content)
+    # the reply is cached only once it parses, or an invalid one would be served again
+    response = self.call(messages, stage=stage, cache=False)
+    message = response.choices[0].message.content
+    for repair in range(self.json_repairs + 1):
+      try:
+        result = parse(message)
+      except json_utils.JSONParseError as e:
+        if repair == self.json_repairs:
+          raise
+        self.parse_stats.record(stage, repairs=1)
+        messages = self._repair_messages(messages, message, e)
+        # "<stage>_repair" is never a cached stage: the same invalid reply would come back
+        message = self.call(messages, stage=stage + "_repair").choices[0].message.content
+        continue
+      if repair:
+        self.parse_stats.record(stage, repaired=1)
+      else:
+        self._cache_response(messages, stage, response)
+      return result
+
+  def _governor_key(self):
+    return f"openai:{self.model}"
+
+  def call(self, messages=None, stage=None, json_mode=False, max_tokens=None, cache=True):
+    """Sends messages to the model; json_mode asks for a JSON reply even if
+    json_output is off, and max_tokens overrides the chatbot's reply limit.
+    cache=False still serves cached replies but leaves adding the reply to
+    the caller, e.g. once it is validated.
+    """
+    if messages is None:
+      messages = self.history.context("chat")
+    
+    with self.tracer.span("llm", stage=stage, request_chars=trace_utils.payload_chars(messages)) as span:
+      started = time.perf_counter()
+      key, response = self._cached_response(messages, stage, json_mode, max_tokens)
+      span.set(cache_hit=response is not None)
+      if response is not None:
+        self._record_timing(stage, started)
+        return response
+      
+      if self.json_output or json_mode:
+        response = self.governor.call(
+          self._governor_key(), self.client.chat.completions.create, idempotent=False,
+          model=self.model,
+          response_format={ "type": "json_object" }, 
+          messages=messages,
+          max_tokens=max_tokens or self.max_tokens
+        )
+      else:
+        response = self.governor.call(
+          self._governor_key(), self.client.chat.completions.create, idempotent=False,
+          model=self.model,
+          messages=messages,
+          max_tokens=max_tokens or self.max_tokens
+        )
+      if key is not None and cache:
+        self.response_cache.put(stage, key, response)
+      self._record_tokens(stage, messages, getattr(response, "usage", None),
+                          response.choices[0].message.content, span)
+      self._record_timing(stage, started)
+      return response
+
+  def _stream_kwargs(self):
+    kwargs = dict(stream=True, stream_options={"include_usage": True})
     if self.json_output:
-      response = self.client.chat.completions.create(
-        model=self.model,
-        response_format={ "type": "json_object" }, 
-        messages=self.messages,
-        max_tokens=self.max_tokens
-      )
-    else:
-      response = self.client.chat.completions.create(
+      kwargs["response_format"] = { "type": "json_object" }
+    return kwargs
+
+  def stream(self, messages, stage=None):
+    """Like call, but yields the reply text in pieces as they are generated.
+    Streamed replies are served from the response cache but not added to it.
+    """
+    span = self.tracer.start_span("llm", stage=stage, stream=True,
+                                  request_chars=trace_utils.payload_chars(messages))
+    error = None
+    try:
+      started = time.perf_counter()
+      key, response = self._cached_response(messages, stage)
+      span.set(cache_hit=response is not None)
+      if response is not None:
+        self._record_timing(stage, started)
+        yield response.choices[0].message.content
+        return
+
+      # only opening the stream is retried, not a stream broken midway
+      chunks = self.governor.call(
+        self._governor_key(), self.client.chat.completions.create, idempotent=False,
         model=self.model,
-        messages=self.messages,
-        max_tokens=self.max_tokens
+        messages=messages,
+        max_tokens=self.max_tokens,
+        **self._stream_kwargs()
       )
-    return response
+      parts = []
+      usage = None
+      for chunk in chunks:
+        if getattr(chunk, "usage", None) is not None:
+          usage = chunk.usage
+        if chunk.choices and chunk.choices[0].delta.content:
+          if not parts:
+            span.set(first_token_ms=round((time.perf_counter() - started) * 1000, 3))
+          parts.append(chunk.choices[0].delta.content)
+          yield chunk.choices[0].delta.content
+      self._record_tokens(stage, messages, usage, "".join(parts), span)
+      self._record_timing(stage, started)
+    except BaseException as e:
+      error = type(e).__name__
+      raise
+    finally:
+      self.tracer.end_span(span, error)
   
-  def _prompt_intent(self, text):
-    
+  def _intent_prompt(self, text):
     # Call ChatGPT for intent classification
-    user_prompt = (
-        f"{text}\n\nDo not respond yet. Classify user intention as one of 1, 2, 3. The meaning of the indices are as follows."
-        "(1) Summarize events in the calendar. (2) Add an event to the calender. (3) Plan tasks and add multiple events to the calendar."
-        "If none, just say nothing.\n"
-        "Examples of (1): \n"
-        "I want to see a list of schedule for today.\n"
-        "What's my schedule on 12/24/2023?\n"
-        "Examples of (2): \n"
-        "Can you add a meeting with my ConvAI teammates this Friday at 4PM?. The location is Building 942 Room 308.\n"
-        "I have a meeting with Selena Gomez tomorrow at 2PM. Please create a schedule.\n"
-        "Examples of (3): \n"
-        "I have a conference talk next Thursday. Can you plan what I should do to prepare for it?\n"
-        "I have a computing 2 homework due on 11/30. Create a study schedule for me.\n"
-        "Can you help me plan for a paper submission due 12/1?\n"
-    )
-    
-    print(">>===========================================")
-    print("[Prompt for Intent Classification]")
-    print(user_prompt + "\n")
+    return self.prompts.render("intent", text=text)
 
-    # Update the messages
-    self.messages.append({
-        "role": "user",
-        "content": user_prompt,
-    })
+  def _local_intent(self, text):
+    """Returns the intent from the local classifier, or None if the LLM should be asked.
+    """
+    if self.intent_classifier is None:
+      return None
+    intent, confidence = self.intent_classifier.classify(text)
+    self.tracer.debug("local_intent", intent=intent, confidence=round(confidence, 3))
+    return intent
 
-    # Call ChatGPT
-    response = self.call()
-    
-    # Remove the last message
-    self.messages.pop()
+  def _prompt_intent(self, text):
+    """The intent reply of the LLM for text.
+    """
+    with self.tracer.span("stage.intent") as span:
+      intent = self._batched("intent", text)
+      span.set(batched=intent is not None)
+      if intent is not None:
+        return intent
+
+      user_prompt = self._intent_prompt(text)
+      self.tracer.debug("prompt", stage="intent", text=user_prompt)
+
+      # Call ChatGPT
+      response = self.call(self._stage_messages("intent", user_prompt), stage="intent")
 
-    return response
+      return response.choices[0].message.content
   
   
-  def _prompt_add_calendar(self, text):
-    # Call ChatGPT for intent classification
-    user_prompt = (
-        f"{text}\n\nDo not respond yet."
-        """You are a sophisticated calendar management assistant, 
-adept at organizing and managing calendar schedules for both simple and complex tasks. 
-Your role involves integrating tasks into a user's calendar with precision and 
-ensuring that all details are accurately reflected.
-
-For a task like "add meeting with Ryan Gosling tomorrow at 9 PM," 
-Output a json that can be used as a calendar create request. 
-Follow the below format. Only return the json.
-
-Example
-Input: "Today is 2023/11/22. Add an event about dance in the moon light at LaLa Land with Ryan Gosling (ryangosling@example.com). 
-It will take place next Tuesday from 9 am to 5 pm LA times." 
-Output:
-{
-  "summary": "Dancing in the moonlight",
-  "location": "LaLa Land",
-  "description": "I plan to dance with Ryan Gosling in the yellow dress.",
-  "startTime": "2023-11-28T09:00:00-07:00",
-  "endTime": "2023-11-28T17:00:00-07:00",
-  "timeZone": "America/Los_Angeles",
-  "attendeesEmail": ["ryangosling@example.com"]
-}
-"""
-f"\nThe timezone is {self.timezone}"""
-f"\nToday is {datetime.datetime.today().date()}"
-    )
-    
-    print(">>===========================================")
-    print("[Prompt for Adding Calendar]")
-    print(user_prompt + "\n")
-
-    # Update the messages
-    self.messages.append({
-        "role": "user",
-        "content": user_prompt,
-    })
+  def _add_calendar_prompt(self, text):
+    return self.prompts.render("add_calendar", text=text, timezone=self.timezone,
+                               today=date_utils.today_in(self.timezone).isoformat())
 
-    # Call ChatGPT
+  def _parse_add_calendar(self, message):
+    message_json = self._load_json("add_calendar", message)
     
-    response = self.call()
-    
-    try:
-      message = response.choices[0].message.content
-      
-      # some cleansing if needed
-      if 'json' in message:
-        message = re.findall(r"(?<=```json)[\S\s]*(?=```)", message)[0]
-        message = message.strip()
-      
-      # reformat json
-      message_json = json.loads(message)
-      
-      message_json['start'] = dict(dateTime=message_json['startTime'],
-                                   timeZone=message_json['timeZone'])
-      message_json['end'] = dict(dateTime=message_json['endTime'],
+    # reformat json
+    message_json['start'] = dict(dateTime=message_json['startTime'],
                                  timeZone=message_json['timeZone'])
-      message_json['attendees'] = dict(emails=message_json['attendeesEmail'])
-      
-      del message_json['startTime']
-      del message_json['endTime']
-      del message_json['timeZone']
-      del message_json['attendeesEmail']
-      
-      print(">>===========================================")
-      print("Adding the event to the calendar...")
-      event = self.service.events().insert(calendarId=self.calendarId, body=message_json).execute()
-      
-      return 'Event created: %s' % (event.get('htmlLink'))
+    message_json['end'] = dict(dateTime=message_json['endTime'],
+                               timeZone=message_json['timeZone'])
+    message_json['attendees'] = [dict(email=email) for email in message_json.pop('attendeesEmail', [])]
     
-    except:
-      print("Error occurred! ")
+    del message_json['startTime']
+    del message_json['endTime']
+    del message_json['timeZone']
+    return message_json
+
+  def _insert_event(self, body):
+    with self.tracer.span("calendar.insert", events=1):
+      started = time.perf_counter()
+      event = calendar_utils.insert_event(self.service, body, calendarId=self.calendarId)
+      self._record_timing("calendar_insert", started)
+    if self.event_store is not None:
+      self.event_store.add_event(event)
+    return event
+
+  def _prompt_add_calendar(self, text):
+    with self.tracer.span("stage.add_calendar") as span:
+      user_prompt = self._add_calendar_prompt(text)
+      self.tracer.debug("prompt", stage="add_calendar", text=user_prompt)
+
+      try:
+        # Call ChatGPT
+        message_json = self._ask_json("add_calendar", user_prompt, self._parse_add_calendar)
+        event = self._insert_event(message_json)
+        
+        return 'Event created: %s' % (event.get('htmlLink'))
       
+      except Exception as e:
+        span.set(failure=f"{type(e).__name__}: {e}")
+        
+        return None
+
+
+  def _local_date(self, text):
+    """Returns (date_expression, date_min, date_max) from date_utils, or None.
+    """
+    if not self.resolve_dates_locally:
       return None
+    resolved = date_utils.resolve_date_expression(text, timezone=self.timezone)
+    if resolved is not None:
+      self.tracer.debug("detected_date", source="local", phrase=resolved[0], date=resolved[1])
+    return resolved
 
+  def _detect_date_prompt(self, text):
+    return self.prompts.render("detect_date", text=text, today=date_utils.today_in(self.timezone).isoformat())
 
-  def _prompt_detect_date(self, text):
-    user_prompt = ("""Do not respond yet. """
-"""Detect any time-related phrase from the given input from the user and resolve it into a date in the format of YYYY/MM/DD and the date after that day YYYY/MM/DD+1day.
-Examples include today, tomorrow, this Wednesday, next Tuesday, last Friday, 11/13, November 5th, 13th of July.
-When the detected word is day of week, make sure to include adjective in front of it such as "this", "next", "upcoming", "last", "past".
-\n\n
-Your output must be in JSON format. {"detected_phrase": <detected phrase>, "date": <YYYY/MM/DD>, "date_after_date": <YYYY/MM/DD>}
-\n\n
-Example 1
-Input: Today is 2023/1/2. ... I want to schedule a meeting at 5PM tomorrow.
-Output: {"detected_phrase": "tomorrow", "date": "2023/1/3", "date_after_date": "2023/1/4"}
-
-Example 2
-Input: Today is 2023/1/2. ... What time does the class start next Friday?
-Output: {"detected_phrase": "next Friday", "date": "2023/1/13", "date_after_date": "2023/1/14"}
-
-Example 3
-Input: Today is 2023/1/2. ... What is the date of this upcoming Friday?
-Output: {"detected_phrase": "this upcoming Friday", "date": "2023/1/6", "date_after_date": "2023/1/7"}
-"""
-f"\n\nInput: Today is {datetime.datetime.today().date()}. ... {text}")
-    self.messages.append({
-        "role": "user",
-        "content": user_prompt,
-    })
-
-    print(">>===========================================")
-    print("[Prompt for detecting date-related expression]")
-    print(user_prompt)
-      
-    # Call ChatGPT
-    response = self.call()
-    message = response.choices[0].message.content
-    
-    # some cleansing if needed
-    if 'json' in message:
-      message = re.findall(r"(?<=```json)[\S\s]*(?=```)", message)[0]
-      message = message.strip()
-      
-    init_result = json.loads(message)
+  def _parse_detect_date(self, message):
+    init_result = self._load_json("detect_date", message)
     
     date_expression = init_result['detected_phrase'] # detected_phrase
     date_min = init_result['date'] #date
     date_max = init_result['date_after_date'] #date+1
     
-    print("[Detected date]")
-    print(date_expression, date_min)
+    self.tracer.debug("detected_date", source="llm", phrase=date_expression, date=date_min)
       
     return date_expression, date_min, date_max
 
+  def _prompt_detect_date(self, text):
+    with self.tracer.span("stage.detect_date") as span:
+      resolved = self._local_date(text)
+      span.set(local=resolved is not None)
+      if resolved is not None:
+        return resolved
 
-  def _prompt_summarize_calendar(self, text):
-    
-    date_expression, date_min, date_max = self._prompt_detect_date(text)
-    
-    date_min = parser.parse(date_min)
-    date_min = date_min.isoformat().split('+')[0] + "Z"
-    date_max = parser.parse(date_max)
-    date_max = date_max.isoformat().split('+')[0] + "Z"
-
-    print(">>===========================================")
-    print("Sending request to Google Calendar API...")
-    event_list = calendar_utils.get_event_list_recent(self.service, timeMin=date_min, timeMax=date_max)
-    
-    # only take the necessary keys in the fetched event info
-    event_list_new = []
-    keys_to_extract = ['summary', 'start', 'organizer', 'end', 'location', 'attendees', ]
-    for event in event_list:
-        event_dict = {}
-        for k in keys_to_extract:
-            try:
-                if k == 'start' or k == 'end':
-                    event_dict[k] = event[k]
-                    event_dict[k]['dateTime'] = event_dict[k]['dateTime'].replace(event_dict[k]['dateTime'][:10], date_min)
-                else:
-                    event_dict[k] = event[k]
-            except KeyError:
-                event_dict[k] = ''
-        event_list_new.append(event_dict)
+      return self._llm_date(text)
 
-    # prompt chatgpt to rephrase the schedule in natural language
-    input_text = f''' You are a sophisticated calendar management assistant, adapt at organizing and managing calendar schedules for both simple and complex tasks.\
+  def _llm_date(self, text):
+    resolved = self._batched("detect_date", text)
+    if resolved is not None:
+      return resolved
 
-    For a given day, check the user's Calendar input which is given as list of python dictionaries and output the agenda for the day in markdown using relevant emojis as bullet points. \
-    Your output must be in this format. Json("date": <YYYY/MM/DD>, "schedule": <schedule>, "start_time":<HH:MM>, "Location": <location>, "Participants":<participants>)
-    Here's an example:\
+    user_prompt = self._detect_date_prompt(text)
+    self.tracer.debug("prompt", stage="detect_date", text=user_prompt)
+      
+    # Call ChatGPT
+    return self._ask_json("detect_date", user_prompt, self._parse_detect_date)
 
-    Example 1
-    Input: The given date is 2023-11-21. Which schedule do I have on the given day?\
-    Output: Schedule is Check-in at HyattRegency Seattle, Start time ⏰ is After 4:00 PM, Location is Hyatt Regency, Seattle, Participants are\
-    Sheryl Soo(sheryl@zapier.com), Mike Knoop (Knoop@zapier.com) and Going to Tacoma airport, Start time ⏰ is After 7:00 PM, Location is Seattle Tacoma International Airport\
+  def _batch_key(self, stage):
+    # replies depend on the model and, for dates, on today in the time zone
+    return (stage, self.model, self.timezone)
 
-    Example 2
-    Input: The given date is 2023-11-03. Which schedule do I have on the given day?\
-    Output: Schedule is Watching soccer game, Start time ⏰ is After 1:00 AM
+  def _batch_messages(self, stage, texts):
+    template = self.prompts.get(stage + "_batch")
+    items = json.dumps([{"id": i, "text": text} for i, text in enumerate(texts)], ensure_ascii=False)
+    content = template.render(items=items, today=date_utils.today_in(self.timezone).isoformat())
+    # the utterances come from different conversations: no history
+    return [template.system_message, {"role": "user", "content": content}]
 
-    Calendar input: {event_list_new}\
-    \n\nInput: The given date is {date_min[:10]}. {text}
-    \n\nOutput: \
-    '''
+  def _batch_answers(self, stage, message, n):
+    """Answers of a batch reply by item; None for the items it has no valid answer for.
+    """
+    answers = [None] * n
+    for result in self._load_json(stage + "_batch", message)["results"]:
+      if not 0 <= result["id"] < n:
+        continue
+      if stage == "intent":
+        answers[result["id"]] = str(result.get("intent") or "")
+        continue
+      try:
+        answers[result["id"]] = self._parse_detect_date(json.dumps(result))
+      except json_utils.JSONParseError:
+        continue
+    return answers
 
-    self.messages.append({
-        "role": "user",
-        "content": input_text,
-    })
+  def _ask_batch(self, stage, texts):
+    with self.tracer.span("llm_batch", stage=stage, items=len(texts)):
+      messages = self._batch_messages(stage, texts)
+      # one reply answers every item, so it gets the room of all of them
+      message = self.call(messages, stage=stage + "_batch", json_mode=True,
+                          max_tokens=self.max_tokens * len(texts)).choices[0].message.content
+      return self._batch_answers(stage, message, len(texts))
 
-    # Call ChatGPT
-    response = self.call()
-    message = response.choices[0].message.content
-    
+  def _batched(self, stage, text):
+    """The reply to text from a batched prompt of stage, or None if text
+    should be sent alone.
+    """
+    if self.micro_batcher is None or self.history.context(stage):
+      # a stage that sees the history cannot share a call with other conversations
+      return None
+    return self.micro_batcher.submit(self._batch_key(stage), text,
+                                     lambda texts: self._ask_batch(stage, texts))
+
+
+  def _summary_time_range(self, date_min, date_max):
+    # the days start at midnight where the user is, not in UTC
+    tzinfo = date_utils.get_tzinfo(self.timezone)
+    date_min = datetime.datetime.combine(parser.parse(date_min).date(), datetime.time(0), tzinfo=tzinfo).isoformat()
+    date_max = datetime.datetime.combine(parser.parse(date_max).date(), datetime.time(0), tzinfo=tzinfo).isoformat()
+    return date_min, date_max
+
+  def _unavailable_calendars(self, errors):
+    for calendarId, error in errors.items():
+      self.tracer.debug("calendar_unavailable", calendar=calendarId, error=str(error))
+    return sorted(errors)
+
+  def _fetch_events(self, date_min, date_max):
+    """(event_list, unavailable): the events of the calendars between
+    date_min and date_max, and the ids of the calendars that could not be read.
+    """
+    source = "store" if self.event_stores else "api"
+    with self.tracer.span("calendar.list", source=source) as span:
+      started = time.perf_counter()
+      errors = {}
+      if self.event_stores:
+        event_lists = calendar_utils.map_calendars(
+            lambda calendarId: self.event_stores[calendarId].query(timeMin=date_min, timeMax=date_max),
+            self.calendarIds, errors=errors)
+        event_lists = [events or [] for events in event_lists]
+      else:
+        event_lists = calendar_utils.get_event_lists(self.service, self.calendarIds, timeMin=date_min, timeMax=date_max,
+                                                     singleEvents=True, orderBy="startTime",
+                                                     fields=calendar_utils.SUMMARY_EVENT_KEYS, errors=errors)
+      # the flows get compact event_record.EventRecords, not the API's dicts
+      event_list = calendar_utils.merge_event_records(event_lists, date_utils.get_tzinfo(self.timezone))
+      self._record_timing("calendar_list", started)
+      span.set(events=len(event_list), calendars=len(self.calendarIds), unavailable=len(errors))
+      if self.tracer.enabled:
+        span.set(payload_bytes=len(json.dumps(event_lists, default=str)))
+      return event_list, self._unavailable_calendars(errors)
+
+  def _summarize_prompt(self, text, event_list, date_min):
+    # one dense line per event rather than the event dicts
+    tzinfo = date_utils.get_tzinfo(self.timezone)
+    events = event_record.serialize(event_record.from_events(event_list, tzinfo), tzinfo)
+
+    # prompt chatgpt to rephrase the schedule in natural language
+    return self.prompts.render("summarize", events=events, date=date_min[:10], text=text)
+
+  def _render_summary(self, message, date_expression, date_min):
     # Post-processing JSON file
-    message_dict = message.replace(' ', '')
-    message_dict = message_dict.replace("true", "'true'")
-    
-    if 'json' in message_dict:
-      message_dict = re.findall(r"(?<=```json)[\S\s]*(?=```)", message_dict)[0]
-      message_dict = message_dict.strip()    
-    
-    message_dict = literal_eval(message_dict)
+    message_dict = self._load_json("summarize", message)
 
     output_string = ''
     output_string +="You have total {0} schedules for {1}, {2}.\n".format(len(message_dict['schedule']), date_expression, date_min[:10])
     for i in range(len(message_dict['schedule'])):
-        output_string+= "schedule {0} is {1}. Start time ⏰ is {2}. ".format(i, message_dict['schedule'][i]['summary'], message_dict['schedule'][i]['start_time'])
-        if message_dict['schedule'][i]['Location'] != '':
+        output_string+= "schedule {0} is {1}. Start time ⏰ is {2}. ".format(i, message_dict['schedule'][i]['summary'], message_dict['schedule'][i].get('start_time', ''))
+        if message_dict['schedule'][i].get('Location', '') != '':
             output_string+="Location is {0}. ".format(message_dict['schedule'][i]['Location'])
-        if message_dict['schedule'][i]['Participants'] != '' :
+        if message_dict['schedule'][i].get('Participants', '') != '' :
             output_string+="Participants are "
-            for p in range(len(message_dict['schedule'][i]['Participants'])):
-                if p == len(message_dict['schedule'][i]['Participants'])-1:
-                    output_string+="and {0}. ".format(message_dict['schedule'][i]['Participants'][p]['email'])
+            # participants come back as the "Name (email)" strings of the calendar input
+            participants = [p if isinstance(p, str) else p.get('email', '') for p in message_dict['schedule'][i]['Participants']]
+            for p in range(len(participants)):
+                if p == len(participants)-1:
+                    output_string+="and {0}. ".format(participants[p])
                 else:
-                    output_string+="{0}, ".format(message_dict['schedule'][i]['Participants'][p]['email'])
+                    output_string+="{0}, ".format(participants[p])
                 
         output_string+='\n'
         
     return output_string
-  
-  def _prompt_plan_and_add_calendar(self, text):
-    
-    formatted_string = self.analysis_dialogue_gpt_call(text)
-    
-    message_json = self.create_schedule_dialogue_gpt_call(formatted_string)
+
+  def _prompt_summarize_calendar(self, text):
+    with self.tracer.span("stage.summarize", mode=self.summary_mode):
+      date_expression, date_min, date_max = self._prompt_detect_date(text)
+      date_min, date_max = self._summary_time_range(date_min, date_max)
+      event_list, unavailable = self._fetch_events(date_min, date_max)
+      return self._summarize_events(text, date_expression, date_min, event_list, unavailable)
+
+  def _polish_prompt(self, text, agenda):
+    return self.prompts.render("polish", text=text, agenda=agenda)
+
+  def _summarize_events(self, text, date_expression, date_min, event_list, unavailable=()):
+    if self.summary_mode == "llm":
+      input_text = self._summarize_prompt(text, event_list, date_min)
+
+      # Call ChatGPT
+      summary = self._ask_json("summarize", input_text,
+                               lambda message: self._render_summary(message, date_expression, date_min))
+      return summary + _unavailable_note(unavailable)
     
-    # some cleansing if needed
-    message_json = message_json["Tasks"]
+    agenda = render_utils.render_agenda(event_list, date_expression, date_min, timezone=self.timezone)
+    if self.summary_mode != "polish":
+      return agenda + _unavailable_note(unavailable)
     
-    # reformat json
+    response = self.call(self._stage_messages("summarize", self._polish_prompt(text, agenda), prompt="polish"),
+                         stage="summarize")
+    return response.choices[0].message.content + _unavailable_note(unavailable)
+  
+  def _plan_bodies(self, message_json):
+    # reformat json, setting aside tasks the LLM left incomplete
     reformat_message_json = []
-    for old_json in message_json:
-      new_json = {}
-      new_json['summary'] = old_json['Task']
-      new_json['start'] = dict(dateTime=old_json['Start Time'],
+    task_indices = []
+    failed = []
+    for i, old_json in enumerate(message_json):
+      try:
+        new_json = {}
+        new_json['summary'] = old_json['Task']
+        new_json['start'] = dict(dateTime=old_json['Start Time'],
+                                 timeZone=old_json['timeZone'])
+        new_json['end'] = dict(dateTime=old_json['End Time'],
                                timeZone=old_json['timeZone'])
-      new_json['end'] = dict(dateTime=old_json['End Time'],
-                             timeZone=old_json['timeZone'])
+      except KeyError as error:
+        self.tracer.debug("plan_task_invalid", task=i, missing=str(error))
+        old_json['Error'] = f"missing {error}"
+        failed.append(old_json.get('Task', str(i)))
+        continue
       reformat_message_json.append(new_json)
+      task_indices.append(i)
+    return reformat_message_json, task_indices, failed
 
-    print(">>===========================================")
-    print("Adding events to the calender...")
-    for i, schedule in enumerate(reformat_message_json):
-      print(f"{i}th event done")
-      event = self.service.events().insert(calendarId=self.calendarId, body=schedule).execute()
+  def _insert_events(self, bodies):
+    with self.tracer.span("calendar.insert", events=len(bodies)) as span:
+      started = time.perf_counter()
+      results = calendar_utils.insert_events(self.service, bodies, calendarId=self.calendarId)
+      self._record_timing("calendar_insert", started)
+      span.set(failed=sum(error is not None for _, error in results))
+      return results
+
+  def _plan_output(self, message_json, task_indices, results, failed):
+    for i, (event, error) in zip(task_indices, results):
+      if error is not None:
+        self.tracer.debug("plan_task_failed", task=i, error=str(error))
+        message_json[i]['Error'] = str(error)
+        failed.append(message_json[i]['Task'])
+        continue
       message_json[i]['URL'] = event.get('htmlLink')
+      if self.event_store is not None:
+        self.event_store.add_event(event)
+    
+    output = "I made a plan as following and added them to your schedule\n\n" + json.dumps(message_json, indent=4)
+    if failed:
+      output += "\n\nThe following tasks could not be added: " + ", ".join(failed)
+    return output
+
+  def _plan_window(self, formatted_string):
+    """(start, deadline) of the plan: from now until the end of the target day.
+    """
+    tzinfo = date_utils.get_tzinfo(self.timezone)
+    now = datetime.datetime.now(tzinfo)
+    # start at the next half hour
+    start = (now + datetime.timedelta(minutes=29)).replace(second=0, microsecond=0)
+    start = start.replace(minute=0 if start.minute < 30 else 30)
+    
+    deadline = None
+    target_time = re.search(r"Target Time: (.*?),?\n", formatted_string)
+    if target_time:
+      resolved = date_utils.resolve_date_expression(target_time.group(1), timezone=self.timezone)
+      if resolved is not None:
+        deadline = parser.parse(resolved[2]).replace(tzinfo=tzinfo)
+    if deadline is None or deadline <= start:
+      deadline = datetime.datetime.combine(start.date() + datetime.timedelta(days=7), datetime.time(0), tzinfo=tzinfo)
+    return start, deadline
+
+  def _fetch_busy(self, start, deadline):
+    """Busy time of the calendars between start and deadline, as
+    (event_list, busy intervals) for _schedule_locally, and the ids of the
+    calendars that could not be read.
+    """
+    if not self.freebusy_planning:
+      event_list, unavailable = self._fetch_events(start.isoformat(), deadline.isoformat())
+      return event_list, [], unavailable
+    with self.tracer.span("calendar.freebusy", calendars=len(self.calendarIds)) as span:
+      started = time.perf_counter()
+      errors = {}
+      busy = calendar_utils.get_busy_intervals(self.service, self.calendarIds, start.isoformat(), deadline.isoformat(),
+                                               errors=errors)
+      self._record_timing("calendar_freebusy", started)
+      span.set(intervals=len(busy), unavailable=len(errors))
+      return [], busy, self._unavailable_calendars(errors)
+
+  def _schedule_locally(self, subtasks, start, deadline, event_list, busy=()):
+    tzinfo = date_utils.get_tzinfo(self.timezone)
+    timezone_name = date_utils.WINDOWS_TIMEZONES.get(self.timezone, self.timezone)
+    scheduled, unscheduled = scheduler_utils.schedule_tasks(
+        subtasks, event_list, start, deadline, tzinfo, timezone_name, busy=busy)
+    for task in unscheduled:
+      task['Error'] = "no free time before the deadline"
+    return scheduled, unscheduled
+
+  def _prompt_plan_and_add_calendar(self, text):
+    with self.tracer.span("stage.plan", local_scheduler=self.local_scheduler) as span:
+      formatted_string = self.analysis_dialogue_gpt_call(text)
       
-    return "I made a plan as following and added them to your schedule\n\n" + json.dumps(message_json, indent=4)
+      unscheduled = []
+      unavailable = []
+      if self.local_scheduler:
+        subtasks = self.create_subtasks_gpt_call(formatted_string)
+        start, deadline = self._plan_window(formatted_string)
+        event_list, busy, unavailable = self._fetch_busy(start, deadline)
+        message_json, unscheduled = self._schedule_locally(subtasks, start, deadline, event_list, busy)
+      else:
+        message_json = self.create_schedule_dialogue_gpt_call(formatted_string)
+        
+        # some cleansing if needed
+        message_json = message_json["Tasks"]
+      
+      bodies, task_indices, failed = self._plan_bodies(message_json)
+      results = self._insert_events(bodies)
+      message_json += unscheduled
+      failed += [task['Task'] for task in unscheduled]
+      span.set(tasks=len(message_json), failed=len(failed))
+      return self._plan_output(message_json, task_indices, results, failed) + _unavailable_note(unavailable)
+
+  def _speculate_summary_inputs(self, text):
+    """Date detection and event prefetch for the summarize path, run before
+    the intent is known.
+    """
+    started = time.perf_counter()
+    llm_calls = 0
+    resolved = self._local_date(text)
+    if resolved is None:
+      resolved = self._llm_date(text)
+      llm_calls = 1
+    date_min, date_max = self._summary_time_range(resolved[1], resolved[2])
+    event_list, unavailable = self._fetch_events(date_min, date_max)
+    return dict(date_expression=resolved[0], date_min=date_min, event_list=event_list, unavailable=unavailable,
+                llm_calls=llm_calls, seconds=time.perf_counter() - started)
+
+  def _record_wasted_speculation(self, future):
+    if future.cancelled() or future.exception() is not None:
+      return
+    result = future.result()
+    with self._speculation_lock:
+      self.speculation_stats["wasted"] += 1
+      self.speculation_stats["wasted_llm_calls"] += result["llm_calls"]
+      self.speculation_stats["wasted_event_fetches"] += 1
+      self.speculation_stats["wasted_seconds"] += result["seconds"]
+
+  def _prompt_speculative(self, text):
+    """Runs the intent prompt, date detection and event prefetch concurrently,
+    keeping the speculative summarize work only if the intent is (1).
+    """
+    if self._speculation_executor is None:
+      self._speculation_executor = ThreadPoolExecutor(max_workers=2)
+    # run under copies of the current context so the spans nest under the turn
+    intent_future = self._speculation_executor.submit(
+        contextvars.copy_context().run, self._prompt_intent, text)
+    summary_future = self._speculation_executor.submit(
+        contextvars.copy_context().run, self._speculate_summary_inputs, text)
+    with self._speculation_lock:
+      self.speculation_stats["runs"] += 1
+    
+    message_content = intent_future.result()
+    self.tracer.debug("intent", intent=message_content)
+    
+    if '1' in message_content:
+      with self._speculation_lock:
+        self.speculation_stats["kept"] += 1
+      inputs = summary_future.result()
+      return self._summarize_events(text, inputs["date_expression"], inputs["date_min"], inputs["event_list"],
+                                    inputs["unavailable"])
+    
+    if summary_future.cancel():
+      with self._speculation_lock:
+        self.speculation_stats["cancelled"] += 1
+    else:
+      summary_future.add_done_callback(self._record_wasted_speculation)
+    return self._dispatch(message_content, text)
 
   def prompt(self, text) -> str:
+    with self.tracer.span("turn", request_chars=len(text)) as span:
+      reply = self._respond(text)
+      # keep the exchange, not the stage prompts, for later turns
+      self.history.add_turn(text, reply)
+      span.set(response_chars=len(reply or ""))
+      return reply
+
+  def prompt_stream(self, text):
+    """Like prompt, but yields the reply in pieces: token by token for the
+    chat fallback, task by task for plans made by the LLM (local_scheduler
+    off), whose events are inserted as soon as each task is complete. Other
+    replies come in one piece.
+    """
+    span = self.tracer.start_span("turn", stream=True, request_chars=len(text))
+    parts = []
+    error = None
+    responses = self._respond_stream(text)
+    try:
+      while True:
+        # the turn is the parent of the spans opened while making the reply
+        with self.tracer.activate(span):
+          part = next(responses, None)
+        if part is None:
+          break
+        parts.append(part)
+        yield part
+    except BaseException as e:
+      error = type(e).__name__
+      raise
+    finally:
+      with self.tracer.activate(span):
+        responses.close()
+      span.set(response_chars=sum(len(part) for part in parts))
+      self.tracer.end_span(span, error)
+    self.history.add_turn(text, "".join(parts))
+
+  def _respond_stream(self, text):
+    message_content = self._local_intent(text)
+    if message_content is None:
+      message_content = self._prompt_intent(text)
+      self.tracer.debug("intent", intent=message_content)
+
+    if '3' in message_content and not self.local_scheduler:
+      yield from self._stream_plan_and_add_calendar(text)
+    elif any(intent in message_content for intent in '123'):
+      yield self._dispatch(message_content, text)
+    else:
+      yield from self.stream(self._stage_messages("chat", text), stage="chat")
+
+  def _insert_plan_task(self, task):
+    """Inserts one task of an LLM plan; returns (event, error).
+    """
+    bodies, _, failed = self._plan_bodies([task])
+    if failed:
+      return None, task['Error']
+    try:
+      return self._insert_event(bodies[0]), None
+    except Exception as error:
+      return None, error
+
+  def _plan_task_line(self, task, event, error):
+    line = f"- {task.get('Task')}"
+    if 'Start Time' in task:
+      line += f": {task['Start Time']} ~ {task.get('End Time')}"
+    if error is not None:
+      task['Error'] = str(error)
+      return line + f" (could not be added: {error})\n"
+    task['URL'] = event.get('htmlLink')
+    return line + f" {task['URL']}\n"
+
+  def _insert_plan_item(self, index, text):
+    """Parses and inserts one task streamed by the schedule prompt; returns
+    (task, event, error). A task that cannot be read is reported as failed.
+    """
+    try:
+      task = self._load_json("schedule_task", text)
+    except json_utils.JSONParseError as error:
+      return {'Task': f"task {index + 1}"}, None, error
+    return (task,) + self._insert_plan_task(task)
+
+  def _plan_item_line(self, index, result, failed):
+    task, event, error = result
+    if error is not None:
+      failed.append(task.get('Task', ''))
+    line = self._plan_task_line(task, event, error)
+    return "I made a plan as following and added them to your schedule\n\n" + line if index == 0 else line
+
+  def _stream_plan_and_add_calendar(self, text):
+    """Streams the plan of the schedule prompt, inserting each task while the
+    LLM is still writing the next ones.
+    """
+    formatted_string = self.analysis_dialogue_gpt_call(text)
+    input_text = self._schedule_prompt(formatted_string)
+    self.tracer.debug("prompt", stage="schedule", text=input_text)
+
+    parser = json_utils.IncrementalArrayParser()
+    futures = []
+    shown = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=5) as executor:
+      for delta in self.stream(self._stage_messages("schedule", input_text), stage="schedule"):
+        for item in parser.feed(delta):
+          futures.append(executor.submit(contextvars.copy_context().run, self._insert_plan_item, len(futures), item))
+        # show the tasks inserted so far, in plan order
+        while shown < len(futures) and futures[shown].done():
+          yield self._plan_item_line(shown, futures[shown].result(), failed)
+          shown += 1
+      for future in futures[shown:]:
+        yield self._plan_item_line(shown, future.result(), failed)
+        shown += 1
+
+    if not futures:
+      # no task could be found in the stream; ask for the whole plan, with the repair retries
+      try:
+        tasks = self.create_schedule_dialogue_gpt_call(formatted_string)["Tasks"]
+      except json_utils.JSONParseError as error:
+        self.tracer.debug("plan_failed", errors=error.errors)
+        tasks = []
+      if not tasks:
+        yield "I could not make a plan for this request. Could you rephrase it?"
+        return
+      for i, task in enumerate(tasks):
+        yield self._plan_item_line(i, (task,) + self._insert_plan_task(task), failed)
+    if failed:
+      yield "\nThe following tasks could not be added: " + ", ".join(failed)
+
+  def _respond(self, text):
     
-    # First prompt chatgpt for intent
-    response = self._prompt_intent(text)
-    # Parse the ChatGPT response to obtain intent
-    message_content = response.choices[0].message.content
-    print(f"message_content: {message_content}")
+    # Try the local classifier first, prompt chatgpt only if it is not confident
+    message_content = self._local_intent(text)
     
+    if message_content is None:
+      if self.speculative:
+        return self._prompt_speculative(text)
+      
+      # First prompt chatgpt for intent
+      message_content = self._prompt_intent(text)
+      self.tracer.debug("intent", intent=message_content)
+    
+    return self._dispatch(message_content, text)
+
+  def _dispatch(self, message_content, text):
     if '1' in message_content:
       return self._prompt_summarize_calendar(text)
     
@@ -351,17 +1001,10 @@ f"\n\nInput: Today is {datetime.datetime.today().date()}. ... {text}")
       return self._prompt_plan_and_add_calendar(text)
     
     else:
-      self.messages.append({
-        "role": "user",
-        "content": text,
-      })
-
       # Call ChatGPT
-      response = self.call()
+      response = self.call(self._stage_messages("chat", text), stage="chat")
 
-      # Save the returned message
       message = response.choices[0].message
-      self.messages.append(message) ## ??
       
     ### add some default message instead of calling chatgpt.
     #   message = ("""Could you rephrase your request so that I can better understand your intent? I can assist you with the following."""
@@ -369,159 +1012,60 @@ f"\n\nInput: Today is {datetime.datetime.today().date()}. ... {text}")
       return message.content
 
     
-  def analysis_dialogue_gpt_call(self, user_text):
-    input_text = f"""###Instruction: The assistant is an expert in analyzing conversations for schedule management. It takes the user's conversation as input and analyzes what tasks need to be done, by when, and how many detailed tasks the user desires. The assistant recognizes the user's conversation and performs accurate analysis.
-  Output Goals:
-  Target Task, Target Time, Maximum Number of Detailed Tasks
-
-  Considerations:
-
-  1. If the target task and target time are not clear in your analysis of the user's conversation, you must output a response stating, "Please suggest a target task or target time."
-  2. If the maximum number of detailed tasks is not clear in your analysis of the user's conversation, set that number to 3.
-
-  Please refer to the following examples for your response
-  Example 1:
-  Input: I need to complete a C++ programming assignment on matrix multiplication optimization within 3 days from today. Please divide it into 4 tasks for scheduling.
-  Output(JSON type):
-  "Target Task": "Completing a C++ programming assignment on matrix multiplication optimization",
-  "Target Time": "3 days from today",
-  "Maximum number of detailed tasks": "four"
-
-  Example 2:
-  Input: I need to select a paper on multi-task learning, familiarize myself with it, and then present it by next Monday.
-  Output(JSON type):
-  "Target Task": "Research and presentation on a multi-task learning paper",
-  "Target Time": "Next Monday",
-  "Maximum number of detailed tasks": "three"
-
-  Example 3:
-  Input: I need to coordinate our team's business trip schedule with another team and submit a report on the travel plan by next Wednesday. Please suggest a schedule divided into 5 detailed tasks.
-  Output(JSON type):
-  "Target Task": "Coordinating our team's business trip schedule with another team and writing a report on the travel plan",
-  "Target Time": "Next Wednesday",
-  "Maximum number of detailed tasks": "five"
-
-  ###User Input:
-  """
-    input_text += user_text
-    print(">>===========================================")
-    print("[Prompt for extracting information from user request.]")
-    print(input_text)
-
-    self.messages.append({
-        "role": "user",
-        "content": input_text,
-    })
+  def _analysis_prompt(self, user_text):
+    return self.prompts.render("analysis", text=user_text)
 
-    response = self.call()
-    message = response.choices[0].message.content
-      
-    # some cleansing if needed
-    if 'json' in message:
-      message = re.findall(r"(?<=```json)[\S\s]*(?=```)", message)[0]
-      message = message.strip()
-    init_result = json.loads(message)
-    init_result = {key.lower(): value for key, value in init_result.items()}
+  def _parse_analysis(self, message):
+    init_result = self._load_json("analysis", message, transform=_lowercase_keys)
 
     formatted_string = f"Target Task: {init_result['target task']},\nTarget Time: {init_result['target time']},\nMaximum number of detailed tasks: {init_result['maximum number of detailed tasks']}"
 
-    print("[Extracted information from the user request.]")
-    print(formatted_string)
+    self.tracer.debug("analysis", text=formatted_string)
 
     return formatted_string
 
+  def analysis_dialogue_gpt_call(self, user_text):
+    with self.tracer.span("stage.analysis"):
+      input_text = self._analysis_prompt(user_text)
+      self.tracer.debug("prompt", stage="analysis", text=input_text)
+
+      return self._ask_json("analysis", input_text, self._parse_analysis)
+
+  def _schedule_prompt(self, formatted_string):
+    return self.prompts.render("schedule", analysis=formatted_string,
+                               today=date_utils.today_in(self.timezone).isoformat())
+
+  def _parse_schedule(self, message):
+    return self._load_json("schedule", message)
+
   def create_schedule_dialogue_gpt_call(self, formatted_string):
-    input_text = """###Instruction : Please assist in optimized schedule management. As a 'Schedule Management Application', you act to suggest necessary tasks for work input by users, manage time effectively, and aid in overall productivity enhancement. The 'Schedule Management Application' performs the following roles for the "Target Task" and "Target Time" input by the user:
-
-Create the required subtasks for the 'Target Task'. Distribute the required subtasks for the 'Target Task' appropriately by 'Target Time'. Finally, the assistant outputs the distribution of detailed tasks by 'Target Time' in JSON format.
-
-Restrictions: 
-1. Between 00:00:00 and 09:00:00 in Asia/Seoul time is sleep time and is excluded from schedule distribution. 
-2. Asia/Seoul time between 12:00:00 and 13:00:00 is lunch time and is excluded from the schedule distribution. 
-3. The period between 18:00:00 and 20:00:00 in Asia/Seoul time is dinner time and is excluded from the schedule distribution.
-4. Assistant only outputs JSON.
-5. You must strictly follow the json format presented in the example.
-6. Create as many detailed tasks as the suggested Maximum number of detailed tasks.
-Considerations: 
-1. You must consider the entire duration of the given schedule and distribute tasks so that they are not concentrated on specific days. Be sure to not concentrate your work on a specific day or time. 
-2. The time allotted for a single detailed tasks must be no more than 3 hours.
-
-Here is an example
-User Input:
-Today is November 21, 2023.
-Target Task: I need to select and present a paper on deep learning.
-Target Time: Next Monday.
-Maximum number of detailed task : five
-
-Assistant Output(Should be JSON format):
-{{
-"Tasks": [
-{{
-  "Task": "Selecting a Paper",
-  "Start Time": "2023-11-21T09:00:00",
-  "End Time": "2023-11-21T12:00:00",
-  "timeZone": 'Asia/Seoul'
-}},
-{{
-  "Task": "Thoroughly Reading the Paper",
-  "Start Time": "2023-11-21T13:00:00",
-  "End Time": "2023-11-22T17:00:00",
-  "timeZone": 'Asia/Seoul'
-}},
-{{
-  "Task": "Researching Background Information",
-  "Start Time": "2023-11-23T09:00:00",
-  "End Time": "2023-11-23T12:00:00",
-  "timeZone": 'Asia/Seoul'
-}},
-{{
-  "Task": "Creating the Presentation",
-  "Start Time": "2023-11-23T13:00:00",
-  "End Time": "2023-11-24T17:00:00",
-  "timeZone": 'Asia/Seoul'
-}},
-{{
-  "Task": "Rehearsing the Presentation",
-  "Start Time": "2023-11-25T09:00:00",
-  "End Time": "2023-11-26T17:00:00",
-  "timeZone": 'Asia/Seoul'
-}}
-]
-}}
-
-###User Input:
-"""
-    
-    current_date = datetime.datetime.now()
-    formatted_date = current_date.strftime("Today is %B %d, %Y.")
-    
-    input_text = input_text + formatted_date + "\n" + formatted_string
+    with self.tracer.span("stage.schedule"):
+      input_text = self._schedule_prompt(formatted_string)
+      self.tracer.debug("prompt", stage="schedule", text=input_text)
+      
+      # Call ChatGPT
+      return self._ask_json("schedule", input_text, self._parse_schedule)
 
-    print(">>===========================================")
-    print("[Prompt for creating a plan according to user request.]")
-    print(input_text)
-    
-    self.messages.append({
-        "role": "user",
-        "content": input_text,
-    })
-    
-    # Call ChatGPT
-    response = self.call()
-    message = response.choices[0].message.content
-    
-    # some cleansing if needed
-    if 'json' in message:
-      message = re.findall(r"(?<=```json)[\S\s]*(?=```)", message)[0]
-      message = message.strip()
-    init_result = json.loads(message)
+  def _subtasks_prompt(self, formatted_string):
+    return self.prompts.render("subtasks", analysis=formatted_string)
+
+  def _parse_subtasks(self, message):
+    init_result = self._load_json("subtasks", message)
+
+    return [(task['Task'], float(task['Hours'])) for task in init_result['Tasks']]
 
-    return init_result
+  def create_subtasks_gpt_call(self, formatted_string):
+    with self.tracer.span("stage.subtasks"):
+      input_text = self._subtasks_prompt(formatted_string)
+      self.tracer.debug("prompt", stage="subtasks", text=input_text)
+      
+      # Call ChatGPT
+      return self._ask_json("subtasks", input_text, self._parse_subtasks)
 
 
 
 # Run an interactive console to chat with ChatGPT
-def run_console(chatgpt):
+def run_console(chatgpt, stream=False):
     while True:
         # Receive user input
         prompt = input("👩🏻‍🦰 User: ")
@@ -531,6 +1075,12 @@ def run_console(chatgpt):
             break
 
         # Receive and display ChatGPT response
+        if stream:
+            print("🤖 ChatGPT:", end=" ", flush=True)
+            for part in chatgpt.prompt_stream(prompt):
+                print(part, end="", flush=True)
+            print()
+            continue
         response = chatgpt.prompt(prompt)
         print("🤖 ChatGPT:", response)
     print("The chat has ended")
@@ -0,0 +1,215 @@
+import datetime
+import re
+
+from dateutil import parser, tz
+from dateutil.relativedelta import relativedelta, MO, TU, WE, TH, FR, SA, SU
+
+
+# Windows time zone names (as used by CalendarChatGPT.timezone) to IANA names.
+WINDOWS_TIMEZONES = {
+  "Korean Standard Time": "Asia/Seoul",
+  "Korea Standard Time": "Asia/Seoul",
+  "Tokyo Standard Time": "Asia/Tokyo",
+  "China Standard Time": "Asia/Shanghai",
+  "UTC": "UTC",
+  "GMT Standard Time": "Europe/London",
+  "Central European Standard Time": "Europe/Berlin",
+  "Eastern Standard Time": "America/New_York",
+  "Central Standard Time": "America/Chicago",
+  "Mountain Standard Time": "America/Denver",
+  "Pacific Standard Time": "America/Los_Angeles",
+}
+
+WEEKDAYS = {
+  "monday": MO, "tuesday": TU, "wednesday": WE, "thursday": TH,
+  "friday": FR, "saturday": SA, "sunday": SU,
+}
+
+MONTHS = {
+  "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
+  "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12,
+}
+
+NUMBER_WORDS = {
+  "a": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+  "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}
+
+_WEEKDAY = r"(monday|tuesday|wednesday|thursday|friday|saturday|sunday)"
+_MONTH = (r"(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?"
+          r"|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)\.?")
+_NUMBER = r"\d+|a|one|two|three|four|five|six|seven|eight|nine|ten"
+
+
+def get_tzinfo(timezone=None):
+  """Returns a tzinfo for an IANA or Windows time zone name (local time if unknown).
+  """
+  if timezone:
+    zone = tz.gettz(WINDOWS_TIMEZONES.get(timezone, timezone))
+    if zone is not None:
+      return zone
+  return tz.tzlocal()
+
+
+def today_in(timezone=None):
+  return datetime.datetime.now(get_tzinfo(timezone)).date()
+
+
+def event_time(event_time_dict, tzinfo):
+  """Converts an event 'start'/'end' dict into an aware datetime.
+  All-day events ('date') start at midnight in the given timezone.
+  """
+  if 'dateTime' in event_time_dict:
+    try:
+      # several times faster than isoparse, and reads the API's RFC 3339 times
+      value = datetime.datetime.fromisoformat(event_time_dict['dateTime'])
+    except ValueError:
+      value = parser.isoparse(event_time_dict['dateTime'])
+    if value.tzinfo is None:
+      value = value.replace(tzinfo=tzinfo)
+    return value
+  day = datetime.date.fromisoformat(event_time_dict['date'])
+  return datetime.datetime(day.year, day.month, day.day, tzinfo=tzinfo)
+
+
+def format_date(date):
+  return f"{date.year}/{date.month:02d}/{date.day:02d}"
+
+
+def _number(word):
+  return int(word) if word.isdigit() else NUMBER_WORDS[word]
+
+
+def _week_start(date):
+  return date - datetime.timedelta(days=date.weekday())
+
+
+def _relative_day(m, today):
+  word = m.group(0)
+  if word.startswith("day after"):
+    day = today + datetime.timedelta(days=2)
+  elif word.startswith("day before"):
+    day = today - datetime.timedelta(days=2)
+  elif word in ("today", "tonight"):
+    day = today
+  elif word == "tomorrow":
+    day = today + datetime.timedelta(days=1)
+  else:
+    day = today - datetime.timedelta(days=1)
+  return day, day
+
+
+def _offset(m, today):
+  n = _number(m.group("n1") or m.group("n2"))
+  unit = m.group("u1") or m.group("u2")
+  delta = relativedelta(weeks=n) if unit.startswith("week") else relativedelta(days=n)
+  day = today + delta
+  return day, day
+
+
+def _weekday(m, today):
+  modifier = (m.group(1) or "").strip()
+  weekday = WEEKDAYS[m.group(2)]
+  if modifier.startswith("next"):
+    day = _week_start(today) + datetime.timedelta(days=7 + weekday.weekday)
+  elif modifier.startswith(("last", "past")):
+    day = today + relativedelta(days=-1, weekday=weekday(-1))
+  else:
+    # this / upcoming / coming / bare weekday: next occurrence from today
+    day = today + relativedelta(weekday=weekday(+1))
+  return day, day
+
+
+def _week_range(m, today):
+  modifier, unit = m.group(1), m.group(2)
+  shift = {"this": 0, "current": 0, "next": 1, "coming": 1, "last": -1, "past": -1}[modifier]
+  if unit == "weekend":
+    saturday = _week_start(today) + datetime.timedelta(days=5, weeks=shift)
+    return saturday, saturday + datetime.timedelta(days=1)
+  if unit == "week":
+    start = _week_start(today) + datetime.timedelta(weeks=shift)
+    return start, start + datetime.timedelta(days=6)
+  start = today.replace(day=1) + relativedelta(months=shift)
+  return start, start + relativedelta(months=1, days=-1)
+
+
+def _year(group, today):
+  if not group:
+    return today.year
+  year = int(group)
+  return year + 2000 if year < 100 else year
+
+
+def _iso_date(m, today):
+  day = datetime.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+  return day, day
+
+
+def _slash_date(m, today):
+  day = datetime.date(_year(m.group(3), today), int(m.group(1)), int(m.group(2)))
+  return day, day
+
+
+def _month_day(m, today):
+  day = datetime.date(_year(m.group(3), today), MONTHS[m.group(1)[:3]], int(m.group(2)))
+  return day, day
+
+
+def _day_month(m, today):
+  day = datetime.date(_year(m.group(3), today), MONTHS[m.group(2)[:3]], int(m.group(1)))
+  return day, day
+
+
+RULES = [
+  (re.compile(r"\bday (after tomorrow|before yesterday)\b|\b(today|tonight|tomorrow|yesterday)\b"), _relative_day),
+  (re.compile(rf"\bin (?P<n1>{_NUMBER}) (?P<u1>days?|weeks?)\b"
+              rf"|\b(?P<n2>{_NUMBER}) (?P<u2>days?|weeks?) (?:later|from (?:now|today))\b"), _offset),
+  (re.compile(rf"\b(this upcoming |this coming |upcoming |coming |this |next |last |past )?{_WEEKDAY}\b"), _weekday),
+  (re.compile(r"\b(this|current|next|coming|last|past) (week|weekend|month)\b"), _week_range),
+  (re.compile(r"\b(\d{4})[/.-](\d{1,2})[/.-](\d{1,2})\b"), _iso_date),
+  (re.compile(r"(?<![\d/])(\d{1,2})/(\d{1,2})(?:/(\d{2}|\d{4}))?(?![\d/])"), _slash_date),
+  (re.compile(rf"\b{_MONTH}\s+(\d{{1,2}})(?:st|nd|rd|th)?(?:,?\s+(\d{{4}}))?\b"), _month_day),
+  (re.compile(rf"\b(\d{{1,2}})(?:st|nd|rd|th)?\s+(?:of\s+)?{_MONTH}(?:,?\s+(\d{{4}}))?\b"), _day_month),
+]
+
+
+def find_date_expressions(text, today):
+  """Returns non-overlapping (start, end, phrase, first_day, last_day) matches in text.
+  """
+  lowered = text.lower()
+  matches = []
+  for pattern, resolve in RULES:
+    for m in pattern.finditer(lowered):
+      try:
+        first_day, last_day = resolve(m, today)
+      except (ValueError, KeyError):
+        continue
+      matches.append((m.start(), m.end(), text[m.start():m.end()].strip(), first_day, last_day))
+
+  # keep the longest match where matches overlap
+  matches.sort(key=lambda x: (x[0], -(x[1] - x[0])))
+  kept = []
+  for match in matches:
+    if kept and match[0] < kept[-1][1]:
+      continue
+    kept.append(match)
+  return kept
+
+
+def resolve_date_expression(text, today=None, timezone=None):
+  """Resolves the date-related phrase in text without calling the LLM.
+
+  Returns (detected_phrase, "YYYY/MM/DD", "YYYY/MM/DD") like
+  CalendarChatGPT._prompt_detect_date, the last value being the day after the
+  resolved date (or range). Returns None if there is no phrase, or more than
+  one, so the caller can fall back to the LLM.
+  """
+  if today is None:
+    today = today_in(timezone)
+
+  matches = find_date_expressions(text, today)
+  if len(matches) != 1:
+    return None
+
+  _, _, phrase, first_day, last_day = matches[0]
+  return phrase, format_date(first_day), format_date(last_day + datetime.timedelta(days=1))
@@ -0,0 +1,115 @@
+import datetime
+import sys
+
+import date_utils
+
+# column order of to_line/serialize
+PROMPT_HEADER = "date|start|end|summary|location|organizer|participants"
+
+
+def _intern(text):
+  # the same locations, organizers and attendees come back on many events; keep one copy
+  return sys.intern(text) if text else ""
+
+
+_ZONES = {}
+
+
+def _shared_zone(value):
+  # parsing gives each time a fixed-offset tzinfo of its own; share one per offset
+  zone = value.tzinfo
+  if type(zone) is datetime.timezone:
+    value = value.replace(tzinfo=_ZONES.setdefault(zone, zone))
+  return value
+
+
+def _person(attendee):
+  email = attendee.get('email', '')
+  name = attendee.get('displayName')
+  return f"{name} ({email})" if name and email else name or email
+
+
+def _field(text):
+  # keep the columns apart
+  return (text or "").replace("|", "/").replace("\n", " ")
+
+
+class EventRecord:
+  """The parts of a Calendar event the summarize and plan flows use.
+
+  start and end are aware datetimes; all-day events start at midnight of
+  their day in the time zone they were read in. Locations, organizers and
+  attendees are interned, attendees being "Name (email)" or just the email.
+  """
+  __slots__ = ("id", "summary", "start", "end", "all_day", "location", "organizer", "attendees",
+               "transparent", "ical_uid")
+
+  def __init__(self, id, summary, start, end, all_day=False, location="", organizer="", attendees=(),
+               transparent=False, ical_uid=None):
+    self.id = id
+    self.summary = summary
+    self.start = start
+    self.end = end
+    self.all_day = all_day
+    self.location = location
+    self.organizer = organizer
+    self.attendees = attendees
+    self.transparent = transparent
+    self.ical_uid = ical_uid
+
+  @classmethod
+  def from_event(cls, event, tzinfo=None):
+    """Record of an event dict of the Calendar API. Raises KeyError or
+    ValueError if its start cannot be read; a missing end is taken as the start.
+    """
+    start = _shared_zone(date_utils.event_time(event['start'], tzinfo))
+    end = _shared_zone(date_utils.event_time(event['end'], tzinfo)) if event.get('end') else start
+    organizer = event.get('organizer') or {}
+    attendees = tuple(_intern(person) for person in map(_person, event.get('attendees') or []) if person)
+    return cls(event.get('id'), event.get('summary') or "", start, end,
+               all_day='dateTime' not in event['start'],
+               location=_intern(event.get('location') or ""),
+               organizer=_intern(organizer.get('email') or organizer.get('displayName') or ""),
+               attendees=attendees,
+               transparent=event.get('transparency') == 'transparent',
+               ical_uid=event.get('iCalUID'))
+
+  def __repr__(self):
+    return f"EventRecord({self.summary!r}, {self.start.isoformat()})"
+
+  def to_line(self, tzinfo=None):
+    """The event as one PROMPT_HEADER line, times in tzinfo.
+    """
+    start = self.start.astimezone(tzinfo)
+    if self.all_day:
+      times = "all day|"
+    else:
+      end = self.end.astimezone(tzinfo)
+      end_text = f"{end:%H:%M}" if end.date() == start.date() else f"{end:%Y-%m-%d %H:%M}"
+      times = f"{start:%H:%M}|{end_text}"
+    return "|".join([f"{start:%Y-%m-%d}", times, _field(self.summary), _field(self.location),
+                     _field(self.organizer), ", ".join(_field(person) for person in self.attendees)])
+
+
+def from_events(event_list, tzinfo=None):
+  """Records of event dicts, in the same order; cancelled and unreadable
+  events are left out. Records in event_list are kept as they are.
+  """
+  records = []
+  for event in event_list:
+    if isinstance(event, EventRecord):
+      records.append(event)
+      continue
+    if event.get('status') == 'cancelled':
+      continue
+    try:
+      records.append(EventRecord.from_event(event, tzinfo))
+    except (KeyError, ValueError):
+      continue
+  return records
+
+
+def serialize(records, tzinfo=None):
+  """Records as prompt text: the PROMPT_HEADER line, then one line per event.
+  """
+  return "\n".join([PROMPT_HEADER] + [record.to_line(tzinfo) for record in records])
@@ -0,0 +1,211 @@
+import json
+import sqlite3
+import threading
+import time
+
+import calendar_utils
+import date_utils
+import recurrence_utils
+
+
+class EventStore:
+  """Local copy of one calendar, kept up to date with incremental sync.
+
+  The first query does a full `events().list` sync; later ones send only the
+  `syncToken` from the previous sync and apply the returned changes. Range
+  queries are answered from a start-time sorted index. Data older than
+  `max_staleness` seconds is re-synced before answering; `refresh` forces it.
+
+  With `expand_recurring` the store syncs recurring series once, as their
+  RRULEs, and expands them locally (see recurrence_utils) over a window
+  around today that grows to cover the queried ranges, instead of having
+  the server send every instance.
+  """
+  def __init__(self,
+               service,
+               calendarId="primary",
+               db_path=None,
+               max_staleness=60,
+               timezone="Korean Standard Time",
+               expand_recurring=True):
+    self.service = service
+    self.calendarId = calendarId
+    self.db_path = db_path
+    self.max_staleness = max_staleness
+    self.tzinfo = date_utils.get_tzinfo(timezone)
+    self.expand_recurring = expand_recurring
+    # sync tokens of series and of instance listings are not interchangeable
+    self._state_key = calendarId + "#series" if expand_recurring else calendarId
+
+    self.events = {}
+    self.sync_token = None
+    self.last_sync = None
+    self._lock = threading.RLock()
+    self._index = None  # recurrence_utils.EventIndex, rebuilt lazily
+    self._window = None  # (start, end) datetimes the series are expanded over
+    self._series_cache = {}  # series id -> instances, reused while the series is unchanged
+    # what _save has to write: every event after a full sync, else the changed
+    # ids; only tracked when there is a database to write to
+    self._rewrite = False
+    self._changed = set()
+
+    if db_path is not None:
+      self._load()
+
+  # --- syncing ---------------------------------------------------------------
+
+  def _list_pages(self, **kwargs):
+    if self.expand_recurring:
+      # cancelled instances of a series only come with showDeleted
+      return calendar_utils.iter_event_pages(
+          self.service, calendarId=self.calendarId, singleEvents=False, showDeleted=True, **kwargs)
+    return calendar_utils.iter_event_pages(
+        self.service, calendarId=self.calendarId, singleEvents=True, **kwargs)
+
+  def _keep(self, event):
+    # a cancelled instance of a series is kept to hide that instance
+    return event.get("status") != "cancelled" or (self.expand_recurring and bool(event.get("recurringEventId")))
+
+  def _full_sync(self):
+    events = {}
+    sync_token = None
+    for page in self._list_pages():
+      for event in page.get("items", []):
+        if self._keep(event):
+          events[event["id"]] = event
+      sync_token = page.get("nextSyncToken", sync_token)
+    self.events = events
+    self.sync_token = sync_token
+    self._rewrite = True
+    self._changed.clear()
+
+  def _mark_changed(self, event_id):
+    if self.db_path is not None:
+      self._changed.add(event_id)
+
+  def _incremental_sync(self):
+    sync_token = self.sync_token
+    for page in self._list_pages(syncToken=self.sync_token):
+      for event in page.get("items", []):
+        self._mark_changed(event["id"])
+        if self._keep(event):
+          self.events[event["id"]] = event
+        else:
+          self.events.pop(event["id"], None)
+      sync_token = page.get("nextSyncToken", sync_token)
+    self.sync_token = sync_token
+
+  def refresh(self, full=False):
+    """Syncs with the server now. full=True discards the local copy first.
+    """
+    from googleapiclient.errors import HttpError
+    with self._lock:
+      if full or self.sync_token is None:
+        self._full_sync()
+      else:
+        try:
+          self._incremental_sync()
+        except HttpError as error:
+          # 410 Gone: the sync token expired, start over
+          if error.resp.status != 410:
+            raise
+          self._full_sync()
+      self.last_sync = time.time()
+      self._index = None
+      if self.db_path is not None:
+        self._save()
+
+  def is_stale(self):
+    return self.last_sync is None or time.time() - self.last_sync > self.max_staleness
+
+  def invalidate(self):
+    """Marks the store stale so that the next query syncs first.
+    """
+    with self._lock:
+      self.last_sync = None
+
+  def add_event(self, event):
+    """Records an event we inserted ourselves and invalidates the store.
+    """
+    with self._lock:
+      if event and "id" in event:
+        self.events[event["id"]] = event
+        self._mark_changed(event["id"])
+        self._index = None
+      self.invalidate()
+
+  # --- querying ---------------------------------------------------------------
+
+  def _build_index(self, time_min, time_max):
+    if not self.expand_recurring:
+      self._index = recurrence_utils.EventIndex(self.events.values(), self.tzinfo)
+      return
+    if self._window is None:
+      self._window = recurrence_utils.default_window(self.tzinfo)
+    self._window = (min(self._window[0], time_min), max(self._window[1], time_max))
+    entries = recurrence_utils.expand_entries(self.events.values(), *self._window, tzinfo=self.tzinfo,
+                                              cache=self._series_cache)
+    self._index = recurrence_utils.EventIndex(entries=entries)
+
+  def _covers(self, time_min, time_max):
+    return not self.expand_recurring or (self._window[0] <= time_min and time_max <= self._window[1])
+
+  def query(self, timeMin, timeMax):
+    """Returns events overlapping [timeMin, timeMax) sorted by start time.
+    timeMin/timeMax are RFC3339 strings as passed to `events().list`.
+    """
+    with self._lock:
+      if self.is_stale():
+        self.refresh()
+
+      time_min = date_utils.event_time({'dateTime': timeMin}, self.tzinfo)
+      time_max = date_utils.event_time({'dateTime': timeMax}, self.tzinfo)
+      if self._index is None or not self._covers(time_min, time_max):
+        self._build_index(time_min, time_max)
+      return self._index.query(time_min.timestamp(), time_max.timestamp())
+
+  # --- persistence -------------------------------------------------------------
+
+  def _connect(self):
+    conn = sqlite3.connect(self.db_path)
+    conn.execute("CREATE TABLE IF NOT EXISTS events "
+                 "(calendar_id TEXT, id TEXT, body TEXT, PRIMARY KEY (calendar_id, id))")
+    conn.execute("CREATE TABLE IF NOT EXISTS sync_state "
+                 "(calendar_id TEXT PRIMARY KEY, sync_token TEXT, last_sync REAL)")
+    return conn
+
+  def _load(self):
+    conn = self._connect()
+    try:
+      row = conn.execute("SELECT sync_token, last_sync FROM sync_state WHERE calendar_id = ?",
+                         (self._state_key,)).fetchone()
+      if row is None:
+        return
+      self.sync_token, self.last_sync = row
+      self.events = {event_id: json.loads(body) for event_id, body in conn.execute(
+          "SELECT id, body FROM events WHERE calendar_id = ?", (self._state_key,))}
+    finally:
+      conn.close()
+
+  def _save(self):
+    conn = self._connect()
+    try:
+      with conn:
+        if self._rewrite:
+          conn.execute("DELETE FROM events WHERE calendar_id = ?", (self._state_key,))
+          conn.executemany("INSERT INTO events VALUES (?, ?, ?)",
+                           [(self._state_key, event_id, json.dumps(event))
+                            for event_id, event in self.events.items()])
+        else:
+          # after an incremental sync only the events it changed are written
+          conn.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?)",
+                           [(self._state_key, event_id, json.dumps(self.events[event_id]))
+                            for event_id in self._changed if event_id in self.events])
+          conn.executemany("DELETE FROM events WHERE calendar_id = ? AND id = ?",
+                           [(self._state_key, event_id) for event_id in self._changed if event_id not in self.events])
+        conn.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)",
+                     (self._state_key, self.sync_token, self.last_sync))
+      self._rewrite = False
+      self._changed.clear()
+    finally:
+      conn.close()
@@ -0,0 +1,588 @@
+"""In-memory stand-ins for the OpenAI chat-completions client and the Google
+Calendar service, so CalendarChatGPT can run without network access.
+
+    bot = CalendarChatGPT(None, client=ScriptedChatClient(),
+                          service=FakeCalendarService(generate_events(500)))
+"""
+import asyncio
+import copy
+import datetime
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+
+import httplib2
+from googleapiclient.errors import HttpError
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+import date_utils
+import history_utils
+import llm_cache
+import recurrence_utils
+
+# Substrings identifying the prompt of each stage, checked in order
+STAGE_MARKERS = [
+  # batch prompts extend the single ones, so they are matched first
+  ("intent_batch", "Classify the intention of each one"),
+  ("detect_date_batch", "Detect the phrase of each one"),
+  ("intent", "Classify user intention"),
+  ("detect_date", "Detect any time-related phrase"),
+  ("add_calendar", "calendar create request"),
+  ("analysis", "expert in analyzing conversations"),
+  ("subtasks", "estimate how many hours"),
+  ("schedule", "'Schedule Management Application'"),
+  ("summarize", "Rephrase the agenda below"),
+  ("summarize", "Calendar input"),
+]
+
+
+def prompt_stage(messages):
+  """Stage of the system prompt or the last message of a request, "chat" if
+  none matches.
+  """
+  contents = [history_utils._content(m) for m in messages[:1] if m.get("role") == "system"]
+  contents += [history_utils._content(m) for m in messages[-1:]]
+  for content in contents:
+    for stage, marker in STAGE_MARKERS:
+      if marker in content:
+        return stage
+  return "chat"
+
+
+def _today(content):
+  match = re.search(r"Today is (\d{4}-\d{2}-\d{2})", content)
+  if match:
+    return datetime.date.fromisoformat(match.group(1))
+  return datetime.date.today()
+
+
+def _intent(text):
+  text = text.lower()
+  if re.search(r"\b(plan|prepare|study schedule)\b", text):
+    return "3"
+  if re.search(r"\b(add|create|book|put)\b", text):
+    return "2"
+  if re.search(r"\b(schedules?|calendar|agenda|today|tomorrow|week|on)\b", text):
+    return "1"
+  return ""
+
+
+def _detected_date(today):
+  tomorrow = today + datetime.timedelta(days=1)
+  return {"detected_phrase": "today",
+          "date": date_utils.format_date(today),
+          "date_after_date": date_utils.format_date(tomorrow)}
+
+
+def _batch_items(content):
+  return json.loads(content[content.index("["):])
+
+
+def default_responder(messages):
+  """Plausible reply for each stage prompt of CalendarChatGPT.
+  """
+  content = history_utils._content(messages[-1])
+  stage = prompt_stage(messages)
+  today = _today(content)
+
+  if stage == "intent_batch":
+    return json.dumps({"results": [{"id": item["id"], "intent": _intent(item["text"])}
+                                   for item in _batch_items(content)]})
+  if stage == "detect_date_batch":
+    return json.dumps({"results": [dict(_detected_date(today), id=item["id"]) for item in _batch_items(content)]})
+  if stage == "intent":
+    return _intent(content)
+  if stage == "detect_date":
+    return json.dumps(_detected_date(today))
+  if stage == "add_calendar":
+    day = (today + datetime.timedelta(days=1)).isoformat()
+    return json.dumps({"summary": "Meeting", "location": "Room 308", "description": "",
+                       "startTime": f"{day}T14:00:00", "endTime": f"{day}T15:00:00",
+                       "timeZone": "Asia/Seoul", "attendeesEmail": []})
+  if stage == "analysis":
+    return json.dumps({"Target Task": "Prepare the conference talk",
+                       "Target Time": "next Friday",
+                       "Maximum number of detailed tasks": "three"})
+  if stage == "subtasks":
+    return json.dumps({"Tasks": [{"Task": "Outline the talk", "Hours": 2},
+                                 {"Task": "Make the slides", "Hours": 5},
+                                 {"Task": "Rehearse", "Hours": 1}]})
+  if stage == "schedule":
+    tasks = []
+    for i, name in enumerate(["Outline the talk", "Make the slides", "Rehearse"]):
+      day = (today + datetime.timedelta(days=i + 1)).isoformat()
+      tasks.append({"Task": name, "Start Time": f"{day}T10:00:00", "End Time": f"{day}T12:00:00",
+                    "timeZone": "Asia/Seoul"})
+    return json.dumps({"Tasks": tasks})
+  if stage == "summarize":
+    if "Agenda:\n" in content:
+      return content.split("Agenda:\n", 1)[1].rsplit("\nQuestion:", 1)[0]
+    return "{'date': '%s', 'schedule': []}" % today.isoformat()
+  return "Hello! How can I help with your calendar?"
+
+
+def _usage(text, messages, cached_tokens=None):
+  prompt_tokens = history_utils.count_message_tokens(messages)
+  completion_tokens = history_utils.estimate_tokens(text)
+  usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+           "total_tokens": prompt_tokens + completion_tokens}
+  if cached_tokens is not None:
+    usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens}
+  return usage
+
+
+def completion(text, model="fake", messages=(), cached_tokens=None, finish_reason="stop"):
+  """Wraps reply text in a ChatCompletion with estimated usage.
+  """
+  return ChatCompletion.model_validate({
+    "id": "chatcmpl-fake",
+    "object": "chat.completion",
+    "created": int(time.time()),
+    "model": model or "fake",
+    "choices": [{"index": 0, "finish_reason": finish_reason,
+                 "message": {"role": "assistant", "content": text}}],
+    "usage": _usage(text, messages, cached_tokens),
+  })
+
+
+def completion_chunks(text, model="fake", messages=(), chunk_chars=16, cached_tokens=None):
+  """Splits reply text into ChatCompletionChunks as streamed with
+  stream_options={"include_usage": True}: deltas, then a usage-only chunk.
+  """
+  base = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+  for i in range(0, len(text), chunk_chars):
+    yield ChatCompletionChunk.model_validate(dict(base, choices=[
+      {"index": 0, "delta": {"role": "assistant", "content": text[i:i + chunk_chars]}, "finish_reason": None}]))
+  yield ChatCompletionChunk.model_validate(dict(base, choices=[], usage=_usage(text, messages, cached_tokens)))
+
+
+def truncate_reply(text, max_tokens=None):
+  """Cuts text to max_tokens as the model would; returns (text, finish_reason).
+  """
+  if not max_tokens or history_utils.estimate_tokens(text) <= max_tokens:
+    return text, "stop"
+  if history_utils._ENCODING is not None:
+    return history_utils._ENCODING.decode(history_utils._ENCODING.encode(text)[:max_tokens]), "length"
+  return text[:max_tokens * 4], "length"
+
+
+def recording_key(messages):
+  return llm_cache.cache_key(None, None, None, messages)
+
+
+def load_recording(path):
+  """Reads a file written by RecordingChatClient into a {key: reply} dict.
+  """
+  replies = {}
+  with open(path, encoding="utf-8") as f:
+    for line in f:
+      if line.strip():
+        record = json.loads(line)
+        replies[record["key"]] = record["reply"]
+  return replies
+
+
+class _Namespace:
+  def __init__(self, **kwargs):
+    self.__dict__.update(kwargs)
+
+
+class ScriptedChatClient:
+  """Drop-in for `OpenAI()` answering `chat.completions.create` locally.
+
+  script is one of:
+    None      - default_responder
+    callable  - called with the messages, returns the reply text
+    dict      - replies keyed by recording_key(messages), e.g. load_recording()
+    iterable  - replies returned in order
+  Each call sleeps `latency` seconds to stand in for the network. With
+  stream=True the reply comes as chunks, `chunk_latency` seconds apart.
+  Replies are cut at the request's max_tokens, like the API does.
+
+  Like the OpenAI prompt cache, usage reports as cached the tokens of the
+  longest run of leading messages sent before, once that run reaches
+  `prompt_cache_min_tokens`.
+  """
+  def __init__(self, script=None, latency=0.0, chunk_latency=0.0, prompt_cache_min_tokens=1024):
+    self.latency = latency
+    self.chunk_latency = chunk_latency
+    self.prompt_cache_min_tokens = prompt_cache_min_tokens
+    self.requests = []
+    self._lock = threading.Lock()
+    self._prefixes = set()
+    if script is None:
+      self._respond = default_responder
+    elif callable(script):
+      self._respond = script
+    elif isinstance(script, dict):
+      self._respond = lambda messages: script[recording_key(messages)]
+    else:
+      replies = iter(script)
+      self._respond = lambda messages: next(replies)
+    self.chat = _Namespace(completions=_Namespace(create=self.create))
+
+  def _cached_tokens(self, messages):
+    cached = 0
+    for n in range(1, len(messages) + 1):
+      key = recording_key(messages[:n])
+      if key in self._prefixes:
+        cached = n
+      else:
+        self._prefixes.add(key)
+    tokens = history_utils.count_message_tokens(messages[:cached])
+    return tokens if tokens >= self.prompt_cache_min_tokens else 0
+
+  def _reply(self, messages, max_tokens=None):
+    """(reply text, cached prompt tokens, finish reason) of a request.
+    """
+    with self._lock:
+      self.requests.append((prompt_stage(messages), messages))
+      text, finish_reason = truncate_reply(self._respond(messages), max_tokens)
+      return text, self._cached_tokens(messages), finish_reason
+
+  def _stream(self, model, messages, max_tokens=None):
+    text, cached, _ = self._reply(messages, max_tokens)
+    for chunk in completion_chunks(text, model=model or "fake", messages=messages, cached_tokens=cached):
+      if self.chunk_latency:
+        time.sleep(self.chunk_latency)
+      yield chunk
+
+  def create(self, model=None, messages=(), stream=False, **kwargs):
+    if self.latency:
+      time.sleep(self.latency)
+    if stream:
+      return self._stream(model, messages, kwargs.get("max_tokens"))
+    text, cached, finish_reason = self._reply(messages, kwargs.get("max_tokens"))
+    return completion(text, model=model, messages=messages, cached_tokens=cached, finish_reason=finish_reason)
+
+
+class AsyncScriptedChatClient(ScriptedChatClient):
+  """Drop-in for `AsyncOpenAI()`.
+  """
+  async def _astream(self, model, messages, max_tokens=None):
+    text, cached, _ = self._reply(messages, max_tokens)
+    for chunk in completion_chunks(text, model=model or "fake", messages=messages, cached_tokens=cached):
+      if self.chunk_latency:
+        await asyncio.sleep(self.chunk_latency)
+      yield chunk
+
+  async def create(self, model=None, messages=(), stream=False, **kwargs):
+    if self.latency:
+      await asyncio.sleep(self.latency)
+    if stream:
+      return self._astream(model, messages, kwargs.get("max_tokens"))
+    text, cached, finish_reason = self._reply(messages, kwargs.get("max_tokens"))
+    return completion(text, model=model, messages=messages, cached_tokens=cached, finish_reason=finish_reason)
+
+
+class RecordingChatClient:
+  """Wraps a real client and appends each request and reply to a JSONL file
+  that ScriptedChatClient(load_recording(path)) replays.
+  """
+  def __init__(self, client, path):
+    self.client = client
+    self.path = path
+    self._lock = threading.Lock()
+    self.chat = _Namespace(completions=_Namespace(create=self.create))
+
+  def _record(self, messages, reply):
+    record = {"key": recording_key(messages), "stage": prompt_stage(messages), "reply": reply}
+    with self._lock, open(self.path, "a", encoding="utf-8") as f:
+      f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+  def _recorded_stream(self, messages, chunks):
+    parts = []
+    for chunk in chunks:
+      if chunk.choices and chunk.choices[0].delta.content:
+        parts.append(chunk.choices[0].delta.content)
+      yield chunk
+    self._record(messages, "".join(parts))
+
+  def create(self, model=None, messages=(), **kwargs):
+    response = self.client.chat.completions.create(model=model, messages=messages, **kwargs)
+    if kwargs.get("stream"):
+      return self._recorded_stream(messages, response)
+    self._record(messages, response.choices[0].message.content)
+    return response
+
+
+class FakeRequest:
+  """Lazy request object; `execute()` runs it like googleapiclient's HttpRequest.
+  """
+  def __init__(self, fn, latency=0.0):
+    self.fn = fn
+    self.latency = latency
+
+  def execute(self, **kwargs):
+    if self.latency:
+      time.sleep(self.latency)
+    return self.fn()
+
+
+def _http_error(status, reason, error_reason=None):
+  # shaped like the API's JSON errors, so that HttpError.reason is the message
+  content = json.dumps({"error": {"code": status, "message": reason,
+                                  "errors": [{"reason": error_reason or reason, "message": reason}]}})
+  return HttpError(httplib2.Response({"status": status, "reason": reason}), content.encode("utf-8"))
+
+
+def _partial(item, fields):
+  """Keeps only the keys listed in an "items(a,b,c)" partial-response string.
+  """
+  match = re.search(r"items\(([^)]*)\)", fields or "")
+  if match is None:
+    return item
+  keys = match.group(1).split(",")
+  return {k: item[k] for k in keys if k in item}
+
+
+class FakeEventsResource:
+  """In-memory `service.events()` supporting list, get, insert, patch and delete.
+
+  list honours timeMin/timeMax, singleEvents (expanding recurring events with
+  recurrence_utils), orderBy="startTime", showDeleted,
+  maxResults/pageToken paging, the partial-response `fields` of items and
+  incremental sync: the last page carries a nextSyncToken, and listing with
+  syncToken returns the events changed since, including deletions as
+  cancelled events. Unknown sync tokens raise HttpError 410 like the API.
+  """
+  def __init__(self, events=(), calendarId="primary", latency=0.0, timezone="Asia/Seoul"):
+    self.latency = latency
+    self.tzinfo = date_utils.get_tzinfo(timezone)
+    self.calendars = defaultdict(dict)  # calendarId -> event id -> event
+    self.times = {}  # event id -> (start, end) timestamps
+    self.changes = []  # (sequence, calendarId, event id)
+    self.calls = defaultdict(int)
+    self.faults = []  # [method, error, after_commit] for the next requests of method
+    self._ids = itertools.count()
+    self._lock = threading.Lock()
+    for event in events:
+      self._store(calendarId, copy.deepcopy(event))
+
+  def fail_next(self, method, error, after_commit=False):
+    """Makes the next `method` request ("list", "insert", ...) raise error;
+    with after_commit only once it has taken effect, like a reply lost to a timeout.
+    """
+    with self._lock:
+      self.faults.append((method, error, after_commit))
+
+  def _request(self, method, fn):
+    def run():
+      with self._lock:
+        fault = next((f for f in self.faults if f[0] == method), None)
+        if fault is not None:
+          self.faults.remove(fault)
+      if fault is not None and not fault[2]:
+        raise fault[1]
+      result = fn()
+      if fault is not None:
+        raise fault[1]
+      return result
+    return FakeRequest(run, self.latency)
+
+  def _store(self, calendarId, event):
+    event.setdefault("id", f"fake{next(self._ids)}")
+    event.setdefault("status", "confirmed")
+    event.setdefault("htmlLink", f"https://calendar.example.com/event?eid={event['id']}")
+    self.calendars[calendarId][event["id"]] = event
+    self.times[event["id"]] = (date_utils.event_time(event["start"], self.tzinfo).timestamp(),
+                               date_utils.event_time(event["end"], self.tzinfo).timestamp())
+    self.changes.append((len(self.changes) + 1, calendarId, event["id"]))
+    return event
+
+  def _time(self, value):
+    return date_utils.event_time({"dateTime": value}, self.tzinfo).timestamp()
+
+  def _span(self, event):
+    if event["id"] in self.times:
+      return self.times[event["id"]]
+    return (date_utils.event_time(event["start"], self.tzinfo).timestamp(),
+            date_utils.event_time(event["end"], self.tzinfo).timestamp())
+
+  def _expand(self, items, timeMin, timeMax):
+    """Instances of the recurring events, as the API lists with singleEvents.
+    """
+    default_start, default_end = recurrence_utils.default_window(self.tzinfo)
+    window_start = date_utils.event_time({"dateTime": timeMin}, self.tzinfo) if timeMin else default_start
+    window_end = date_utils.event_time({"dateTime": timeMax}, self.tzinfo) if timeMax else default_end
+    expanded = recurrence_utils.expand_events(items, window_start, window_end, self.tzinfo)
+    for event in expanded:
+      event.setdefault("status", "confirmed")
+    return expanded
+
+  def _list(self, calendarId, timeMin=None, timeMax=None, syncToken=None, orderBy=None,
+            showDeleted=False, pageToken=None, maxResults=250, fields=None, **kwargs):
+    with self._lock:
+      self.calls["list"] += 1
+      events = self.calendars[calendarId]
+      if syncToken is not None:
+        if not syncToken.isdigit() or int(syncToken) > len(self.changes):
+          raise _http_error(410, "Gone")
+        changed = dict.fromkeys(event_id for seq, cal, event_id in self.changes[int(syncToken):]
+                                if cal == calendarId)
+        items = [events[event_id] for event_id in changed]
+      else:
+        items = list(events.values())
+        if kwargs.get("singleEvents") and any(event.get("recurrence") for event in items):
+          items = self._expand(items, timeMin, timeMax)
+        items = [event for event in items if showDeleted or event["status"] != "cancelled"]
+        if timeMin is not None or timeMax is not None:
+          time_min = self._time(timeMin) if timeMin else None
+          time_max = self._time(timeMax) if timeMax else None
+          # a series is listed if it starts before timeMax, whenever it ends
+          items = [event for event in items
+                   if (time_max is None or self._span(event)[0] < time_max)
+                   and (time_min is None or event.get("recurrence") or self._span(event)[1] > time_min)]
+        if orderBy == "startTime":
+          items.sort(key=lambda event: self._span(event)[0])
+      sync_token = str(len(self.changes))
+
+    offset = int(pageToken or 0)
+    # callers get their own copies, as from the API
+    page = {"items": [copy.deepcopy(_partial(item, fields)) for item in items[offset:offset + maxResults]]}
+    if offset + maxResults < len(items):
+      page["nextPageToken"] = str(offset + maxResults)
+    else:
+      page["nextSyncToken"] = sync_token
+    return page
+
+  def list(self, calendarId="primary", **kwargs):
+    kwargs = {k: v for k, v in kwargs.items() if v is not None}
+    return self._request("list", lambda: self._list(calendarId, **kwargs))
+
+  def _insert(self, calendarId, body):
+    with self._lock:
+      self.calls["insert"] += 1
+      event = copy.deepcopy(body)
+      # client-chosen ids are kept, and taken only once, like the API does
+      if event.get("id") in self.calendars[calendarId]:
+        raise _http_error(409, "The requested identifier already exists.")
+      return copy.deepcopy(self._store(calendarId, event))
+
+  def insert(self, calendarId="primary", body=None, **kwargs):
+    return self._request("insert", lambda: self._insert(calendarId, body))
+
+  def _get(self, calendarId, eventId):
+    with self._lock:
+      self.calls["get"] += 1
+      if eventId not in self.calendars[calendarId]:
+        raise _http_error(404, "Not Found")
+      return copy.deepcopy(self.calendars[calendarId][eventId])
+
+  def get(self, calendarId="primary", eventId=None, **kwargs):
+    return self._request("get", lambda: self._get(calendarId, eventId))
+
+  def _patch(self, calendarId, eventId, body):
+    with self._lock:
+      self.calls["patch"] += 1
+      if eventId not in self.calendars[calendarId]:
+        raise _http_error(404, "Not Found")
+      event = dict(self.calendars[calendarId][eventId], **copy.deepcopy(body))
+      return copy.deepcopy(self._store(calendarId, event))
+
+  def patch(self, calendarId="primary", eventId=None, body=None, **kwargs):
+    return self._request("patch", lambda: self._patch(calendarId, eventId, body))
+
+  def delete(self, calendarId="primary", eventId=None, **kwargs):
+    return self._request("delete", lambda: self._patch(calendarId, eventId, {"status": "cancelled"}) and None)
+
+
+class FakeFreebusyResource:
+  """In-memory `service.freebusy()`: merged busy intervals per calendar.
+  """
+  def __init__(self, events_resource):
+    self.events_resource = events_resource
+
+  def _query(self, body):
+    resource = self.events_resource
+    time_min = resource._time(body["timeMin"])
+    time_max = resource._time(body["timeMax"])
+    calendars = {}
+    with resource._lock:
+      resource.calls["freebusy"] += 1
+      for item in body.get("items", []):
+        if item["id"] not in resource.calendars:
+          calendars[item["id"]] = {"errors": [{"domain": "global", "reason": "notFound"}], "busy": []}
+          continue
+        intervals = sorted(resource.times[event["id"]] for event in resource.calendars[item["id"]].values()
+                           if event["status"] != "cancelled" and event.get("transparency") != "transparent")
+        busy = []
+        for start, end in intervals:
+          start, end = max(start, time_min), min(end, time_max)
+          if start >= end:
+            continue
+          if busy and start <= busy[-1][1]:
+            busy[-1][1] = max(busy[-1][1], end)
+          else:
+            busy.append([start, end])
+        calendars[item["id"]] = {"busy": [
+          {"start": datetime.datetime.fromtimestamp(start, datetime.timezone.utc).isoformat().replace("+00:00", "Z"),
+           "end": datetime.datetime.fromtimestamp(end, datetime.timezone.utc).isoformat().replace("+00:00", "Z")}
+          for start, end in busy]}
+    return {"kind": "calendar#freeBusy", "timeMin": body["timeMin"], "timeMax": body["timeMax"],
+            "calendars": calendars}
+
+  def query(self, body=None, **kwargs):
+    return FakeRequest(lambda: self._query(body), self.events_resource.latency)
+
+
+class FakeCalendarService:
+  """Drop-in for the googleapiclient Calendar service.
+
+  events seeds calendarId; calendars optionally seeds more, as
+  {calendarId: events}.
+  """
+  def __init__(self, events=(), calendarId="primary", latency=0.0, timezone="Asia/Seoul", calendars=None):
+    self._events = FakeEventsResource(events, calendarId=calendarId, latency=latency, timezone=timezone)
+    for other_id, other_events in (calendars or {}).items():
+      for event in other_events:
+        self._events._store(other_id, copy.deepcopy(event))
+    self._freebusy = FakeFreebusyResource(self._events)
+
+  def events(self):
+    return self._events
+
+  def freebusy(self):
+    return self._freebusy
+
+
+def generate_events(n, start=None, days=30, timezone="Asia/Seoul", seed=0, recurring=0):
+  """n synthetic events spread over `days` days from start (default today),
+  with a mix of timed and all-day events, locations and attendees, plus
+  `recurring` endless daily or weekly series that began a year earlier.
+  """
+  rng = random.Random(seed)
+  tzinfo = date_utils.get_tzinfo(timezone)
+  start = start or date_utils.today_in(timezone)
+  events = []
+  for i in range(n):
+    day = start + datetime.timedelta(days=rng.randrange(days))
+    event = {"summary": f"Event {i}", "organizer": {"email": "me@example.com"}}
+    if rng.random() < 0.05:
+      event["start"] = {"date": day.isoformat()}
+      event["end"] = {"date": (day + datetime.timedelta(days=1)).isoformat()}
+    else:
+      begin = datetime.datetime.combine(day, datetime.time(rng.randrange(8, 20), rng.choice([0, 30])),
+                                        tzinfo=tzinfo)
+      end = begin + datetime.timedelta(minutes=rng.choice([30, 60, 90, 120]))
+      event["start"] = {"dateTime": begin.isoformat(), "timeZone": timezone}
+      event["end"] = {"dateTime": end.isoformat(), "timeZone": timezone}
+    if rng.random() < 0.5:
+      event["location"] = f"Room {rng.randrange(100, 500)}"
+    if rng.random() < 0.3:
+      event["attendees"] = [{"email": f"user{rng.randrange(50)}@example.com"}
+                            for _ in range(rng.randrange(1, 4))]
+    events.append(event)
+  for i in range(recurring):
+    day = start - datetime.timedelta(days=365 - rng.randrange(7))
+    begin = datetime.datetime.combine(day, datetime.time(rng.randrange(8, 20)), tzinfo=tzinfo)
+    rule = rng.choice(["RRULE:FREQ=DAILY;BYDAY=MO,TU,WE,TH,FR", "RRULE:FREQ=WEEKLY"])
+    events.append({"summary": f"Series {i}", "organizer": {"email": "me@example.com"},
+                   "start": {"dateTime": begin.isoformat(), "timeZone": timezone},
+                   "end": {"dateTime": (begin + datetime.timedelta(minutes=30)).isoformat(), "timeZone": timezone},
+                   "recurrence": [rule]})
+  return events
@@ -0,0 +1,280 @@
+import copy
+import random
+import sys
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+# HTTP statuses worth retrying: timeouts, rate limits and server errors
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+# the ones that mean the request was turned away before it did anything
+RATE_LIMIT_STATUSES = {429}
+
+
+def _status_and_headers(error):
+  resp = getattr(error, "resp", None)
+  if resp is not None:
+    # googleapiclient HttpError; resp is an httplib2.Response (a dict of headers)
+    return int(resp.status), resp
+  response = getattr(error, "response", None)
+  # openai.APIStatusError
+  return getattr(error, "status_code", None), getattr(response, "headers", None) or {}
+
+
+def retry_after(error):
+  """Seconds the server asked to wait before retrying, if it said.
+  """
+  _, headers = _status_and_headers(error)
+  value = headers.get("retry-after-ms")
+  if value is not None:
+    try:
+      return float(value) / 1000
+    except ValueError:
+      pass
+  value = headers.get("retry-after")
+  if value is None:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  import email.utils
+  try:
+    return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+  except (TypeError, ValueError):
+    return None
+
+
+def is_rate_limited(error):
+  """Whether error is a rate limit, which rejects a request without running it.
+  """
+  status, _ = _status_and_headers(error)
+  if status in RATE_LIMIT_STATUSES:
+    return True
+  # Calendar reports per-user rate limits as 403 rateLimitExceeded
+  return status == 403 and "rate limit" in str(getattr(error, "reason", "")).lower()
+
+
+def is_retryable(error, idempotent=True):
+  """Whether error is transient: a rate limit, a server error or a dropped
+  connection, from either OpenAI or Google Calendar.
+
+  A call that is not idempotent may have taken effect when it timed out or
+  failed with a server error, so for it only rate limits count.
+  """
+  if is_rate_limited(error):
+    return True
+  if not idempotent:
+    return False
+  if isinstance(error, (ConnectionError, TimeoutError)):
+    return True
+  # openai is imported with the first OpenAI client; an error of it implies it is loaded
+  openai = sys.modules.get("openai")
+  if openai is not None and isinstance(error, openai.APIConnectionError):
+    return True
+  status, _ = _status_and_headers(error)
+  return status in RETRY_STATUSES
+
+
+class TokenBucket:
+  """Allows `rate` calls per second on average and bursts of `burst`.
+  """
+  def __init__(self, rate, burst=None):
+    self.rate = rate
+    self.capacity = burst if burst is not None else max(1.0, rate)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self._lock = threading.Lock()
+
+  def reserve(self):
+    """Takes a token and returns the seconds to wait before using it.
+    """
+    with self._lock:
+      now = time.monotonic()
+      self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      self.tokens -= 1
+      return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class _Flight:
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+
+class Governor:
+  """Shared limits on the calls to OpenAI and Google Calendar.
+
+  Calls are keyed like "openai:<model>" or "calendar:<calendarId>". Each key
+  gets its own token bucket, at the rate given for the key or for its prefix
+  in `rates` ({key: rate} or {key: (rate, burst)}); unlisted keys are not
+  rate limited. At most `max_concurrency` calls of a prefix run at once.
+  Transient failures (see is_retryable) are retried up to `max_retries`
+  times with jittered exponential backoff, waiting at least as long as the
+  server's Retry-After. Calls made with idempotent=False (inserts, paid LLM
+  completions) are retried on rate limits only.
+  """
+  def __init__(self, rates=None, max_concurrency=16, max_retries=4, base_delay=0.5, max_delay=30.0):
+    self.rates = dict(rates or {})
+    self.max_concurrency = max_concurrency
+    self.max_retries = max_retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self._lock = threading.Lock()
+    self._buckets = {}
+    self._semaphores = {}
+    self._async_semaphores = weakref.WeakKeyDictionary()  # event loop -> {prefix: Semaphore}
+    self._flights = {}
+    self.stats = defaultdict(lambda: {"calls": 0, "retries": 0, "failures": 0,
+                                      "throttled_seconds": 0.0, "coalesced": 0})
+
+  @staticmethod
+  def _prefix(key):
+    return key.split(":", 1)[0]
+
+  def _bucket(self, key):
+    with self._lock:
+      if key not in self._buckets:
+        rate = self.rates.get(key, self.rates.get(self._prefix(key)))
+        if isinstance(rate, tuple):
+          self._buckets[key] = TokenBucket(*rate)
+        else:
+          self._buckets[key] = TokenBucket(rate) if rate else None
+      return self._buckets[key]
+
+  def _semaphore(self, key):
+    with self._lock:
+      prefix = self._prefix(key)
+      if prefix not in self._semaphores:
+        self._semaphores[prefix] = threading.BoundedSemaphore(self.max_concurrency)
+      return self._semaphores[prefix]
+
+  def _async_semaphore(self, key):
+    import asyncio
+    loop = asyncio.get_running_loop()
+    with self._lock:
+      semaphores = self._async_semaphores.setdefault(loop, {})
+      prefix = self._prefix(key)
+      if prefix not in semaphores:
+        semaphores[prefix] = asyncio.Semaphore(self.max_concurrency)
+      return semaphores[prefix]
+
+  def _record(self, key, **counts):
+    with self._lock:
+      stats = self.stats[self._prefix(key)]
+      for name, n in counts.items():
+        stats[name] += n
+
+  def _throttle_delay(self, key):
+    bucket = self._bucket(key)
+    delay = bucket.reserve() if bucket is not None else 0.0
+    if delay:
+      self._record(key, throttled_seconds=delay)
+    return delay
+
+  def backoff(self, attempt, error):
+    """Seconds to wait before retry number attempt + 1 of a call that failed with error.
+    """
+    delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+    hint = retry_after(error)
+    if hint is not None:
+      delay = max(delay, min(hint, self.max_delay))
+    return delay
+
+  def _should_retry(self, key, attempt, error, idempotent=True):
+    if attempt < self.max_retries and is_retryable(error, idempotent):
+      self._record(key, retries=1)
+      return True
+    self._record(key, failures=1)
+    return False
+
+  def call(self, key, fn, *args, idempotent=True, **kwargs):
+    """Runs fn(*args, **kwargs) within the limits of key, retrying transient
+    errors; only rate limits unless the call is idempotent.
+    """
+    self._record(key, calls=1)
+    attempt = 0
+    while True:
+      delay = self._throttle_delay(key)
+      if delay:
+        time.sleep(delay)
+      try:
+        with self._semaphore(key):
+          return fn(*args, **kwargs)
+      except Exception as error:
+        if not self._should_retry(key, attempt, error, idempotent):
+          raise
+        time.sleep(self.backoff(attempt, error))
+        attempt += 1
+
+  async def acall(self, key, fn, *args, idempotent=True, **kwargs):
+    """Like call, for a coroutine function fn.
+    """
+    # asyncio is only imported by the async chatbot, keep it off the sync start-up path
+    import asyncio
+    self._record(key, calls=1)
+    attempt = 0
+    while True:
+      delay = self._throttle_delay(key)
+      if delay:
+        await asyncio.sleep(delay)
+      try:
+        async with self._async_semaphore(key):
+          return await fn(*args, **kwargs)
+      except Exception as error:
+        if not self._should_retry(key, attempt, error, idempotent):
+          raise
+        await asyncio.sleep(self.backoff(attempt, error))
+        attempt += 1
+
+  def single_flight(self, key, query, fn):
+    """Runs fn() once for all the threads asking the same query of key at the
+    same time. The first caller gets the result, the others a deep copy of it.
+    """
+    with self._lock:
+      flight = self._flights.get((key, query))
+      leader = flight is None
+      if leader:
+        flight = self._flights[key, query] = _Flight()
+    if not leader:
+      flight.done.wait()
+      self._record(key, coalesced=1)
+      if flight.error is not None:
+        raise flight.error
+      return copy.deepcopy(flight.result)
+    try:
+      flight.result = fn()
+      return flight.result
+    except BaseException as error:
+      flight.error = error
+      raise
+    finally:
+      with self._lock:
+        del self._flights[key, query]
+      flight.done.set()
+
+
+_default_governor = None
+_default_governor_lock = threading.Lock()
+
+
+def get_governor():
+  """The process-wide Governor, shared by every chatbot and Calendar call.
+  """
+  global _default_governor
+  with _default_governor_lock:
+    if _default_governor is None:
+      _default_governor = Governor()
+    return _default_governor
+
+
+def configure(**kwargs):
+  """Replaces the process-wide Governor, e.g. configure(rates={"calendar": 10}).
+  """
+  global _default_governor
+  with _default_governor_lock:
+    _default_governor = Governor(**kwargs)
+    return _default_governor
@@ -0,0 +1,134 @@
+import math
+import re
+from collections import defaultdict, deque
+
+try:
+  import tiktoken
+  _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken is optional
+  _ENCODING = None
+
+# Tokens added per message by the chat format (role, separators)
+MESSAGE_OVERHEAD = 4
+
+# How many past turns each prompt stage sees; None means all within the budget.
+# The task stages carry everything they need in their own prompt.
+STAGE_TURNS = {
+  "intent": 0,
+  "detect_date": 0,
+  "add_calendar": 0,
+  "summarize": 0,
+  "analysis": 0,
+  "schedule": 0,
+  "subtasks": 0,
+  "chat": None,
+}
+
+
+def estimate_tokens(text):
+  """Token count of text with tiktoken if installed, else ~4 characters per token.
+  """
+  if not text:
+    return 0
+  if _ENCODING is not None:
+    return len(_ENCODING.encode(text))
+  return math.ceil(len(text) / 4)
+
+
+def _content(message):
+  if isinstance(message, dict):
+    return message.get("content") or ""
+  return getattr(message, "content", None) or ""
+
+
+def count_message_tokens(messages):
+  return sum(MESSAGE_OVERHEAD + estimate_tokens(_content(m)) for m in messages)
+
+
+def cached_tokens(usage):
+  """Prompt tokens the API served from its prompt cache, None if not reported.
+  """
+  details = getattr(usage, "prompt_tokens_details", None)
+  return getattr(details, "cached_tokens", None)
+
+
+class HistoryManager:
+  """Conversation history bounded by a token budget.
+
+  Only the user's utterances and the assistant's replies are kept, not the
+  stage prompts. When the turns exceed `max_tokens`, the oldest are evicted
+  and folded into a short local summary that is sent ahead of the turns.
+  """
+  def __init__(self, max_tokens=1500, summary_tokens=200, stage_turns=STAGE_TURNS):
+    self.max_tokens = max_tokens
+    self.summary_tokens = summary_tokens
+    self.stage_turns = stage_turns
+    self.turns = []
+    self.summary = ""
+    self._tokens = 0
+
+  def add(self, role, content):
+    message = {"role": role, "content": content or ""}
+    self.turns.append(message)
+    self._tokens += count_message_tokens([message])
+    self._trim()
+
+  def add_turn(self, user_text, reply):
+    self.add("user", user_text)
+    self.add("assistant", reply)
+
+  def _trim(self):
+    while self._tokens > self.max_tokens and len(self.turns) > 1:
+      message = self.turns.pop(0)
+      self._tokens -= count_message_tokens([message])
+      self._fold(message)
+
+  def _fold(self, message):
+    # keep the first sentence of each evicted message
+    first = re.split(r"(?<=[.?!])\s|\n", message["content"].strip(), maxsplit=1)[0]
+    self.summary = f"{self.summary} {message['role']}: {first}".strip()
+    max_chars = self.summary_tokens * 4
+    if len(self.summary) > max_chars:
+      self.summary = "..." + self.summary[-max_chars:]
+
+  def context(self, stage):
+    """Messages to send ahead of the prompt of the given stage.
+    """
+    n = self.stage_turns.get(stage, 0)
+    if n == 0:
+      return []
+    turns = self.turns if n is None else self.turns[-n:]
+    if self.summary and (n is None or n >= len(self.turns)):
+      return [{"role": "system", "content": f"Earlier in this conversation: {self.summary}"}] + list(turns)
+    return list(turns)
+
+  def clear(self):
+    self.turns = []
+    self.summary = ""
+    self._tokens = 0
+
+
+class TokenCounter:
+  """Per-stage prompt token counts of each LLM call.
+
+  Records the local estimate and, when the response carries it, the
+  `usage.prompt_tokens` reported by the API and how many of them were
+  served from its prompt cache. `calls` keeps the most recent calls as
+  (stage, estimated, reported, cached) tuples.
+  """
+  def __init__(self, max_calls=1000):
+    self.calls = deque(maxlen=max_calls)
+    self.stats = defaultdict(lambda: {"calls": 0, "estimated_prompt_tokens": 0, "prompt_tokens": 0,
+                                      "cached_prompt_tokens": 0})
+
+  def record(self, stage, messages, usage=None):
+    estimated = count_message_tokens(messages)
+    reported = getattr(usage, "prompt_tokens", None)
+    cached = cached_tokens(usage)
+    stats = self.stats[stage]
+    stats["calls"] += 1
+    stats["estimated_prompt_tokens"] += estimated
+    stats["prompt_tokens"] += reported or 0
+    stats["cached_prompt_tokens"] += cached or 0
+    self.calls.append((stage, estimated, reported, cached))
+    return estimated
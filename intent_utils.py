@@ -0,0 +1,170 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+
+
+# Few-shot examples shared by the LLM intent prompt and the local classifier.
+# (1) Summarize events in the calendar. (2) Add an event to the calender.
+# (3) Plan tasks and add multiple events to the calendar.
+INTENT_EXAMPLES = {
+  '1': [
+    "I want to see a list of schedule for today.",
+    "What's my schedule on 12/24/2023?",
+  ],
+  '2': [
+    "Can you add a meeting with my ConvAI teammates this Friday at 4PM?. The location is Building 942 Room 308.",
+    "I have a meeting with Selena Gomez tomorrow at 2PM. Please create a schedule.",
+  ],
+  '3': [
+    "I have a conference talk next Thursday. Can you plan what I should do to prepare for it?",
+    "I have a computing 2 homework due on 11/30. Create a study schedule for me.",
+    "Can you help me plan for a paper submission due 12/1?",
+  ],
+}
+
+# (intent, pattern, weight)
+DEFAULT_RULES = [
+  ('1', r"\b(what('s| is| are)|show|see|list|check|tell me|summari[sz]e)\b.*\b(schedules?|calendar|events?|agenda|plans?)\b", 3.0),
+  ('1', r"\b(am i|do i have)\b.*\b(free|busy|anything|schedules?|meetings?|events?)\b", 2.0),
+  ('1', r"\blist of schedule", 2.0),
+  ('2', r"\b(add|put|book|register|insert|set up|create)\b.*\b(event|meeting|appointment|call|schedule|calendar)\b", 3.0),
+  ('2', r"\b(at|from) \d{1,2}(:\d{2})? ?(am|pm)\b", 1.0),
+  ('3', r"\b(plan|planning|prepare|preparation|study schedule|subtasks?|detailed tasks?|divide|break (it )?down)\b", 4.0),
+  ('3', r"\b(due|deadline|submission)\b", 2.0),
+]
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+  return TOKEN_PATTERN.findall(text.lower())
+
+
+class TfidfIntentModel:
+  """Small TF-IDF nearest-centroid model (linear in tf-idf space).
+  """
+  def __init__(self, idf=None, centroids=None):
+    self.idf = idf or {}
+    self.centroids = centroids or {}
+
+  def fit(self, examples=INTENT_EXAMPLES):
+    docs = [(intent, tokenize(text)) for intent, texts in examples.items() for text in texts]
+    df = Counter()
+    for _, tokens in docs:
+      df.update(set(tokens))
+    n_docs = len(docs)
+    self.idf = {t: math.log((1 + n_docs) / (1 + c)) + 1 for t, c in df.items()}
+
+    self.centroids = {}
+    for intent in examples:
+      centroid = Counter()
+      for doc_intent, tokens in docs:
+        if doc_intent == intent:
+          centroid.update(self._vectorize(tokens))
+      self.centroids[intent] = self._normalize(centroid)
+    return self
+
+  def _vectorize(self, tokens):
+    tf = Counter(t for t in tokens if t in self.idf)
+    return self._normalize({t: c * self.idf[t] for t, c in tf.items()})
+
+  @staticmethod
+  def _normalize(vector):
+    norm = math.sqrt(sum(v * v for v in vector.values()))
+    if norm == 0:
+      return dict(vector)
+    return {k: v / norm for k, v in vector.items()}
+
+  def predict_proba(self, text, temperature=0.1):
+    vector = self._vectorize(tokenize(text))
+    if not vector:
+      return {}
+    sims = {intent: sum(w * centroid.get(t, 0.0) for t, w in vector.items())
+            for intent, centroid in self.centroids.items()}
+    exps = {intent: math.exp(s / temperature) for intent, s in sims.items()}
+    total = sum(exps.values())
+    return {intent: e / total for intent, e in exps.items()}
+
+  def save(self, path):
+    with open(path, "w") as f:
+      json.dump({"idf": self.idf, "centroids": self.centroids}, f)
+
+  @classmethod
+  def load(cls, path):
+    with open(path) as f:
+      data = json.load(f)
+    return cls(idf=data["idf"], centroids=data["centroids"])
+
+
+class IntentClassifier:
+  """Local intent classifier run ahead of the LLM intent prompt.
+
+  `classify` returns (intent, confidence). intent is None when the
+  confidence is below `threshold`, meaning the caller should ask the LLM.
+  """
+  def __init__(self,
+               threshold=0.7,
+               rules=DEFAULT_RULES,
+               model=None,
+               model_path=None,
+               model_weight=2.0,
+               smoothing=1.0):
+    self.threshold = threshold
+    self.rules = [(intent, re.compile(pattern, re.IGNORECASE), weight)
+                  for intent, pattern, weight in rules]
+    self.model_weight = model_weight
+    self.smoothing = smoothing
+
+    if model is None and model_path is not None:
+      if os.path.exists(model_path):
+        model = TfidfIntentModel.load(model_path)
+      else:
+        model = TfidfIntentModel().fit()
+        model.save(model_path)
+    self.model = model
+
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.stats = {
+      "calls": 0,
+      "local_hits": 0,
+      "fallbacks": 0,
+      "by_intent": Counter(),
+      # confidence histogram in 0.1-wide buckets
+      "confidence_histogram": [0] * 10,
+    }
+
+  @property
+  def hit_rate(self):
+    if self.stats["calls"] == 0:
+      return 0.0
+    return self.stats["local_hits"] / self.stats["calls"]
+
+  def scores(self, text):
+    scores = {'1': 0.0, '2': 0.0, '3': 0.0}
+    for intent, pattern, weight in self.rules:
+      if pattern.search(text):
+        scores[intent] += weight
+    if self.model is not None:
+      for intent, p in self.model.predict_proba(text).items():
+        scores[intent] += self.model_weight * p
+    return scores
+
+  def classify(self, text):
+    scores = self.scores(text)
+    total = sum(scores.values())
+    best = max(scores, key=scores.get)
+    confidence = scores[best] / (total + self.smoothing) if total > 0 else 0.0
+
+    self.stats["calls"] += 1
+    self.stats["confidence_histogram"][min(int(confidence * 10), 9)] += 1
+    if confidence < self.threshold:
+      self.stats["fallbacks"] += 1
+      return None, confidence
+
+    self.stats["local_hits"] += 1
+    self.stats["by_intent"][best] += 1
+    return best, confidence
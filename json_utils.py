@@ -0,0 +1,192 @@
+import ast
+import json
+import threading
+from collections import defaultdict
+
+
+class IncrementalArrayParser:
+  """Finds the objects of the first JSON array in text that arrives in pieces.
+
+  `feed` returns the text of the objects completed by the new text, so that a
+  plan like {"Tasks": [{...}, {...}]} can be acted on task by task while the
+  LLM is still generating the rest of it. Parsing the items is left to the
+  caller (e.g. extract_json), so that one bad item does not stop the rest.
+  """
+  def __init__(self):
+    self.buffer = ""
+    self.pos = 0
+    self.depth = 0
+    self.in_string = False
+    self.escape = False
+    self.array_depth = None  # depth inside the array, once it is found
+    self.item_start = None
+    self.done = False
+
+  def feed(self, text):
+    self.buffer += text
+    items = []
+    while self.pos < len(self.buffer) and not self.done:
+      char = self.buffer[self.pos]
+      if self.in_string:
+        if self.escape:
+          self.escape = False
+        elif char == "\\":
+          self.escape = True
+        elif char == '"':
+          self.in_string = False
+      elif char == '"':
+        self.in_string = True
+      elif char in "[{":
+        if self.array_depth is None and char == "[":
+          self.array_depth = self.depth + 1
+        elif self.depth == self.array_depth and char == "{":
+          self.item_start = self.pos
+        self.depth += 1
+      elif char in "]}":
+        self.depth -= 1
+        if self.depth == self.array_depth and char == "}" and self.item_start is not None:
+          items.append(self.buffer[self.item_start:self.pos + 1])
+          self.item_start = None
+        elif self.array_depth is not None and self.depth < self.array_depth:
+          self.done = True
+      self.pos += 1
+    return items
+
+
+class JSONParseError(ValueError):
+  """Raised when no JSON value can be extracted or it does not match the schema.
+  `errors` lists what was wrong, for a targeted repair prompt.
+  """
+  def __init__(self, errors):
+    super().__init__("; ".join(errors))
+    self.errors = errors
+
+
+# Expected shape of the JSON reply of each stage. A type (or tuple of types)
+# matches with isinstance, a dict requires its keys ("?key" is optional) and
+# a one-item list matches a list whose items all match that item.
+STAGE_SCHEMAS = {
+  "detect_date": {"detected_phrase": str, "date": str, "date_after_date": str},
+  "add_calendar": {"summary": str, "startTime": str, "endTime": str, "timeZone": str,
+                   "?location": str, "?description": str, "?attendeesEmail": [str]},
+  # keys are lowercased before validation
+  "analysis": {"target task": str, "target time": str, "maximum number of detailed tasks": (str, int)},
+  "schedule": {"Tasks": [{"Task": str, "Start Time": str, "End Time": str, "timeZone": str}]},
+  # one task of a streamed schedule reply
+  "schedule_task": {"Task": str, "Start Time": str, "End Time": str, "timeZone": str},
+  "subtasks": {"Tasks": [{"Task": str, "Hours": (int, float, str)}]},
+  "summarize": {"schedule": [{"summary": str, "?start_time": str, "?Location": str, "?Participants": [(str, dict)]}]},
+  # items of a batch are checked on their own, so that one bad item does not fail the rest
+  "intent_batch": {"results": [{"id": int}]},
+  "detect_date_batch": {"results": [{"id": int}]},
+}
+
+
+def _candidates(text):
+  """Yields the top-level balanced {...} / [...] spans of text in one scan.
+  Braces inside single- or double-quoted strings are ignored.
+  """
+  closers = {"{": "}", "[": "]"}
+  stack = []
+  start = None
+  quote = None
+  escape = False
+  for i, char in enumerate(text):
+    if quote is not None:
+      if escape:
+        escape = False
+      elif char == "\\":
+        escape = True
+      elif char == quote:
+        quote = None
+    elif char in closers:
+      if not stack:
+        start = i
+      stack.append(closers[char])
+    elif not stack:
+      continue
+    elif char in "\"'":
+      quote = char
+    elif char in "}]":
+      if char != stack.pop():
+        # mismatched; drop this candidate
+        stack = []
+        continue
+      if not stack:
+        yield text[start:i + 1]
+  if stack:
+    raise JSONParseError(["the JSON is incomplete (it was cut off)"])
+
+
+def extract_json(text):
+  """The first JSON object or array in text, which may be wrapped in prose or
+  a ```json fence. Python-literal style (single quotes) is accepted too.
+  """
+  if text is None:
+    raise JSONParseError(["the reply is empty"])
+  found = False
+  try:
+    for candidate in _candidates(text):
+      found = True
+      try:
+        return json.loads(candidate)
+      except ValueError:
+        pass
+      try:
+        value = ast.literal_eval(candidate)
+      except (ValueError, SyntaxError, MemoryError, RecursionError):
+        continue
+      if isinstance(value, (dict, list)):
+        return value
+  except JSONParseError:
+    if not found:
+      raise
+  if found:
+    raise JSONParseError(["the reply is not valid JSON"])
+  raise JSONParseError(["the reply contains no JSON object"])
+
+
+def validate(value, schema, path="$"):
+  """Returns the list of places where value does not match schema.
+  """
+  if isinstance(schema, dict):
+    if not isinstance(value, dict):
+      return [f"{path} should be an object"]
+    errors = []
+    for key, subschema in schema.items():
+      optional = key.startswith("?")
+      key = key.lstrip("?")
+      if key not in value:
+        if not optional:
+          errors.append(f"{path} is missing \"{key}\"")
+        continue
+      errors += validate(value[key], subschema, f"{path}.{key}")
+    return errors
+  if isinstance(schema, list):
+    if not isinstance(value, list):
+      return [f"{path} should be a list"]
+    errors = []
+    for i, item in enumerate(value):
+      errors += validate(item, schema[0], f"{path}[{i}]")
+    return errors
+  if schema is None or isinstance(value, schema):
+    return []
+  names = " or ".join(t.__name__ for t in (schema if isinstance(schema, tuple) else (schema,)))
+  return [f"{path} should be {names}"]
+
+
+class ParseStats:
+  """Per-stage counts of JSON parse attempts, failures and repair requests.
+  """
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.stats = defaultdict(lambda: {"attempts": 0, "failures": 0, "repairs": 0, "repaired": 0})
+
+  def record(self, stage, **counts):
+    with self._lock:
+      for name, n in counts.items():
+        self.stats[stage][name] += n
+
+  def failure_rate(self, stage):
+    stats = self.stats[stage]
+    return stats["failures"] / stats["attempts"] if stats["attempts"] else 0.0
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+def _message_fields(message):
+  if isinstance(message, dict):
+    return message.get("role"), message.get("content")
+  # ChatCompletionMessage objects kept in the history by the chat fallback
+  return getattr(message, "role", None), getattr(message, "content", None)
+
+
+def normalize_messages(messages):
+  normalized = []
+  for message in messages:
+    role, content = _message_fields(message)
+    if isinstance(content, str):
+      content = re.sub(r"\s+", " ", content).strip()
+    normalized.append([role, content])
+  return normalized
+
+
+def cache_key(model, response_format, max_tokens, messages):
+  payload = json.dumps([model, response_format, max_tokens, normalize_messages(messages)],
+                       sort_keys=True, ensure_ascii=False)
+  return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _dump_response(response):
+  if hasattr(response, "model_dump_json"):
+    return response.model_dump_json()
+  return None
+
+
+def _load_response(body):
+  from openai.types.chat import ChatCompletion
+  return ChatCompletion.model_validate_json(body)
+
+
+class ResponseCache:
+  """Content-addressed cache of chat completion responses.
+
+  An in-memory LRU tier holds up to `max_entries` responses, an optional
+  SQLite tier at `disk_path` up to `max_disk_entries`. Entries expire after
+  `ttl` seconds. Only the stages listed in `stages` are cached; the free-form
+  "chat" fallback is cached only if listed explicitly.
+  """
+  def __init__(self,
+               stages=("intent", "detect_date"),
+               max_entries=1024,
+               ttl=3600,
+               disk_path=None,
+               max_disk_entries=100000):
+    self.stages = set(stages)
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.disk_path = disk_path
+    self.max_disk_entries = max_disk_entries
+
+    self._memory = OrderedDict()  # key -> (expires_at, response)
+    self._lock = threading.Lock()
+    self.stats = defaultdict(lambda: {"hits": 0, "misses": 0, "disk_hits": 0})
+
+    if disk_path is not None:
+      with self._connect() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS responses "
+                     "(key TEXT PRIMARY KEY, stage TEXT, expires_at REAL, body TEXT)")
+      conn.close()
+
+  def enabled_for(self, stage):
+    return stage in self.stages
+
+  def hit_rate(self, stage):
+    stats = self.stats[stage]
+    total = stats["hits"] + stats["misses"]
+    return stats["hits"] / total if total else 0.0
+
+  def _connect(self):
+    return sqlite3.connect(self.disk_path)
+
+  def get(self, stage, key):
+    now = time.time()
+    with self._lock:
+      entry = self._memory.get(key)
+      if entry is not None:
+        if entry[0] > now:
+          self._memory.move_to_end(key)
+          self.stats[stage]["hits"] += 1
+          return entry[1]
+        del self._memory[key]
+
+    if self.disk_path is not None:
+      conn = self._connect()
+      try:
+        row = conn.execute("SELECT expires_at, body FROM responses WHERE key = ?", (key,)).fetchone()
+      finally:
+        conn.close()
+      if row is not None and row[0] > now:
+        response = _load_response(row[1])
+        with self._lock:
+          self._put_memory(key, row[0], response)
+          self.stats[stage]["hits"] += 1
+          self.stats[stage]["disk_hits"] += 1
+        return response
+
+    with self._lock:
+      self.stats[stage]["misses"] += 1
+    return None
+
+  def _put_memory(self, key, expires_at, response):
+    self._memory[key] = (expires_at, response)
+    self._memory.move_to_end(key)
+    while len(self._memory) > self.max_entries:
+      self._memory.popitem(last=False)
+
+  def put(self, stage, key, response):
+    expires_at = time.time() + self.ttl
+    with self._lock:
+      entry = self._memory.get(key)
+      if entry is not None and entry[1] is response:
+        # a response just served from the cache
+        return
+      self._put_memory(key, expires_at, response)
+
+    body = _dump_response(response) if self.disk_path is not None else None
+    if body is not None:
+      conn = self._connect()
+      try:
+        with conn:
+          conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                       (key, stage, expires_at, body))
+          conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+          conn.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                       "ORDER BY expires_at DESC LIMIT -1 OFFSET ?)", (self.max_disk_entries,))
+      finally:
+        conn.close()
+
+  def clear(self):
+    with self._lock:
+      self._memory.clear()
+    if self.disk_path is not None:
+      conn = self._connect()
+      try:
+        with conn:
+          conn.execute("DELETE FROM responses")
+      finally:
+        conn.close()
@@ -0,0 +1,131 @@
+import threading
+import time
+
+
+class _Batch:
+  def __init__(self, asynchronous=False):
+    self.items = []
+    self.results = None
+    self.closed = False
+    if asynchronous:
+      import asyncio
+      self.full = asyncio.Event()
+      self.done = asyncio.Event()
+    else:
+      self.full = None
+      self.done = threading.Event()
+
+
+class MicroBatcher:
+  """Gathers the requests of the same kind that arrive within `max_wait`
+  seconds of each other, up to `max_batch_size` of them, so that they can be
+  sent as one LLM call.
+
+  The first caller of a batch leads it: it waits for the batch to fill or
+  for max_wait to pass, runs run(items) on its own thread (or task) and hands
+  each waiting caller its result. run returns the results in the order of
+  the items, None for an item it has no answer for. A caller gets None when
+  its item was alone in its batch, run raised or had no answer for it, and
+  then sends its request alone.
+
+  Keys (e.g. stage and model) decide which requests may share a batch. The
+  same key should not be used from both threads and coroutines.
+  """
+  def __init__(self, max_batch_size=8, max_wait=0.01):
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+    self._lock = threading.Lock()
+    self._cond = threading.Condition(self._lock)
+    self._open = {}
+    self.stats = {"batches": 0, "batched_items": 0, "alone": 0, "failed_batches": 0, "unanswered": 0}
+
+  def _join(self, key, item, asynchronous=False):
+    """Adds item to the open batch of key; returns (batch, index, leader).
+    """
+    with self._lock:
+      batch = self._open.get(key)
+      leader = batch is None
+      if leader:
+        batch = self._open[key] = _Batch(asynchronous)
+      batch.items.append(item)
+      if len(batch.items) >= self.max_batch_size:
+        self._close(key, batch)
+      return batch, len(batch.items) - 1, leader
+
+  def _close(self, key, batch):
+    # with self._lock held
+    if self._open.get(key) is batch:
+      del self._open[key]
+    batch.closed = True
+    if batch.full is not None:
+      batch.full.set()
+    self._cond.notify_all()
+
+  def _finish(self, batch, results, failed=False):
+    n = len(batch.items)
+    results = list(results or [])[:n]
+    results += [None] * (n - len(results))
+    with self._lock:
+      if n == 1:
+        self.stats["alone"] += 1
+      else:
+        self.stats["batches"] += 1
+        self.stats["batched_items"] += n
+        self.stats["failed_batches"] += failed
+        self.stats["unanswered"] += sum(result is None for result in results)
+    batch.results = results
+    batch.done.set()
+
+  def submit(self, key, item, run):
+    """Returns the result of item from run(items) of its batch, or None if
+    the caller should send it alone.
+    """
+    batch, index, leader = self._join(key, item)
+    if not leader:
+      batch.done.wait()
+      return batch.results[index]
+
+    deadline = time.monotonic() + self.max_wait
+    results, failed = None, False
+    try:
+      with self._cond:
+        while not batch.closed and deadline > time.monotonic():
+          self._cond.wait(deadline - time.monotonic())
+        self._close(key, batch)
+      if len(batch.items) > 1:
+        results = run(list(batch.items))
+    except Exception:
+      failed = True
+    finally:
+      # whatever happened, release the callers waiting on the batch
+      with self._lock:
+        self._close(key, batch)
+      self._finish(batch, results, failed)
+    return batch.results[index]
+
+  async def asubmit(self, key, item, run):
+    """Like submit, for a coroutine function run.
+    """
+    import asyncio
+    batch, index, leader = self._join(key, item, asynchronous=True)
+    if not leader:
+      await batch.done.wait()
+      return batch.results[index]
+
+    results, failed = None, False
+    try:
+      try:
+        await asyncio.wait_for(batch.full.wait(), self.max_wait)
+      except asyncio.TimeoutError:
+        pass
+      with self._lock:
+        self._close(key, batch)
+      if len(batch.items) > 1:
+        results = await run(list(batch.items))
+    except Exception:
+      failed = True
+    finally:
+      with self._lock:
+        self._close(key, batch)
+      self._finish(batch, results, failed)
+    return batch.results[index]
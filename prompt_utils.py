@@ -0,0 +1,290 @@
+import string
+import threading
+
+import history_utils
+import intent_utils
+
+
+class PromptTemplate:
+  """A stage prompt split into a static system message and a user message
+  template holding the fields that change from call to call.
+
+  The system message is the same for every call, so that it, and the
+  history after it, can be served from the provider's prompt cache; only
+  the user message at the end differs. `user` is a str.format template
+  whose fields are all required; it is parsed once here, not on each render.
+  """
+  def __init__(self, name, version, system, user):
+    self.name = name
+    self.version = version
+    self.system = system
+    self.user = user
+    self.system_message = {"role": "system", "content": system}
+    self.static_tokens = history_utils.count_message_tokens([self.system_message])
+    self._parts = [(literal, field) for literal, field, _, _ in string.Formatter().parse(user)]
+    self.fields = {field for _, field in self._parts if field is not None}
+
+  @property
+  def label(self):
+    return f"{self.name}@{self.version}"
+
+  def render(self, **fields):
+    """The user message with fields filled in.
+    """
+    missing = self.fields - fields.keys()
+    if missing:
+      raise KeyError(f"prompt {self.label} is missing {', '.join(sorted(missing))}")
+    return "".join(literal + (str(fields[field]) if field is not None else "") for literal, field in self._parts)
+
+
+class PromptRegistry:
+  """Versioned PromptTemplates by name.
+
+  `get` returns the latest version of a template unless another one is
+  pinned, e.g. to compare an edited prompt against the previous one.
+  """
+  def __init__(self, templates=()):
+    self._lock = threading.Lock()
+    self._templates = {}  # name -> {version: template}
+    self._pinned = {}
+    self._by_system = {}  # system text -> template
+    for template in templates:
+      self.register(template)
+
+  def register(self, template):
+    with self._lock:
+      self._templates.setdefault(template.name, {})[template.version] = template
+      self._by_system[template.system] = template
+    return template
+
+  def pin(self, name, version=None):
+    """Uses version of name from now on; None goes back to the latest.
+    """
+    with self._lock:
+      if version is None:
+        self._pinned.pop(name, None)
+      elif version not in self._templates.get(name, {}):
+        raise KeyError(f"no prompt {name}@{version}")
+      else:
+        self._pinned[name] = version
+
+  def get(self, name):
+    """The template in use for name, or None if there is none.
+    """
+    versions = self._templates.get(name)
+    if not versions:
+      return None
+    return versions[self._pinned.get(name, max(versions))]
+
+  def render(self, name, **fields):
+    return self.get(name).render(**fields)
+
+  def template_of(self, messages):
+    """The template whose system message starts messages, if any.
+    """
+    if not messages or messages[0].get("role") != "system":
+      return None
+    return self._by_system.get(messages[0].get("content"))
+
+
+def _intent_system():
+  system = ("Classify user intention as one of 1, 2, 3. The meaning of the indices are as follows."
+            "(1) Summarize events in the calendar. (2) Add an event to the calender. (3) Plan tasks and add multiple events to the calendar."
+            "If none, just say nothing.\n")
+  for intent, examples in intent_utils.INTENT_EXAMPLES.items():
+    system += f"Examples of ({intent}): \n"
+    system += "".join(f"{example}\n" for example in examples)
+  return system
+
+
+INTENT = PromptTemplate("intent", 1, _intent_system(), "{text}")
+
+ADD_CALENDAR = PromptTemplate("add_calendar", 1, """You are a sophisticated calendar management assistant,
+adept at organizing and managing calendar schedules for both simple and complex tasks.
+Your role involves integrating tasks into a user's calendar with precision and
+ensuring that all details are accurately reflected.
+
+For a task like "add meeting with Ryan Gosling tomorrow at 9 PM,"
+Output a json that can be used as a calendar create request.
+Follow the below format. Only return the json.
+
+Example
+Input: "Today is 2023/11/22. Add an event about dance in the moon light at LaLa Land with Ryan Gosling (ryangosling@example.com).
+It will take place next Tuesday from 9 am to 5 pm LA times."
+Output:
+{
+  "summary": "Dancing in the moonlight",
+  "location": "LaLa Land",
+  "description": "I plan to dance with Ryan Gosling in the yellow dress.",
+  "startTime": "2023-11-28T09:00:00-07:00",
+  "endTime": "2023-11-28T17:00:00-07:00",
+  "timeZone": "America/Los_Angeles",
+  "attendeesEmail": ["ryangosling@example.com"]
+}
+""", "The timezone is {timezone}\nToday is {today}\n\n{text}")
+
+DETECT_DATE = PromptTemplate("detect_date", 1, """Detect any time-related phrase from the given input from the user and resolve it into a date in the format of YYYY/MM/DD and the date after that day YYYY/MM/DD+1day.
+Examples include today, tomorrow, this Wednesday, next Tuesday, last Friday, 11/13, November 5th, 13th of July.
+When the detected word is day of week, make sure to include adjective in front of it such as "this", "next", "upcoming", "last", "past".
+
+
+Your output must be in JSON format. {"detected_phrase": <detected phrase>, "date": <YYYY/MM/DD>, "date_after_date": <YYYY/MM/DD>}
+
+
+Example 1
+Input: Today is 2023/1/2. ... I want to schedule a meeting at 5PM tomorrow.
+Output: {"detected_phrase": "tomorrow", "date": "2023/1/3", "date_after_date": "2023/1/4"}
+
+Example 2
+Input: Today is 2023/1/2. ... What time does the class start next Friday?
+Output: {"detected_phrase": "next Friday", "date": "2023/1/13", "date_after_date": "2023/1/14"}
+
+Example 3
+Input: Today is 2023/1/2. ... What is the date of this upcoming Friday?
+Output: {"detected_phrase": "this upcoming Friday", "date": "2023/1/6", "date_after_date": "2023/1/7"}
+""", "Input: Today is {today}. ... {text}")
+
+SUMMARIZE = PromptTemplate("summarize", 2, """You are a sophisticated calendar management assistant, adapt at organizing and managing calendar schedules for both simple and complex tasks.
+For a given day, check the user's Calendar input, which has a header line and then one line per event with its fields separated by "|", and output the agenda for the day in markdown using relevant emojis as bullet points.
+Your output must be in this format. Json("date": <YYYY/MM/DD>, "schedule": <schedule>, "start_time":<HH:MM>, "Location": <location>, "Participants":<participants>)
+Here's an example:
+
+Example 1
+Input: The given date is 2023-11-21. Which schedule do I have on the given day?
+Output: Schedule is Check-in at HyattRegency Seattle, Start time ⏰ is After 4:00 PM, Location is Hyatt Regency, Seattle, Participants are Sheryl Soo(sheryl@zapier.com), Mike Knoop (Knoop@zapier.com) and Going to Tacoma airport, Start time ⏰ is After 7:00 PM, Location is Seattle Tacoma International Airport
+
+Example 2
+Input: The given date is 2023-11-03. Which schedule do I have on the given day?
+Output: Schedule is Watching soccer game, Start time ⏰ is After 1:00 AM
+""", "Calendar input:\n{events}\n\nInput: The given date is {date}. {text}\n\nOutput:")
+
+POLISH = PromptTemplate("polish", 1, (
+  "You are a sophisticated calendar management assistant. "
+  "Rephrase the agenda below as an answer to the user's question in markdown, using relevant emojis as bullet points. "
+  "Do not add, drop or change any event, date, time, location or participant."
+), "Agenda:\n{agenda}\nQuestion: {text}")
+
+ANALYSIS = PromptTemplate("analysis", 1, """###Instruction: The assistant is an expert in analyzing conversations for schedule management. It takes the user's conversation as input and analyzes what tasks need to be done, by when, and how many detailed tasks the user desires. The assistant recognizes the user's conversation and performs accurate analysis.
+Output Goals:
+Target Task, Target Time, Maximum Number of Detailed Tasks
+
+Considerations:
+
+1. If the target task and target time are not clear in your analysis of the user's conversation, you must output a response stating, "Please suggest a target task or target time."
+2. If the maximum number of detailed tasks is not clear in your analysis of the user's conversation, set that number to 3.
+
+Please refer to the following examples for your response
+Example 1:
+Input: I need to complete a C++ programming assignment on matrix multiplication optimization within 3 days from today. Please divide it into 4 tasks for scheduling.
+Output(JSON type):
+"Target Task": "Completing a C++ programming assignment on matrix multiplication optimization",
+"Target Time": "3 days from today",
+"Maximum number of detailed tasks": "four"
+
+Example 2:
+Input: I need to select a paper on multi-task learning, familiarize myself with it, and then present it by next Monday.
+Output(JSON type):
+"Target Task": "Research and presentation on a multi-task learning paper",
+"Target Time": "Next Monday",
+"Maximum number of detailed tasks": "three"
+
+Example 3:
+Input: I need to coordinate our team's business trip schedule with another team and submit a report on the travel plan by next Wednesday. Please suggest a schedule divided into 5 detailed tasks.
+Output(JSON type):
+"Target Task": "Coordinating our team's business trip schedule with another team and writing a report on the travel plan",
+"Target Time": "Next Wednesday",
+"Maximum number of detailed tasks": "five"
+""", "###User Input:\n{text}")
+
+SCHEDULE = PromptTemplate("schedule", 1, """###Instruction : Please assist in optimized schedule management. As a 'Schedule Management Application', you act to suggest necessary tasks for work input by users, manage time effectively, and aid in overall productivity enhancement. The 'Schedule Management Application' performs the following roles for the "Target Task" and "Target Time" input by the user:
+
+Create the required subtasks for the 'Target Task'. Distribute the required subtasks for the 'Target Task' appropriately by 'Target Time'. Finally, the assistant outputs the distribution of detailed tasks by 'Target Time' in JSON format.
+
+Restrictions:
+1. Between 00:00:00 and 09:00:00 in Asia/Seoul time is sleep time and is excluded from schedule distribution.
+2. Asia/Seoul time between 12:00:00 and 13:00:00 is lunch time and is excluded from the schedule distribution.
+3. The period between 18:00:00 and 20:00:00 in Asia/Seoul time is dinner time and is excluded from the schedule distribution.
+4. Assistant only outputs JSON.
+5. You must strictly follow the json format presented in the example.
+6. Create as many detailed tasks as the suggested Maximum number of detailed tasks.
+Considerations:
+1. You must consider the entire duration of the given schedule and distribute tasks so that they are not concentrated on specific days. Be sure to not concentrate your work on a specific day or time.
+2. The time allotted for a single detailed tasks must be no more than 3 hours.
+
+Here is an example
+User Input:
+Today is 2023-11-21.
+Target Task: I need to select and present a paper on deep learning.
+Target Time: Next Monday.
+Maximum number of detailed task : five
+
+Assistant Output(Should be JSON format):
+{
+"Tasks": [
+{
+  "Task": "Selecting a Paper",
+  "Start Time": "2023-11-21T09:00:00",
+  "End Time": "2023-11-21T12:00:00",
+  "timeZone": "Asia/Seoul"
+},
+{
+  "Task": "Thoroughly Reading the Paper",
+  "Start Time": "2023-11-21T13:00:00",
+  "End Time": "2023-11-22T17:00:00",
+  "timeZone": "Asia/Seoul"
+},
+{
+  "Task": "Researching Background Information",
+  "Start Time": "2023-11-23T09:00:00",
+  "End Time": "2023-11-23T12:00:00",
+  "timeZone": "Asia/Seoul"
+},
+{
+  "Task": "Creating the Presentation",
+  "Start Time": "2023-11-23T13:00:00",
+  "End Time": "2023-11-24T17:00:00",
+  "timeZone": "Asia/Seoul"
+},
+{
+  "Task": "Rehearsing the Presentation",
+  "Start Time": "2023-11-25T09:00:00",
+  "End Time": "2023-11-26T17:00:00",
+  "timeZone": "Asia/Seoul"
+}
+]
+}
+""", "###User Input:\nToday is {today}.\n{analysis}")
+
+SUBTASKS = PromptTemplate("subtasks", 1, """###Instruction : Create the required subtasks for the 'Target Task' below, in the order they should be done, and estimate how many hours each one takes.
+Do not assign dates or times; they are scheduled separately.
+
+Restrictions:
+1. Assistant only outputs JSON in the format {"Tasks": [{"Task": <subtask name>, "Hours": <number of hours>}]}.
+2. Create as many detailed tasks as the suggested Maximum number of detailed tasks.
+3. A task that takes more than 3 hours is split into parts when scheduled.
+
+Here is an example
+User Input:
+Target Task: I need to select and present a paper on deep learning.
+Target Time: Next Monday.
+Maximum number of detailed task : three
+
+Assistant Output:
+{"Tasks": [{"Task": "Selecting a Paper", "Hours": 2}, {"Task": "Thoroughly Reading the Paper", "Hours": 5}, {"Task": "Creating the Presentation", "Hours": 4}]}
+""", "###User Input:\n{analysis}")
+
+# Several utterances of different conversations in one call, see micro_batcher.py.
+# `items` is a JSON list of {"id": <id>, "text": <utterance>}.
+INTENT_BATCH = PromptTemplate("intent_batch", 1, INTENT.system + """
+The input is a JSON list of separate user messages, each with an id. Classify the intention of each one on its own.
+Reply with only a JSON object {"results": [{"id": <id>, "intent": <"1", "2", "3" or "">}]} with one result for every id.
+""", "{items}")
+
+DETECT_DATE_BATCH = PromptTemplate("detect_date_batch", 1, DETECT_DATE.system + """
+The input is a JSON list of separate user messages, each with an id. Detect the phrase of each one on its own.
+Reply with only a JSON object {"results": [{"id": <id>, "detected_phrase": <detected phrase>, "date": <YYYY/MM/DD>, "date_after_date": <YYYY/MM/DD>}]} with one result for every id.
+""", "Today is {today}.\n{items}")
+
+# the prompts of CalendarChatGPT unless it is given another registry
+PROMPTS = PromptRegistry([INTENT, ADD_CALENDAR, DETECT_DATE, SUMMARIZE, POLISH, ANALYSIS, SCHEDULE, SUBTASKS,
+                          INTENT_BATCH, DETECT_DATE_BATCH])
@@ -0,0 +1,224 @@
+import bisect
+import datetime
+import zoneinfo
+
+from dateutil import rrule, tz
+
+import date_utils
+
+# How far ahead of today an endless series is materialized by default
+DEFAULT_HORIZON_DAYS = 366
+# and how far back
+DEFAULT_HISTORY_DAYS = 31
+
+
+def _zone(name):
+  # zoneinfo looks up UTC offsets many times faster than dateutil's tzfile
+  try:
+    return zoneinfo.ZoneInfo(date_utils.WINDOWS_TIMEZONES.get(name, name))
+  except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+    return date_utils.get_tzinfo(name)
+
+
+def _series_start(master, tzinfo):
+  """(dtstart, zone, all_day) of a recurring event.
+
+  Timed series recur in the wall-clock time of their own timeZone, so that a
+  9:00 meeting stays at 9:00 across daylight saving changes; all-day series
+  recur on naive dates.
+  """
+  start = master['start']
+  if 'dateTime' in start:
+    zone = _zone(start['timeZone']) if start.get('timeZone') else tzinfo
+    return date_utils.event_time(start, zone).astimezone(zone), zone, False
+  day = datetime.date.fromisoformat(start['date'])
+  return datetime.datetime(day.year, day.month, day.day), tzinfo, True
+
+
+def _rule_set(lines, dtstart):
+  text = "\n".join(lines)
+  try:
+    return rrule.rrulestr(text, dtstart=dtstart, forceset=True), dtstart.tzinfo
+  except ValueError:
+    # e.g. an UNTIL without "Z" on a timed series: expand in naive local time
+    return rrule.rrulestr(text, dtstart=dtstart.replace(tzinfo=None), forceset=True), None
+
+
+def _instance_id(event_id, start, all_day):
+  # the ids the API gives the instances of a series
+  if all_day:
+    return f"{event_id}_{start:%Y%m%d}"
+  return f"{event_id}_{start.astimezone(tz.UTC):%Y%m%dT%H%M%SZ}"
+
+
+def _time_dict(value, all_day, template):
+  if all_day:
+    return {'date': value.date().isoformat()}
+  result = {'dateTime': value.isoformat()}
+  if template.get('timeZone'):
+    result['timeZone'] = template['timeZone']
+  return result
+
+
+def _fixed_offset(value, zone):
+  value = value.replace(tzinfo=zone)
+  return value.replace(tzinfo=datetime.timezone(value.utcoffset()))
+
+
+def _instances(master, window_start, window_end, tzinfo):
+  """(start, end, instance) of the instances of master overlapping the
+  window, with start and end as timestamps.
+  """
+  dtstart, zone, all_day = _series_start(master, tzinfo)
+  duration = (date_utils.event_time(master['end'], zone) - date_utils.event_time(master['start'], zone))
+  rule, rule_tz = _rule_set(master['recurrence'], dtstart)
+
+  def local(value):
+    # window bound in the terms of the rule: naive wall-clock time if the rule is naive
+    value = value.astimezone(zone)
+    return value if rule_tz is not None else value.replace(tzinfo=None)
+
+  window_min, window_max = window_start.timestamp(), window_end.timestamp()
+  instances = []
+  for start in rule.between(local(window_start - duration), local(window_end), inc=True):
+    # pin each time to its UTC offset once: tzfile offset lookups are slow
+    start = _fixed_offset(start, zone)
+    end = _fixed_offset(start.replace(tzinfo=None) + duration, zone)
+    start_ts, end_ts = start.timestamp(), end.timestamp()
+    if end_ts <= window_min or start_ts >= window_max:
+      continue
+    instance = {k: v for k, v in master.items() if k != 'recurrence'}
+    instance['id'] = _instance_id(master.get('id'), start, all_day)
+    instance['recurringEventId'] = master.get('id')
+    instance['start'] = _time_dict(start, all_day, master['start'])
+    instance['end'] = _time_dict(end, all_day, master['end'])
+    instance['originalStartTime'] = dict(instance['start'])
+    instances.append((start_ts, end_ts, instance))
+  return instances
+
+
+def expand_event(master, window_start, window_end, tzinfo=None):
+  """Instances of a recurring event that overlap [window_start, window_end),
+  shaped like the events `events().list(singleEvents=True)` returns.
+
+  window_start/window_end are aware datetimes; tzinfo is the calendar's
+  time zone, used for all-day events and times without a zone.
+  """
+  return [instance for _, _, instance in _instances(master, window_start, window_end, tzinfo or tz.tzlocal())]
+
+
+def _timestamps(event, tzinfo):
+  return (date_utils.event_time(event['start'], tzinfo).timestamp(),
+          date_utils.event_time(event['end'], tzinfo).timestamp())
+
+
+def _version(master):
+  if master.get('etag') or master.get('updated'):
+    return master.get('etag'), master.get('updated')
+  return repr(master)
+
+
+def expand_entries(events, window_start, window_end, tzinfo=None, cache=None):
+  """(start, end, event) timestamps and events of a `singleEvents=False`
+  listing, with the recurring events replaced by their instances in the window.
+
+  Modified instances (events with recurringEventId and originalStartTime)
+  take the place of the instance they change, and cancelled ones remove it.
+  Cancelled and unreadable events are dropped; the rest are kept as they are.
+  `cache`, a dict kept by the caller, saves expanding unchanged series again
+  over the same window.
+  """
+  tzinfo = tzinfo or tz.tzlocal()
+  masters = []
+  exceptions = {}  # (series id, original start timestamp) -> event
+  entries = []
+  for event in events:
+    try:
+      if event.get('recurrence') and event.get('status') != 'cancelled':
+        masters.append(event)
+      elif event.get('recurringEventId') and 'originalStartTime' in event:
+        original = date_utils.event_time(event['originalStartTime'], tzinfo).timestamp()
+        exceptions[event['recurringEventId'], original] = event
+      elif event.get('status') != 'cancelled':
+        entries.append(_timestamps(event, tzinfo) + (event,))
+    except (KeyError, ValueError):
+      continue
+
+  for master in masters:
+    key = (master.get('id'), _version(master), window_start, window_end)
+    try:
+      if cache is not None and cache.get(master.get('id'), (None,))[0] == key:
+        instances = cache[master.get('id')][1]
+      else:
+        instances = _instances(master, window_start, window_end, tzinfo)
+        if cache is not None:
+          cache[master.get('id')] = (key, instances)
+    except (KeyError, ValueError):
+      # unreadable rule: keep the first occurrence rather than nothing
+      event = {k: v for k, v in master.items() if k != 'recurrence'}
+      entries.append(_timestamps(event, tzinfo) + (event,))
+      continue
+    for start, end, instance in instances:
+      exception = exceptions.pop((master.get('id'), start), None)
+      if exception is None:
+        entries.append((start, end, instance))
+      elif exception.get('status') != 'cancelled':
+        entries.append(_timestamps(exception, tzinfo) + (exception,))
+
+  # instances moved into the window from outside it
+  for event in exceptions.values():
+    if event.get('status') != 'cancelled':
+      try:
+        entries.append(_timestamps(event, tzinfo) + (event,))
+      except (KeyError, ValueError):
+        continue
+  return entries
+
+
+def expand_events(events, window_start, window_end, tzinfo=None):
+  """The events of expand_entries, like `events().list(singleEvents=True)`
+  would list them.
+  """
+  return [event for _, _, event in expand_entries(events, window_start, window_end, tzinfo)]
+
+
+def default_window(tzinfo=None, horizon_days=DEFAULT_HORIZON_DAYS, history_days=DEFAULT_HISTORY_DAYS):
+  """(start, end) around today that series are materialized over by default.
+  """
+  tzinfo = tzinfo or tz.tzlocal()
+  today = datetime.datetime.now(tzinfo).replace(hour=0, minute=0, second=0, microsecond=0)
+  return today - datetime.timedelta(days=history_days), today + datetime.timedelta(days=horizon_days)
+
+
+class EventIndex:
+  """Single events sorted by start time, with range queries by binary search.
+
+  Times are compared as UTC timestamps, so events written in different time
+  zones order correctly; all-day events span their days in `tzinfo`.
+  `entries` of (start, end, event), as from expand_entries, are used as
+  they are instead of parsing the times of events again.
+  """
+  def __init__(self, events=(), tzinfo=None, entries=None):
+    if entries is None:
+      tzinfo = tzinfo or tz.tzlocal()
+      entries = []
+      for event in events:
+        try:
+          entries.append(_timestamps(event, tzinfo) + (event,))
+        except (KeyError, ValueError):
+          continue
+    entries = sorted(entries, key=lambda entry: entry[:2])
+    self._entries = entries
+    self._starts = [entry[0] for entry in entries]
+    self._max_duration = max((end - start for start, end, _ in entries), default=0.0)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def query(self, time_min, time_max):
+    """Events overlapping [time_min, time_max) (timestamps), in start order.
+    """
+    # nothing starting earlier than the longest event can still be running
+    lo = bisect.bisect_left(self._starts, time_min - self._max_duration)
+    hi = bisect.bisect_left(self._starts, time_max)
+    return [event for start, end, event in self._entries[lo:hi] if end > time_min]
@@ -0,0 +1,56 @@
+import datetime
+from itertools import groupby
+
+import date_utils
+import event_record
+
+
+def _join(names):
+  if len(names) == 1:
+    return names[0]
+  return ", ".join(names[:-1]) + " and " + names[-1]
+
+
+def agenda_entries(event_list, timezone=None, first_day=None):
+  """Returns (day, start_text, record) for each event, sorted by start time.
+
+  event_list holds event_record.EventRecords or event dicts. Times are shown
+  in the given timezone; all-day events are shown as "All day". Events that
+  began before first_day are listed on first_day.
+  """
+  tzinfo = date_utils.get_tzinfo(timezone)
+  entries = []
+  for event in event_record.from_events(event_list, tzinfo):
+    start_time = event.start.astimezone(tzinfo)
+    all_day = event.all_day
+    day = start_time.date()
+    if first_day is not None and day < first_day:
+      day = first_day
+    start_text = "All day" if all_day else start_time.strftime("%H:%M")
+    entries.append((day, not all_day, start_time, start_text, event))
+  entries.sort(key=lambda x: (x[0], x[1], x[2]))
+  return [(day, start_text, event) for day, _, _, start_text, event in entries]
+
+
+def render_agenda(event_list, date_expression, date_min, timezone=None):
+  """Builds the agenda text for fetched events without calling the LLM.
+
+  date_min is the first day of the range ("YYYY-MM-DD..."); events are
+  grouped per day with emoji bullets, start time, location and participants.
+  """
+  first_day = datetime.date.fromisoformat(date_min[:10])
+  entries = agenda_entries(event_list, timezone=timezone, first_day=first_day)
+
+  output_string = "You have total {0} schedules for {1}, {2}.\n".format(len(entries), date_expression, date_min[:10])
+  i = 0
+  for day, day_entries in groupby(entries, key=lambda x: x[0]):
+    output_string += "📅 {0} ({1})\n".format(day.isoformat(), day.strftime("%a"))
+    for _, start_text, event in day_entries:
+      output_string += "🔹 schedule {0} is {1}. Start time ⏰ is {2}. ".format(i, event.summary or '(no title)', start_text)
+      if event.location:
+        output_string += "Location 📍 is {0}. ".format(event.location)
+      if event.attendees:
+        output_string += "Participants 👥 are {0}. ".format(_join(event.attendees))
+      output_string += '\n'
+      i += 1
+  return output_string
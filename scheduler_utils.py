@@ -0,0 +1,156 @@
+import bisect
+import datetime
+import math
+
+import event_record
+
+# Daily windows excluded from planning (sleep, lunch, dinner), local time
+DAILY_EXCLUSIONS = [
+  (datetime.time(0, 0), datetime.time(9, 0)),
+  (datetime.time(12, 0), datetime.time(13, 0)),
+  (datetime.time(18, 0), datetime.time(20, 0)),
+]
+MAX_TASK_HOURS = 3
+
+
+class BusyIndex:
+  """Sorted, merged busy intervals with bisect lookups.
+
+  Intervals are (start, end) POSIX timestamps. Adding an interval merges it
+  with the ones it overlaps, so `starts` and `ends` are both increasing.
+  """
+  def __init__(self, intervals=()):
+    self.starts = []
+    self.ends = []
+    merged = []
+    for start, end in sorted(intervals):
+      if end <= start:
+        continue
+      if merged and start <= merged[-1][1]:
+        merged[-1][1] = max(merged[-1][1], end)
+      else:
+        merged.append([start, end])
+    for start, end in merged:
+      self.starts.append(start)
+      self.ends.append(end)
+
+  def __len__(self):
+    return len(self.starts)
+
+  def add(self, start, end):
+    lo = bisect.bisect_left(self.ends, start)
+    hi = bisect.bisect_right(self.starts, end)
+    if lo < hi:
+      start = min(start, self.starts[lo])
+      end = max(end, self.ends[hi - 1])
+    self.starts[lo:hi] = [start]
+    self.ends[lo:hi] = [end]
+
+  def is_free(self, start, end):
+    i = bisect.bisect_right(self.starts, start) - 1
+    if i >= 0 and self.ends[i] > start:
+      return False
+    j = i + 1
+    return j >= len(self.starts) or self.starts[j] >= end
+
+  def find_slot(self, start, duration, limit):
+    """Earliest t >= start such that [t, t + duration) is free and ends by limit.
+    """
+    t = start
+    i = bisect.bisect_right(self.starts, t) - 1
+    if i >= 0 and self.ends[i] > t:
+      t = self.ends[i]
+    j = i + 1
+    while t + duration <= limit:
+      gap_end = self.starts[j] if j < len(self.starts) else limit
+      if gap_end - t >= duration:
+        return t
+      t = self.ends[j]
+      j += 1
+    return None
+
+
+def busy_intervals(event_list, tzinfo):
+  """(start, end) timestamps of the events (EventRecords or dicts) that block time.
+  """
+  return [(event.start.timestamp(), event.end.timestamp())
+          for event in event_record.from_events(event_list, tzinfo) if not event.transparent]
+
+
+def exclusion_intervals(first_day, last_day, tzinfo, exclusions=DAILY_EXCLUSIONS):
+  intervals = []
+  day = first_day
+  while day <= last_day:
+    for start, end in exclusions:
+      start_dt = datetime.datetime.combine(day, start, tzinfo=tzinfo)
+      end_dt = datetime.datetime.combine(day, end, tzinfo=tzinfo)
+      intervals.append((start_dt.timestamp(), end_dt.timestamp()))
+    day += datetime.timedelta(days=1)
+  return intervals
+
+
+def split_tasks(tasks, max_task_hours=MAX_TASK_HOURS):
+  """Splits (name, hours) tasks into chunks of at most max_task_hours.
+  """
+  chunks = []
+  for name, hours in tasks:
+    parts = max(1, math.ceil(hours / max_task_hours))
+    for part in range(parts):
+      chunk_name = name if parts == 1 else f"{name} (part {part + 1})"
+      chunks.append((chunk_name, hours / parts))
+  return chunks
+
+
+def schedule_tasks(tasks,
+                   event_list,
+                   start,
+                   deadline,
+                   tzinfo,
+                   timezone_name,
+                   exclusions=DAILY_EXCLUSIONS,
+                   max_task_hours=MAX_TASK_HOURS,
+                   busy=()):
+  """Places (name, hours) tasks in the free time between start and deadline.
+
+  Busy time is the calendar events, the (start, end) timestamps in busy
+  (e.g. from a freebusy query) and the daily exclusion windows. Tasks
+  keep their order, no task is longer than max_task_hours, and each task
+  starts no earlier than its share of the window so that work is spread
+  over the days instead of concentrated on the first one. Once a task does
+  not fit, it and every task after it are left unscheduled.
+
+  Returns (scheduled, unscheduled) lists of task dicts in the format of the
+  plan prompt ("Task", "Start Time", "End Time", "timeZone").
+  """
+  index = BusyIndex(busy_intervals(event_list, tzinfo) + list(busy) +
+                    exclusion_intervals(start.date(), deadline.date(), tzinfo, exclusions))
+  chunks = split_tasks(tasks, max_task_hours)
+
+  begin = start.timestamp()
+  limit = deadline.timestamp()
+  days = max(1, (deadline.date() - start.date()).days)
+  first_midnight = datetime.datetime.combine(start.date(), datetime.time(0), tzinfo=tzinfo)
+
+  scheduled = []
+  unscheduled = []
+  cursor = begin
+  for i, (name, hours) in enumerate(chunks):
+    duration = hours * 3600
+    target_day = first_midnight + datetime.timedelta(days=(i * days) // len(chunks))
+    earliest = max(cursor, begin, target_day.timestamp())
+    slot = index.find_slot(earliest, duration, limit)
+    if slot is None and earliest > cursor:
+      slot = index.find_slot(max(cursor, begin), duration, limit)
+    if slot is None:
+      # later tasks are not moved ahead of this one
+      unscheduled.extend({"Task": rest, "Hours": rest_hours} for rest, rest_hours in chunks[i:])
+      break
+    index.add(slot, slot + duration)
+    cursor = slot + duration
+    scheduled.append({
+      "Task": name,
+      "Start Time": datetime.datetime.fromtimestamp(slot, tzinfo).strftime("%Y-%m-%dT%H:%M:%S"),
+      "End Time": datetime.datetime.fromtimestamp(slot + duration, tzinfo).strftime("%Y-%m-%dT%H:%M:%S"),
+      "timeZone": timezone_name,
+    })
+  return scheduled, unscheduled
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+# the modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_backends  # noqa: E402
+
+
+@pytest.fixture
+def chat_client():
+  return fake_backends.ScriptedChatClient()
+
+
+@pytest.fixture
+def chatbot(chat_client, monkeypatch):
+  from chatbot_utils import CalendarChatGPT
+  monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+  return CalendarChatGPT(None, client=chat_client, service=fake_backends.FakeCalendarService(),
+                         timezone="Korean Standard Time")
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+
+import batch_runner
+import fake_backends
+from chatbot_utils import CalendarChatGPT
+
+TEXTS = ["What do I have tomorrow?", "Tell me a joke", "What do I have today?", "Hello there"]
+
+
+@pytest.fixture
+def make_chatbot(monkeypatch):
+  monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+  return lambda: CalendarChatGPT(None, client=fake_backends.ScriptedChatClient(),
+                                 service=fake_backends.FakeCalendarService(), timezone="Korean Standard Time")
+
+
+def write_lines(path, records):
+  path.write_text("".join(json.dumps(record) + "\n" for record in records), encoding="utf-8")
+
+
+def read_records(path):
+  return [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+
+
+def test_a_rerun_resumes_after_a_partial_run(tmp_path, make_chatbot):
+  input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+  write_lines(input_path, [{"request_id": f"r{i}", "text": text} for i, text in enumerate(TEXTS)])
+  # r0 finished, r1 failed and r2 was cut off in the middle of its line
+  write_lines(output_path, [{"request_id": "r0", "status": "ok"}, {"request_id": "r1", "status": "error"}])
+  with open(output_path, "a", encoding="utf-8") as f:
+    f.write('{"request_id": "r2", "sta')
+
+  counts = batch_runner.run_batch(str(input_path), str(output_path), make_chatbot, concurrency=2)
+  assert counts == {"ok": 2, "error": 0, "skipped": 2}
+  lines = output_path.read_text(encoding="utf-8").splitlines()
+  assert lines[2] == '{"request_id": "r2", "sta'
+  assert sorted(json.loads(line)["request_id"] for line in lines[3:]) == ["r2", "r3"]
+
+  counts = batch_runner.run_batch(str(input_path), str(output_path), make_chatbot, retry_errors=True)
+  assert counts == {"ok": 1, "error": 0, "skipped": 3}
+  assert json.loads(output_path.read_text(encoding="utf-8").splitlines()[-1])["request_id"] == "r1"
+
+
+def test_each_record_has_the_timings_of_its_own_turn(tmp_path, make_chatbot):
+  input_path, output_path = tmp_path / "in.jsonl", tmp_path / "out.jsonl"
+  write_lines(input_path, [{"id": i, "text": TEXTS[i % 2]} for i in range(8)])
+  batch_runner.run_batch(str(input_path), str(output_path), make_chatbot, concurrency=4)
+  records = read_records(output_path)
+  assert len(records) == 8
+  for record in records:
+    # summaries list the calendar, chat replies do not
+    expected = {"intent", "calendar_list"} if "have" in record["text"] else {"intent", "chat"}
+    assert set(record["timings"]) == expected
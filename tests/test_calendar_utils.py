@@ -0,0 +1,105 @@
+import threading
+import time
+
+import pytest
+from googleapiclient.errors import HttpError
+
+import calendar_utils
+import fake_backends
+import governor
+
+BODY = {"summary": "Review", "start": {"dateTime": "2023-01-02T09:00:00+09:00"},
+        "end": {"dateTime": "2023-01-02T10:00:00+09:00"}}
+
+
+@pytest.fixture(autouse=True)
+def fast_governor(monkeypatch):
+  monkeypatch.setattr(governor, "_default_governor", governor.Governor(base_delay=0.001))
+
+
+def test_a_retried_insert_that_was_stored_adds_one_event():
+  service = fake_backends.FakeCalendarService()
+  service.events().fail_next("insert", TimeoutError("reply lost"), after_commit=True)
+  event = calendar_utils.insert_event(service, BODY)
+  assert event["summary"] == "Review"
+  assert list(service.events().calendars["primary"]) == [event["id"]]
+  # the retry hit 409 and fetched the event stored by the first attempt
+  assert service.events().calls["insert"] == 2 and service.events().calls["get"] == 1
+
+
+def test_insert_events_keeps_failures_per_item():
+  service = fake_backends.FakeCalendarService()
+  service.events().fail_next("insert", fake_backends._http_error(400, "Bad Request"))
+  results = calendar_utils.insert_events(service, [BODY, dict(BODY, summary="Write")], max_workers=1)
+  assert results[0][0] is None and results[0][1].resp.status == 400
+  assert results[1][0]["summary"] == "Write" and results[1][1] is None
+  assert len(service.events().calendars["primary"]) == 1
+
+
+def test_bodies_get_an_id_before_the_first_attempt():
+  body = calendar_utils.with_event_id(BODY)
+  assert "id" not in BODY and len(body["id"]) >= 5
+  assert set(body["id"]) <= set("0123456789abcdefghijklmnopqrstuv")
+  assert calendar_utils.with_event_id(body) is body
+
+
+def test_one_users_login_does_not_block_the_others(monkeypatch):
+  login_started, finish_login = threading.Event(), threading.Event()
+  def load_credentials(path, credentials_path):
+    if path == "token_slow.json":
+      login_started.set()
+      finish_login.wait(5)
+    return path
+  monkeypatch.setattr(calendar_utils, "load_credentials", load_credentials)
+  pool = calendar_utils.ServicePool(check_interval=3600)
+  try:
+    slow = threading.Thread(target=pool.credentials, args=("slow",))
+    slow.start()
+    assert login_started.wait(5)
+    started = time.monotonic()
+    assert pool.credentials("fast") == "token_fast.json"
+    assert time.monotonic() - started < 1
+    finish_login.set()
+    slow.join()
+    assert pool.credentials("slow") == "token_slow.json"
+  finally:
+    finish_login.set()
+    pool.close()
+
+
+def test_calendars_that_cannot_be_listed_raise_or_are_recorded():
+  service = fake_backends.FakeCalendarService(calendars={"work": [BODY]})
+  service.events().fail_next("list", fake_backends._http_error(404, "Not Found", "notFound"))
+  with pytest.raises(HttpError):
+    calendar_utils.get_event_lists(service, ["work"])
+
+  errors = {}
+  service.events().fail_next("list", fake_backends._http_error(404, "Not Found", "notFound"))
+  event_lists = calendar_utils.get_event_lists(service, ["work"], errors=errors)
+  assert event_lists == [[]]
+  assert list(errors) == ["work"]
+
+
+def test_busy_intervals_of_unreadable_calendars_raise_or_are_recorded():
+  service = fake_backends.FakeCalendarService(calendars={"work": [BODY]})
+  time_min, time_max = "2023-01-02T00:00:00+09:00", "2023-01-03T00:00:00+09:00"
+  with pytest.raises(calendar_utils.FreeBusyError):
+    calendar_utils.get_busy_intervals(service, ["work", "missing"], time_min, time_max)
+
+  errors = {}
+  busy = calendar_utils.get_busy_intervals(service, ["work", "missing"], time_min, time_max, errors=errors)
+  assert len(busy) == 1
+  assert list(errors) == ["missing"]
+
+
+def test_summaries_name_the_calendars_left_out(chat_client, monkeypatch):
+  from chatbot_utils import CalendarChatGPT
+  from event_store import EventStore
+  monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+  service, other_service = fake_backends.FakeCalendarService(), fake_backends.FakeCalendarService()
+  other_service.events().fail_next("list", fake_backends._http_error(404, "Not Found", "notFound"))
+  stores = [EventStore(service, "primary"), EventStore(other_service, "work")]
+  chatbot = CalendarChatGPT(None, client=chat_client, service=service, timezone="Korean Standard Time",
+                            calendarIds=["primary", "work"], event_store=stores)
+  reply = chatbot._prompt_summarize_calendar("What do I have tomorrow?")
+  assert reply.endswith("The following calendars could not be read and were left out: work")
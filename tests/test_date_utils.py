@@ -0,0 +1,65 @@
+import datetime
+
+import pytest
+
+import date_utils
+
+MONDAY = datetime.date(2023, 1, 2)
+WEDNESDAY = datetime.date(2023, 1, 4)
+
+
+@pytest.mark.parametrize("text, today, expected", [
+  ("What is the date of this Friday?", MONDAY, ("this Friday", "2023/01/06", "2023/01/07")),
+  ("this upcoming Friday", MONDAY, ("this upcoming Friday", "2023/01/06", "2023/01/07")),
+  ("friday", MONDAY, ("friday", "2023/01/06", "2023/01/07")),
+  ("this Monday", MONDAY, ("this Monday", "2023/01/02", "2023/01/03")),
+  ("this monday", WEDNESDAY, ("this monday", "2023/01/09", "2023/01/10")),
+  ("last friday", MONDAY, ("last friday", "2022/12/30", "2022/12/31")),
+])
+def test_this_weekday_is_the_next_occurrence(text, today, expected):
+  assert date_utils.resolve_date_expression(text, today=today) == expected
+
+
+@pytest.mark.parametrize("text, today, expected", [
+  # "next" is the weekday of next week, not the next occurrence
+  ("next Friday", MONDAY, ("next Friday", "2023/01/13", "2023/01/14")),
+  ("next monday", MONDAY, ("next monday", "2023/01/09", "2023/01/10")),
+  ("next monday", WEDNESDAY, ("next monday", "2023/01/09", "2023/01/10")),
+  ("next sunday", WEDNESDAY, ("next sunday", "2023/01/15", "2023/01/16")),
+])
+def test_next_weekday_is_in_next_week(text, today, expected):
+  assert date_utils.resolve_date_expression(text, today=today) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+  ("meet on 1/13", ("1/13", "2023/01/13", "2023/01/14")),
+  ("12/25/24 party", ("12/25/24", "2024/12/25", "2024/12/26")),
+  ("on 3/4/2025", ("3/4/2025", "2025/03/04", "2025/03/05")),
+  ("due 2023/2/28", ("2023/2/28", "2023/02/28", "2023/03/01")),
+])
+def test_slash_dates(text, expected):
+  assert date_utils.resolve_date_expression(text, today=MONDAY) == expected
+
+
+@pytest.mark.parametrize("text", ["on 13/45", "1/13 and 1/14", "no date here"])
+def test_unresolved_phrases_are_left_to_the_llm(text):
+  assert date_utils.resolve_date_expression(text, today=MONDAY) is None
+
+
+def test_week_ranges():
+  assert date_utils.resolve_date_expression("next week", today=WEDNESDAY) == ("next week", "2023/01/09", "2023/01/16")
+  assert date_utils.resolve_date_expression("this weekend", today=WEDNESDAY) == ("this weekend", "2023/01/07", "2023/01/09")
+
+
+def test_chatbot_resolves_dates_without_the_llm(chatbot, chat_client):
+  today = date_utils.today_in("Korean Standard Time")
+  phrase, date_min, date_max = chatbot._prompt_detect_date("What do I have tomorrow?")
+  assert phrase == "tomorrow"
+  assert date_min == date_utils.format_date(today + datetime.timedelta(days=1))
+  assert date_max == date_utils.format_date(today + datetime.timedelta(days=2))
+  assert chat_client.requests == []
+
+
+def test_chatbot_asks_the_llm_for_phrases_it_cannot_resolve(chatbot, chat_client):
+  chatbot._prompt_detect_date("What do I have on 1/13 and 1/14?")
+  assert [stage for stage, _ in chat_client.requests] == ["detect_date"]
@@ -0,0 +1,89 @@
+import datetime
+import sqlite3
+
+import fake_backends
+from event_store import EventStore
+
+DAY = datetime.date(2023, 1, 2)
+
+
+def event(summary, hour):
+  return {"summary": summary, "start": {"dateTime": f"{DAY}T{hour:02}:00:00+09:00"},
+          "end": {"dateTime": f"{DAY}T{hour + 1:02}:00:00+09:00"}}
+
+
+def summaries(store):
+  return sorted(event["summary"] for event in store.events.values())
+
+
+def stored_ids(db_path):
+  conn = sqlite3.connect(db_path)
+  try:
+    return {event_id for event_id, in conn.execute("SELECT id FROM events")}
+  finally:
+    conn.close()
+
+
+def test_refresh_applies_the_changes_since_the_last_sync():
+  service = fake_backends.FakeCalendarService([event("Standup", 9), event("Review", 14)])
+  store = EventStore(service, timezone="Asia/Seoul")
+  store.refresh()
+  events = service.events()
+  events.insert(calendarId="primary", body=event("Lunch", 12)).execute()
+  review = next(e for e in store.events.values() if e["summary"] == "Review")
+  events.delete(calendarId="primary", eventId=review["id"]).execute()
+  store.refresh()
+  assert summaries(store) == ["Lunch", "Standup"]
+  assert events.calls["list"] == 2
+
+
+def test_an_expired_sync_token_falls_back_to_a_full_sync():
+  service = fake_backends.FakeCalendarService([event("Standup", 9)])
+  store = EventStore(service, timezone="Asia/Seoul")
+  store.refresh()
+  service.events().insert(calendarId="primary", body=event("Lunch", 12)).execute()
+  # the server answers 410 Gone to a token it does not know
+  store.sync_token = "expired"
+  store.refresh()
+  assert summaries(store) == ["Lunch", "Standup"]
+  assert store.sync_token not in (None, "expired")
+
+
+def test_the_store_is_saved_and_loaded(tmp_path):
+  db_path = str(tmp_path / "events.db")
+  service = fake_backends.FakeCalendarService([event("Standup", 9), event("Review", 14)])
+  store = EventStore(service, db_path=db_path, timezone="Asia/Seoul")
+  store.refresh()
+
+  loaded = EventStore(service, db_path=db_path, timezone="Asia/Seoul")
+  assert loaded.events == store.events
+  assert loaded.sync_token == store.sync_token
+  # a fresh copy is queried without listing again
+  loaded.max_staleness = 3600
+  loaded.query(f"{DAY}T00:00:00+09:00", f"{DAY}T23:59:59+09:00")
+  assert service.events().calls["list"] == 1
+
+
+def test_incremental_syncs_write_the_changed_events(tmp_path):
+  db_path = str(tmp_path / "events.db")
+  service = fake_backends.FakeCalendarService([event("Standup", 9), event("Review", 14)])
+  store = EventStore(service, db_path=db_path, timezone="Asia/Seoul")
+  store.refresh()
+  events = service.events()
+  lunch = events.insert(calendarId="primary", body=event("Lunch", 12)).execute()
+  review = next(e for e in store.events.values() if e["summary"] == "Review")
+  events.delete(calendarId="primary", eventId=review["id"]).execute()
+  store.refresh()
+  assert stored_ids(db_path) == set(store.events)
+  assert lunch["id"] in stored_ids(db_path)
+  assert store._changed == set()
+
+
+def test_changes_are_not_tracked_without_a_database():
+  service = fake_backends.FakeCalendarService([event("Standup", 9)])
+  store = EventStore(service, timezone="Asia/Seoul")
+  store.refresh()
+  service.events().insert(calendarId="primary", body=event("Lunch", 12)).execute()
+  store.refresh()
+  store.add_event({"id": "mine", **event("Focus", 15)})
+  assert store._changed == set()
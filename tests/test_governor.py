@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import time
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import fake_backends
+import governor
+
+
+def failing(errors, result="done"):
+  """A function raising errors one by one, then returning result."""
+  errors = list(errors)
+  calls = []
+  def fn():
+    calls.append(len(calls))
+    if errors:
+      raise errors.pop(0)
+    return result
+  return fn, calls
+
+
+def test_transient_errors_are_retried():
+  gov = governor.Governor(base_delay=0.001)
+  fn, calls = failing([fake_backends._http_error(503, "Unavailable"), TimeoutError()])
+  assert gov.call("calendar:primary", fn) == "done"
+  assert len(calls) == 3
+  assert gov.stats["calendar"]["retries"] == 2
+  assert gov.stats["calendar"]["failures"] == 0
+
+
+def test_retries_stop_after_max_retries():
+  gov = governor.Governor(max_retries=2, base_delay=0.001)
+  fn, calls = failing([fake_backends._http_error(500, "Backend Error")] * 5)
+  with pytest.raises(HttpError):
+    gov.call("calendar:primary", fn)
+  assert len(calls) == 3
+  assert gov.stats["calendar"]["failures"] == 1
+
+
+def test_client_errors_are_not_retried():
+  gov = governor.Governor(base_delay=0.001)
+  fn, calls = failing([fake_backends._http_error(404, "Not Found", "notFound")])
+  with pytest.raises(HttpError):
+    gov.call("calendar:primary", fn)
+  assert len(calls) == 1
+
+
+@pytest.mark.parametrize("error, retried", [
+  (fake_backends._http_error(500, "Backend Error"), False),
+  (TimeoutError(), False),
+  (fake_backends._http_error(429, "Too Many Requests"), True),
+  (fake_backends._http_error(403, "Rate Limit Exceeded", "rateLimitExceeded"), True),
+])
+def test_non_idempotent_calls_retry_rate_limits_only(error, retried):
+  gov = governor.Governor(base_delay=0.001)
+  fn, calls = failing([error])
+  if retried:
+    assert gov.call("calendar:primary", fn, idempotent=False) == "done"
+  else:
+    with pytest.raises(type(error)):
+      gov.call("calendar:primary", fn, idempotent=False)
+  assert len(calls) == (2 if retried else 1)
+
+
+def test_async_calls_are_retried():
+  gov = governor.Governor(base_delay=0.001)
+  fn, calls = failing([fake_backends._http_error(429, "Too Many Requests")])
+  async def afn():
+    return fn()
+  assert asyncio.run(gov.acall("openai:model", afn)) == "done"
+  assert len(calls) == 2
+
+
+def test_backoff_grows_and_honours_retry_after():
+  gov = governor.Governor(base_delay=0.5, max_delay=30.0)
+  error = fake_backends._http_error(503, "Unavailable")
+  for attempt in range(6):
+    assert 0 <= gov.backoff(attempt, error) <= min(30.0, 0.5 * 2 ** attempt)
+  asked = HttpError(httplib2.Response({"status": 429, "retry-after": "7"}), b"")
+  assert gov.backoff(0, asked) >= 7
+  asked = HttpError(httplib2.Response({"status": 429, "retry-after": "120"}), b"")
+  assert gov.backoff(0, asked) <= 30.0
+
+
+def test_single_flight_runs_concurrent_queries_once():
+  gov = governor.Governor()
+  started, release = threading.Event(), threading.Event()
+  runs = []
+  def fn():
+    runs.append(1)
+    started.set()
+    release.wait(5)
+    return {"items": [1, 2]}
+  results = []
+  def query():
+    results.append(gov.single_flight("calendar:primary", "q", fn))
+  threads = [threading.Thread(target=query) for _ in range(4)]
+  threads[0].start()
+  assert started.wait(5)
+  for thread in threads[1:]:
+    thread.start()
+  # give the others time to join the flight
+  time.sleep(0.05)
+  release.set()
+  for thread in threads:
+    thread.join()
+  assert len(runs) == 1
+  assert gov.stats["calendar"]["coalesced"] == 3
+  assert results == [{"items": [1, 2]}] * 4
+  # each caller gets its own copy
+  assert len({id(result) for result in results}) == 4
+
+
+def test_single_flight_shares_errors_and_forgets_the_query():
+  gov = governor.Governor()
+  fn, _ = failing([ValueError()], result=1)
+  with pytest.raises(ValueError):
+    gov.single_flight("calendar:primary", "q", fn)
+  assert gov.single_flight("calendar:primary", "q", fn) == 1
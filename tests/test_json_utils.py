@@ -0,0 +1,58 @@
+import pytest
+
+import fake_backends
+import json_utils
+
+
+@pytest.mark.parametrize("text, expected", [
+  ('{"a": 1}', {"a": 1}),
+  ('Sure! {"a": "b}c", "d": [1, {"e": "]"}]} Anything else?', {"a": "b}c", "d": [1, {"e": "]"}]}),
+  ('```json\n{"a": [1, 2]}\n```', {"a": [1, 2]}),
+  # apostrophes in the prose around the JSON do not open a string
+  ("Here's your plan: {\"a\": \"it's\"} Let's go.", {"a": "it's"}),
+  ('{"a": "say \\"}\\" twice"}', {"a": 'say "}" twice'}),
+  ("{'date': '2023-01-02', 'schedule': []}", {"date": "2023-01-02", "schedule": []}),
+  # the first balanced span is not JSON, the second is
+  ('{not json} but {"a": 1}', {"a": 1}),
+  ('[{"id": 1}, {"id": 2}]', [{"id": 1}, {"id": 2}]),
+])
+def test_extract_json_scans_balanced_braces(text, expected):
+  assert json_utils.extract_json(text) == expected
+
+
+def test_mismatched_brackets_drop_the_candidate():
+  assert json_utils.extract_json('{"a": [1, 2}} {"b": 2}') == {"b": 2}
+
+
+@pytest.mark.parametrize("text, error", [
+  ('{"a": [1, 2', "cut off"),
+  ("no JSON at all", "no JSON object"),
+  ("{nope}", "not valid JSON"),
+  (None, "empty"),
+])
+def test_extract_json_errors(text, error):
+  with pytest.raises(json_utils.JSONParseError) as info:
+    json_utils.extract_json(text)
+  assert error in str(info.value)
+
+
+def test_validate_reports_every_mismatch():
+  schema = json_utils.STAGE_SCHEMAS["summarize"]
+  assert json_utils.validate({"schedule": [{"summary": "a", "Participants": ["b (b@x.com)"]}]}, schema) == []
+  assert json_utils.validate({"schedule": [{"summary": 1, "Participants": [2]}, "x"]}, schema) == [
+    "$.schedule[0].summary should be str",
+    "$.schedule[0].Participants[0] should be str or dict",
+    "$.schedule[1] should be an object",
+  ]
+
+
+def test_incremental_parser_returns_each_item_once_complete():
+  reply = '{"Tasks": [{"Task": "a]}", "n": {"x": 1}}, {"Task": "b"}, {"Task": \'c\'}]}'
+  parser = json_utils.IncrementalArrayParser()
+  items = []
+  for chunk in fake_backends.completion_chunks(reply, chunk_chars=5):
+    if chunk.choices:
+      items += parser.feed(chunk.choices[0].delta.content)
+  assert items == ['{"Task": "a]}", "n": {"x": 1}}', '{"Task": "b"}', "{\"Task\": 'c'}"]
+  assert parser.done
+  assert [json_utils.extract_json(item)["Task"] for item in items] == ["a]}", "b", "c"]
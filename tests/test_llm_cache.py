@@ -0,0 +1,65 @@
+import json
+
+import fake_backends
+import llm_cache
+from chatbot_utils import CalendarChatGPT
+
+DATE_REPLY = json.dumps({"detected_phrase": "someday", "date": "2023-01-02T00:00:00",
+                         "date_after_date": "2023-01-03T00:00:00"})
+
+
+def test_only_replies_that_parse_are_cached(monkeypatch):
+  monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+  client = fake_backends.ScriptedChatClient(["not json", DATE_REPLY, DATE_REPLY])
+  chatbot = CalendarChatGPT(None, client=client, service=fake_backends.FakeCalendarService(),
+                            response_cache=llm_cache.ResponseCache(stages=("detect_date",)))
+  # the invalid reply is repaired but not cached, the valid one is
+  for _ in range(3):
+    assert chatbot._llm_date("someday")[0] == "someday"
+  assert len(client.requests) == 3
+  assert chatbot.response_cache.stats["detect_date"]["hits"] == 1
+
+
+def reply(text):
+  return fake_backends.completion(text)
+
+
+def test_cache_keys_ignore_whitespace():
+  key = llm_cache.cache_key("model", None, 100, [{"role": "user", "content": "What do I  have\ntoday?"}])
+  assert key == llm_cache.cache_key("model", None, 100, [{"role": "user", "content": " What do I have today? "}])
+  assert key != llm_cache.cache_key("model", None, 200, [{"role": "user", "content": "What do I have today?"}])
+
+
+def test_memory_tier_evicts_the_least_recently_used():
+  cache = llm_cache.ResponseCache(max_entries=2)
+  cache.put("intent", "a", reply("1"))
+  cache.put("intent", "b", reply("2"))
+  assert cache.get("intent", "a") is not None
+  cache.put("intent", "c", reply("3"))
+  assert cache.get("intent", "b") is None
+  assert [cache.get("intent", key).choices[0].message.content for key in "ac"] == ["1", "3"]
+  assert cache.stats["intent"] == {"hits": 3, "misses": 1, "disk_hits": 0}
+
+
+def test_expired_entries_are_not_served(tmp_path):
+  cache = llm_cache.ResponseCache(ttl=0, disk_path=str(tmp_path / "cache.db"))
+  cache.put("intent", "a", reply("1"))
+  assert cache.get("intent", "a") is None
+
+
+def test_disk_tier_survives_restarts_and_keeps_the_newest(tmp_path):
+  disk_path = str(tmp_path / "cache.db")
+  cache = llm_cache.ResponseCache(max_entries=1, disk_path=disk_path, max_disk_entries=2)
+  for key, text in zip("abc", "123"):
+    cache.put("intent", key, reply(text))
+
+  restarted = llm_cache.ResponseCache(disk_path=disk_path, max_disk_entries=2)
+  assert restarted.get("intent", "a") is None
+  assert restarted.get("intent", "b").choices[0].message.content == "2"
+  assert restarted.stats["intent"]["disk_hits"] == 1
+  # served from memory once read from disk
+  restarted.get("intent", "b")
+  assert restarted.stats["intent"]["disk_hits"] == 1
+
+  restarted.clear()
+  assert llm_cache.ResponseCache(disk_path=disk_path).get("intent", "c") is None
@@ -0,0 +1,84 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import fake_backends
+from micro_batcher import MicroBatcher
+
+
+def submit_all(batcher, items, run, key="k"):
+  with ThreadPoolExecutor(max_workers=len(items)) as executor:
+    return list(executor.map(lambda item: batcher.submit(key, item, run), items))
+
+
+def test_concurrent_items_share_one_run():
+  batcher = MicroBatcher(max_batch_size=4, max_wait=5)
+  runs = []
+  def run(items):
+    runs.append(list(items))
+    return [item * 10 for item in items]
+  started = time.monotonic()
+  assert submit_all(batcher, [1, 2, 3, 4], run) == [10, 20, 30, 40]
+  # a full batch does not wait for max_wait
+  assert time.monotonic() - started < 5
+  assert sorted(runs[0]) == [1, 2, 3, 4] and len(runs) == 1
+  assert batcher.stats["batches"] == 1 and batcher.stats["batched_items"] == 4
+
+
+def test_an_item_alone_is_sent_alone():
+  batcher = MicroBatcher(max_wait=0.01)
+  runs = []
+  assert batcher.submit("k", 1, runs.append) is None
+  assert runs == []
+  assert batcher.stats["alone"] == 1
+
+
+def test_keys_do_not_share_batches():
+  batcher = MicroBatcher(max_batch_size=2, max_wait=5)
+  barrier = threading.Barrier(4)
+  def submit(item):
+    barrier.wait()
+    return batcher.submit(item % 2, item, lambda items: [(len(items), sum(items))] * len(items))
+  with ThreadPoolExecutor(max_workers=4) as executor:
+    results = list(executor.map(submit, [0, 1, 2, 3]))
+  assert results == [(2, 2), (2, 4), (2, 2), (2, 4)]
+
+
+def test_failed_or_partial_runs_send_the_rest_alone():
+  batcher = MicroBatcher(max_batch_size=3, max_wait=5)
+  def fail(items):
+    raise RuntimeError("bad batch")
+  assert submit_all(batcher, [1, 2, 3], fail) == [None, None, None]
+  assert batcher.stats["failed_batches"] == 1
+
+  results = submit_all(batcher, [1, 2, 3], lambda items: [item for item in items if item != 2])
+  assert results.count(None) == 1
+  assert batcher.stats["unanswered"] == 4
+
+
+def test_asubmit_batches_coroutines():
+  batcher = MicroBatcher(max_batch_size=3, max_wait=5)
+  runs = []
+  async def run(items):
+    runs.append(list(items))
+    return [item + 1 for item in items]
+  async def main():
+    return await asyncio.gather(*(batcher.asubmit("k", item, run) for item in [1, 2, 3]))
+  assert asyncio.run(main()) == [2, 3, 4]
+  assert runs == [[1, 2, 3]]
+
+
+def test_chatbots_batch_their_intent_prompts(monkeypatch):
+  from chatbot_utils import CalendarChatGPT
+  monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+  client = fake_backends.ScriptedChatClient(latency=0.01)
+  batcher = MicroBatcher(max_batch_size=4, max_wait=5)
+  texts = ["show my agenda", "add lunch with Kim", "plan my thesis", "hello there"]
+  def intent(text):
+    bot = CalendarChatGPT(None, client=client, service=fake_backends.FakeCalendarService(), micro_batcher=batcher)
+    return bot._prompt_intent(text)
+  with ThreadPoolExecutor(max_workers=4) as executor:
+    intents = list(executor.map(intent, texts))
+  assert intents == ["1", "2", "3", ""]
+  assert [stage for stage, _ in client.requests] == ["intent_batch"]
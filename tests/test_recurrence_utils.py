@@ -0,0 +1,72 @@
+import datetime
+
+import pytest
+
+import date_utils
+import fake_backends
+import recurrence_utils
+from event_store import EventStore
+
+SEOUL = date_utils.get_tzinfo("Asia/Seoul")
+WINDOW = (datetime.datetime(2023, 1, 1, tzinfo=SEOUL), datetime.datetime(2024, 1, 1, tzinfo=SEOUL))
+
+
+def series(recurrence, start="2023-03-06T09:00:00-05:00", end="2023-03-06T09:30:00-05:00", zone="America/New_York"):
+  return {"id": "s1", "summary": "Standup", "recurrence": recurrence,
+          "start": {"dateTime": start, "timeZone": zone}, "end": {"dateTime": end, "timeZone": zone}}
+
+
+def starts(events):
+  return [event["start"].get("dateTime") or event["start"]["date"] for event in events]
+
+
+def test_series_keep_their_wall_clock_time_across_dst():
+  instances = recurrence_utils.expand_event(series(["RRULE:FREQ=WEEKLY;COUNT=3"]), *WINDOW, tzinfo=SEOUL)
+  # New York moves to EDT on 2023-03-12
+  assert starts(instances) == ["2023-03-06T09:00:00-05:00", "2023-03-13T09:00:00-04:00", "2023-03-20T09:00:00-04:00"]
+  assert [instance["end"]["dateTime"] for instance in instances][1] == "2023-03-13T09:30:00-04:00"
+  assert [instance["id"] for instance in instances] == ["s1_20230306T140000Z", "s1_20230313T130000Z",
+                                                        "s1_20230320T130000Z"]
+
+
+def test_series_across_the_end_of_dst():
+  master = series(["RRULE:FREQ=DAILY;COUNT=3"], "2023-11-04T09:00:00-04:00", "2023-11-04T10:00:00-04:00")
+  instances = recurrence_utils.expand_event(master, *WINDOW, tzinfo=SEOUL)
+  assert starts(instances) == ["2023-11-04T09:00:00-04:00", "2023-11-05T09:00:00-05:00", "2023-11-06T09:00:00-05:00"]
+
+
+@pytest.mark.parametrize("exdate", ["EXDATE;TZID=America/New_York:20230308T090000", "EXDATE:20230308T140000Z"])
+def test_exdate_removes_an_instance(exdate):
+  instances = recurrence_utils.expand_event(series(["RRULE:FREQ=DAILY;COUNT=5", exdate]), *WINDOW, tzinfo=SEOUL)
+  assert starts(instances) == ["2023-03-06T09:00:00-05:00", "2023-03-07T09:00:00-05:00",
+                               "2023-03-09T09:00:00-05:00", "2023-03-10T09:00:00-05:00"]
+
+
+def test_all_day_exdate():
+  master = {"id": "a1", "summary": "Holiday", "start": {"date": "2023-03-06"}, "end": {"date": "2023-03-07"},
+            "recurrence": ["RRULE:FREQ=DAILY;COUNT=3", "EXDATE;VALUE=DATE:20230307"]}
+  instances = recurrence_utils.expand_event(master, *WINDOW, tzinfo=SEOUL)
+  assert starts(instances) == ["2023-03-06", "2023-03-08"]
+  assert [instance["id"] for instance in instances] == ["a1_20230306", "a1_20230308"]
+
+
+def test_exceptions_replace_or_cancel_instances():
+  master = series(["RRULE:FREQ=DAILY;COUNT=3"])
+  moved = {"id": "s1_20230307T140000Z", "recurringEventId": "s1", "summary": "Standup (moved)",
+           "originalStartTime": {"dateTime": "2023-03-07T09:00:00-05:00"},
+           "start": {"dateTime": "2023-03-07T11:00:00-05:00"}, "end": {"dateTime": "2023-03-07T11:30:00-05:00"}}
+  cancelled = {"id": "s1_20230308T140000Z", "recurringEventId": "s1", "status": "cancelled",
+               "originalStartTime": {"dateTime": "2023-03-08T09:00:00-05:00"}}
+  events = recurrence_utils.expand_events([master, moved, cancelled], *WINDOW, tzinfo=SEOUL)
+  assert starts(events) == ["2023-03-06T09:00:00-05:00", "2023-03-07T11:00:00-05:00"]
+
+
+def test_store_expansion_matches_the_servers_single_events():
+  service = fake_backends.FakeCalendarService(fake_backends.generate_events(50, recurring=5))
+  today = date_utils.today_in("Asia/Seoul")
+  time_min = datetime.datetime.combine(today, datetime.time(0), tzinfo=SEOUL).isoformat()
+  time_max = datetime.datetime.combine(today + datetime.timedelta(days=14), datetime.time(0), tzinfo=SEOUL).isoformat()
+  local = EventStore(service, timezone="Asia/Seoul", expand_recurring=True).query(time_min, time_max)
+  server = EventStore(service, timezone="Asia/Seoul", expand_recurring=False).query(time_min, time_max)
+  assert [event["id"] for event in local] == [event["id"] for event in server]
+  assert any(event.get("recurringEventId") for event in local)
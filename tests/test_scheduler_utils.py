@@ -0,0 +1,86 @@
+import datetime
+
+import date_utils
+import fake_backends
+import scheduler_utils
+
+TZ = date_utils.get_tzinfo("Asia/Seoul")
+DAY = datetime.date(2023, 1, 2)
+
+
+def at(hour, minute=0, day=DAY):
+  return datetime.datetime.combine(day, datetime.time(hour, minute), tzinfo=TZ).timestamp()
+
+
+def event(start_hour, end_hour, **fields):
+  return dict({"start": {"dateTime": datetime.datetime.fromtimestamp(at(start_hour), TZ).isoformat()},
+               "end": {"dateTime": datetime.datetime.fromtimestamp(at(end_hour), TZ).isoformat()}}, **fields)
+
+
+def intervals(index):
+  return list(zip(index.starts, index.ends))
+
+
+def test_overlapping_touching_and_nested_intervals_merge():
+  index = scheduler_utils.BusyIndex([(at(9), at(10)), (at(9, 30), at(11)), (at(11), at(12)),
+                                     (at(14), at(17)), (at(15), at(16))])
+  assert intervals(index) == [(at(9), at(12)), (at(14), at(17))]
+
+
+def test_empty_intervals_are_dropped():
+  index = scheduler_utils.BusyIndex([(at(10), at(10)), (at(12), at(11))])
+  assert len(index) == 0
+
+
+def test_add_merges_with_every_interval_it_overlaps():
+  index = scheduler_utils.BusyIndex([(at(9), at(10)), (at(11), at(12)), (at(13), at(14)), (at(16), at(17))])
+  index.add(at(9, 30), at(13, 30))
+  assert intervals(index) == [(at(9), at(14)), (at(16), at(17))]
+  index.add(at(14, 30), at(15))
+  assert intervals(index) == [(at(9), at(14)), (at(14, 30), at(15)), (at(16), at(17))]
+  # touching the ends joins both neighbours
+  index.add(at(15), at(16))
+  assert intervals(index) == [(at(9), at(14)), (at(14, 30), at(17))]
+
+
+def test_is_free_and_find_slot():
+  index = scheduler_utils.BusyIndex([(at(9), at(10)), (at(11), at(12))])
+  assert index.is_free(at(10), at(11))
+  assert not index.is_free(at(9, 30), at(10, 30))
+  assert not index.is_free(at(8), at(13))
+  assert index.find_slot(at(9), 3600, at(18)) == at(10)
+  assert index.find_slot(at(9), 2 * 3600, at(18)) == at(12)
+  assert index.find_slot(at(9), 2 * 3600, at(13)) is None
+
+
+def test_busy_intervals_skip_free_and_cancelled_events():
+  events = [event(9, 10), event(10, 11, transparency="transparent"), event(11, 12, status="cancelled"),
+            event(13, 14)]
+  assert scheduler_utils.busy_intervals(events, TZ) == [(at(9), at(10)), (at(13), at(14))]
+
+
+def test_scheduled_tasks_avoid_calendar_events_and_exclusions():
+  events = fake_backends.generate_events(40, start=DAY, days=3)
+  start = datetime.datetime.combine(DAY, datetime.time(9), tzinfo=TZ)
+  deadline = start + datetime.timedelta(days=3)
+  scheduled, unscheduled = scheduler_utils.schedule_tasks([("Write", 4), ("Review", 2)], events, start, deadline,
+                                                          TZ, "Asia/Seoul")
+  assert unscheduled == []
+  assert [task["Task"] for task in scheduled] == ["Write (part 1)", "Write (part 2)", "Review"]
+  busy = scheduler_utils.BusyIndex(scheduler_utils.busy_intervals(events, TZ) +
+                                   scheduler_utils.exclusion_intervals(DAY, deadline.date(), TZ))
+  for task in scheduled:
+    task_start = datetime.datetime.fromisoformat(task["Start Time"]).replace(tzinfo=TZ).timestamp()
+    task_end = datetime.datetime.fromisoformat(task["End Time"]).replace(tzinfo=TZ).timestamp()
+    assert busy.is_free(task_start, task_end)
+
+
+def test_tasks_after_one_that_does_not_fit_stay_unscheduled():
+  start = datetime.datetime.combine(DAY, datetime.time(9), tzinfo=TZ)
+  deadline = start + datetime.timedelta(hours=3)
+  # a 2 hour gap is free, so "Long" does not fit but "Short" would
+  events = [event(11, 12)]
+  scheduled, unscheduled = scheduler_utils.schedule_tasks([("Intro", 1), ("Long", 3), ("Short", 1)], events,
+                                                          start, deadline, TZ, "Asia/Seoul", exclusions=())
+  assert [task["Task"] for task in scheduled] == ["Intro"]
+  assert unscheduled == [{"Task": "Long", "Hours": 3}, {"Task": "Short", "Hours": 1}]
@@ -0,0 +1,46 @@
+import asyncio
+
+import fake_backends
+import trace_utils
+from async_chatbot_utils import AsyncCalendarChatGPT, ChatSession
+from chatbot_utils import CalendarChatGPT
+
+
+class ListSink:
+  def __init__(self):
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(record)
+
+
+def assert_one_tree(records):
+  spans = {record["span_id"]: record for record in records if record["kind"] == "span"}
+  turn = next(record for record in spans.values() if record["name"] == "turn")
+  assert turn["parent_id"] is None
+  for record in spans.values():
+    assert record["trace_id"] == turn["trace_id"]
+    if record is not turn:
+      assert record["parent_id"] in spans
+  return spans
+
+
+def test_streamed_turns_parent_their_spans(monkeypatch):
+  monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+  sink = ListSink()
+  bot = CalendarChatGPT(None, client=fake_backends.ScriptedChatClient(), service=fake_backends.FakeCalendarService(),
+                        tracer=trace_utils.Tracer([sink]), local_scheduler=False)
+  assert "".join(bot.prompt_stream("plan my thesis by friday"))
+  spans = assert_one_tree(sink.records)
+  assert {"stage.intent", "llm", "calendar.insert"} <= {record["name"] for record in spans.values()}
+
+
+def test_async_streamed_turns_parent_their_spans():
+  sink = ListSink()
+  bot = AsyncCalendarChatGPT(None, async_client=fake_backends.AsyncScriptedChatClient(),
+                             service=fake_backends.FakeCalendarService(), tracer=trace_utils.Tracer([sink]))
+  async def turn():
+    return "".join([part async for part in bot.prompt_stream("hello there", ChatSession("s"))])
+  assert asyncio.run(turn())
+  spans = assert_one_tree(sink.records)
+  assert "llm" in {record["name"] for record in spans.values()}
@@ -0,0 +1,204 @@
+import bisect
+import contextlib
+import contextvars
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+
+# Span of the running stage, per thread and per asyncio task
+_current_span = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+# Upper bounds in milliseconds of the HistogramRegistry buckets
+DEFAULT_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class Span:
+  """One timed unit of work: a turn, a prompt stage or an external call.
+  """
+  def __init__(self, name, parent=None, **attrs):
+    self.name = name
+    self.span_id = next(_span_ids)
+    self.parent_id = parent.span_id if parent is not None else None
+    self.trace_id = parent.trace_id if parent is not None else self.span_id
+    self.attrs = attrs
+    self.start = time.time()
+    self._started = time.perf_counter()
+    self.duration = None
+    self.error = None
+
+  def set(self, **attrs):
+    self.attrs.update(attrs)
+
+  def finish(self):
+    self.duration = time.perf_counter() - self._started
+
+  def to_dict(self):
+    return {"kind": "span", "name": self.name, "trace_id": self.trace_id, "span_id": self.span_id,
+            "parent_id": self.parent_id, "start": self.start,
+            "duration_ms": round(self.duration * 1000, 3), "error": self.error, **self.attrs}
+
+
+class Tracer:
+  """Records spans and debug events and hands them to sinks.
+
+  A sink is any object with `emit(record)` taking a dict. Debug events (e.g.
+  the full text of each prompt) are dropped unless `debug` is set. With no
+  sinks the tracer only keeps the span stack.
+  """
+  def __init__(self, sinks=(), debug=False):
+    self.sinks = list(sinks)
+    self.debug_enabled = debug
+
+  @property
+  def enabled(self):
+    return bool(self.sinks)
+
+  def add_sink(self, sink):
+    self.sinks.append(sink)
+
+  def _emit(self, record):
+    for sink in self.sinks:
+      sink.emit(record)
+
+  @contextlib.contextmanager
+  def span(self, name, **attrs):
+    span = Span(name, _current_span.get(), **attrs)
+    token = _current_span.set(span)
+    try:
+      yield span
+    except BaseException as e:
+      span.error = type(e).__name__
+      raise
+    finally:
+      _current_span.reset(token)
+      span.finish()
+      if self.sinks:
+        self._emit(span.to_dict())
+
+  def start_span(self, name, **attrs):
+    """Starts a span under the current one without making it current, for
+    work that spans several yields of a generator. Close it with end_span.
+    """
+    return Span(name, _current_span.get(), **attrs)
+
+  @contextlib.contextmanager
+  def activate(self, span):
+    """Makes span current inside the block, e.g. around each resume of the
+    generator a span started with start_span covers.
+    """
+    token = _current_span.set(span)
+    try:
+      yield span
+    finally:
+      _current_span.reset(token)
+
+  def end_span(self, span, error=None):
+    span.finish()
+    span.error = error
+    if self.sinks:
+      self._emit(span.to_dict())
+
+  def debug(self, name, **attrs):
+    if not (self.debug_enabled and self.sinks):
+      return
+    parent = _current_span.get()
+    self._emit({"kind": "event", "name": name, "time": time.time(),
+                "trace_id": parent.trace_id if parent is not None else None,
+                "span_id": parent.span_id if parent is not None else None, **attrs})
+
+
+def payload_chars(messages):
+  """Characters of message content, a cheap proxy for the request size.
+  """
+  total = 0
+  for message in messages:
+    content = message.get("content") if isinstance(message, dict) else getattr(message, "content", None)
+    total += len(content or "")
+  return total
+
+
+class LoggingSink:
+  """Writes spans at `level` and debug events at DEBUG to a logger.
+  """
+  def __init__(self, logger=None, level=logging.INFO):
+    self.logger = logger or logging.getLogger("calendar_chatbot")
+    self.level = level
+
+  def emit(self, record):
+    attrs = {k: v for k, v in record.items()
+             if k not in ("kind", "name", "trace_id", "span_id", "parent_id", "start", "time")}
+    if record["kind"] == "span":
+      self.logger.log(self.level, "%s %s", record["name"], attrs)
+    else:
+      self.logger.debug("%s %s", record["name"], attrs)
+
+
+class JsonlSink:
+  """Appends every record as one JSON line to a file.
+  """
+  def __init__(self, path):
+    self._file = open(path, "a", encoding="utf-8")
+    self._lock = threading.Lock()
+
+  def emit(self, record):
+    line = json.dumps(record, ensure_ascii=False, default=str)
+    with self._lock:
+      self._file.write(line + "\n")
+      self._file.flush()
+
+  def close(self):
+    self._file.close()
+
+
+class HistogramRegistry:
+  """In-process latency histograms of spans, keyed by (span name, stage).
+  """
+  def __init__(self, buckets_ms=DEFAULT_BUCKETS_MS):
+    self.buckets_ms = list(buckets_ms)
+    self._lock = threading.Lock()
+    self.histograms = defaultdict(lambda: {"counts": [0] * (len(self.buckets_ms) + 1),
+                                           "count": 0, "sum_ms": 0.0, "errors": 0, "cache_hits": 0})
+
+  def emit(self, record):
+    if record["kind"] != "span":
+      return
+    key = (record["name"], record.get("stage"))
+    duration_ms = record["duration_ms"]
+    with self._lock:
+      histogram = self.histograms[key]
+      histogram["counts"][bisect.bisect_left(self.buckets_ms, duration_ms)] += 1
+      histogram["count"] += 1
+      histogram["sum_ms"] += duration_ms
+      histogram["errors"] += record.get("error") is not None
+      histogram["cache_hits"] += bool(record.get("cache_hit"))
+
+  def percentile(self, name, q, stage=None):
+    """Upper bound in ms of the bucket holding the q-th percentile.
+    """
+    histogram = self.histograms.get((name, stage))
+    if not histogram or not histogram["count"]:
+      return None
+    rank = q / 100 * histogram["count"]
+    seen = 0
+    for i, count in enumerate(histogram["counts"]):
+      seen += count
+      if seen >= rank and count:
+        return self.buckets_ms[i] if i < len(self.buckets_ms) else float("inf")
+    return float("inf")
+
+  def summary(self):
+    rows = {}
+    for (name, stage), histogram in sorted(self.histograms.items(), key=lambda x: (x[0][0], x[0][1] or "")):
+      rows[f"{name}[{stage}]" if stage else name] = {
+        "count": histogram["count"],
+        "mean_ms": round(histogram["sum_ms"] / histogram["count"], 3),
+        "p50_ms": self.percentile(name, 50, stage),
+        "p95_ms": self.percentile(name, 95, stage),
+        "errors": histogram["errors"],
+        "cache_hits": histogram["cache_hits"],
+      }
+    return rows